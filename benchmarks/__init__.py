@@ -0,0 +1,6 @@
+# Copyright (c) 2021 Bill Chen
+# License: MIT (see LICENSE)
+
+"""
+Benchmarks of mesh_illustris, run with airspeed velocity (asv).
+"""
@@ -0,0 +1,75 @@
+# Copyright (c) 2021 Bill Chen
+# License: MIT (see LICENSE)
+
+"""
+Benchmarks of building and loading the index.
+"""
+
+import os
+import glob
+import shutil
+import tempfile
+import numpy as np
+
+from mesh_illustris import load, Mesh
+from mesh_illustris.cache import index_cache, meta_cache
+from .synthetic import make_snapshot
+
+# Number of particles of each type, override for larger runs
+N_PART = int(os.environ.get("MESH_ILLUSTRIS_BENCH_NPART", 2**18))
+
+class BuildIndex(object):
+    """Time, memory and disk size of building the index of a snapshot."""
+
+    params = ([6, 8], ["row", "morton"])
+    param_names = ["depth", "curve"]
+    timeout = 600
+
+    def setup_cache(self):
+        return make_snapshot(os.path.abspath("snapshot"), 
+            numPart={"gas": N_PART, "dm": N_PART})
+
+    def setup(self, basePath, depth, curve):
+        self.index_path = tempfile.mkdtemp()
+        index_cache.clear()
+        meta_cache.clear()
+
+    def teardown(self, basePath, depth, curve):
+        shutil.rmtree(self.index_path)
+
+    def _build(self, basePath, depth, curve):
+        return load(basePath, 0, ["gas", "dm"], depth, self.index_path, 
+            curve, build_index=True, workers=1)
+
+    def time_build(self, basePath, depth, curve):
+        self._build(basePath, depth, curve)
+
+    def peakmem_build(self, basePath, depth, curve):
+        self._build(basePath, depth, curve)
+
+    def track_disk_size(self, basePath, depth, curve):
+        self._build(basePath, depth, curve)
+        return sum(os.path.getsize(fn) 
+            for fn in glob.glob(self.index_path + "/*.h5"))
+    track_disk_size.unit = "bytes"
+
+    def track_memory_size(self, basePath, depth, curve):
+        data = self._build(basePath, depth, curve)
+        return sum(array.nbytes for d in data.datasets 
+            for g in d.index.values() for array in g.values() 
+            if isinstance(array, np.ndarray))
+    track_memory_size.unit = "bytes"
+
+class MeshBuild(object):
+    """Time of sorting points into a Mesh."""
+
+    params = ([6, 8, 10], ["counting", "sort"])
+    param_names = ["depth", "method"]
+
+    def setup(self, depth, method):
+        rng = np.random.default_rng(0)
+        self.pos = rng.uniform(0, 1, (N_PART, 3)).astype(np.float32)
+        self.boundary = np.array([[0, 0, 0], [1, 1, 1]], dtype=np.float32)
+
+    def time_build(self, depth, method):
+        Mesh(self.pos, N_PART, 0, self.boundary, depth).build(method)
@@ -0,0 +1,158 @@
+# Copyright (c) 2021 Bill Chen
+# License: MIT (see LICENSE)
+
+"""
+Benchmarks of box and sphere queries on an indexed snapshot.
+"""
+
+import os
+import numpy as np
+
+from mesh_illustris import load, profile
+from mesh_illustris.il_util import loadFile, snapPath
+from .synthetic import make_snapshot
+
+# Number of particles of each type, override for larger runs
+N_PART = int(os.environ.get("MESH_ILLUSTRIS_BENCH_NPART", 2**18))
+BOX_SIZE = 1e4
+
+def _setup_cache():
+    basePath = make_snapshot(os.path.abspath("snapshot"), n_chunk=8, 
+        numPart={"gas": N_PART}, box_size=BOX_SIZE)
+    for depth in [6, 8]:
+        for curve in ["row", "morton"]:
+            load(basePath, 0, "gas", depth, curve=curve, build_index=True, 
+                workers=1)
+    return basePath
+
+class Query(object):
+    """Latency of box and sphere queries against their selectivity, i.e., 
+    the fraction of the box they cover."""
+
+    params = ([1e-4, 1e-2, 0.2], [6, 8], ["row", "morton"])
+    param_names = ["selectivity", "depth", "curve"]
+    timeout = 600
+
+    def setup_cache(self):
+        return _setup_cache()
+
+    def setup(self, basePath, selectivity, depth, curve):
+        self.data = load(basePath, 0, "gas", depth, curve=curve)
+        side = BOX_SIZE * selectivity**(1/3)
+        self.boundary = np.array([[0.3, 0.4, 0.5]]*2) * BOX_SIZE
+        self.boundary[1] += side
+        self.center = self.boundary.mean(axis=0)
+        self.radius = side * (3 / (4*np.pi))**(1/3)
+        # Warm up the index and metadata caches
+        self.data.box(self.boundary, "gas", "Coordinates")
+
+    def time_box(self, basePath, selectivity, depth, curve):
+        self.data.box(self.boundary, "gas", ["Coordinates", "Masses"])
+
+    def time_box_exact(self, basePath, selectivity, depth, curve):
+        self.data.box(self.boundary, "gas", ["Coordinates", "Masses"], 
+            method="exact")
+
+    def time_sphere(self, basePath, selectivity, depth, curve):
+        self.data.sphere(self.center, self.radius, "gas", 
+            ["Coordinates", "Masses"])
+
+    def track_count(self, basePath, selectivity, depth, curve):
+        return len(self.data.box(self.boundary, "gas", 
+            "Masses")["gas"]["Masses"])
+    track_count.unit = "particles"
+
+class Merge(object):
+    """Latency of a box query against the number of chunk files the same 
+    particles are split into, i.e., the cost of merging the subsets of 
+    chunks, and against the threads reading them."""
+
+    params = ([1, 8, 64], [1, 4])
+    param_names = ["n_chunk", "workers"]
+    timeout = 600
+
+    def setup_cache(self):
+        basePaths = {}
+        for n_chunk in self.params[0]:
+            basePaths[n_chunk] = make_snapshot(os.path.abspath( 
+                "snapshot_%d"%n_chunk), n_chunk=n_chunk, 
+                numPart={"gas": N_PART}, box_size=BOX_SIZE)
+            load(basePaths[n_chunk], 0, "gas", 6, curve="morton", 
+                build_index=True, workers=1)
+        return basePaths
+
+    def setup(self, basePaths, n_chunk, workers):
+        self.data = load(basePaths[n_chunk], 0, "gas", 6, curve="morton")
+        self.boundary = np.array([[0.25]*3, [0.75]*3]) * BOX_SIZE
+        # Warm up the index and metadata caches
+        self.data.box(self.boundary, "gas", "Coordinates")
+
+    def time_box(self, basePaths, n_chunk, workers):
+        self.data.box(self.boundary, "gas", ["Coordinates", "Masses"], 
+            workers=workers)
+
+    def track_merge(self, basePaths, n_chunk, workers):
+        with profile() as p:
+            self.data.box(self.boundary, "gas", ["Coordinates", "Masses"], 
+                workers=workers)
+        return p.stages["merge"]["time"]
+    track_merge.unit = "seconds"
+
+class Load(object):
+    """Time of gathering rows of one chunk file."""
+
+    params = [1e-3, 0.1, 1.]
+    param_names = ["fraction"]
+
+    def setup_cache(self):
+        return _setup_cache()
+
+    def setup(self, basePath, fraction):
+        self.fn = snapPath(basePath, 0)
+        n = loadFile(self.fn, "gas", "Masses")["gas"]["count"]
+        rng = np.random.default_rng(0)
+        self.index = np.sort(rng.choice(n, int(n*fraction), replace=False))
+
+    def time_loadFile(self, basePath, fraction):
+        loadFile(self.fn, "gas", ["Coordinates", "Masses"], 
+            index=[self.index])
+
+class Overread(object):
+    """Particles read by small boxes around the densest particles, where 
+    cells of a uniform index are the most crowded."""
+
+    params = ["uniform", "adaptive"]
+    param_names = ["index"]
+    timeout = 600
+
+    def setup_cache(self):
+        basePath = make_snapshot(os.path.abspath("snapshot"), n_chunk=8, 
+            numPart={"gas": N_PART}, box_size=BOX_SIZE, clustering=0.9, 
+            halo_size=10.)
+        load(basePath, 0, "gas", 8, curve="morton", build_index=True, 
+            workers=1)
+        load(basePath, 0, "gas", 14, curve="morton", threshold=256, 
+            build_index=True, workers=1)
+        return basePath
+
+    def setup(self, basePath, index):
+        if index == "uniform":
+            self.data = load(basePath, 0, "gas", 8, curve="morton")
+        else:
+            self.data = load(basePath, 0, "gas", 14, curve="morton", 
+                threshold=256)
+        pos = loadFile(snapPath(basePath, 0), "gas", 
+            "Coordinates")["gas"]["Coordinates"]
+        self.boundaries = [np.array([p - 5., p + 5.]) for p in pos[:8]]
+
+    def time_box(self, basePath, index):
+        for boundary in self.boundaries:
+            self.data.box(boundary, "gas", "Masses")
+
+    def track_overread(self, basePath, index):
+        outer = sum(self.data.box(b, "gas", "Masses")["gas"]["count"] 
+            for b in self.boundaries)
+        exact = sum(self.data.box(b, "gas", "Masses", 
+            method="exact")["gas"]["count"] for b in self.boundaries)
+        return outer / max(exact, 1)
+    track_overread.unit = "ratio"
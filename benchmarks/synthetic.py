@@ -0,0 +1,74 @@
+# Copyright (c) 2021 Bill Chen
+# License: MIT (see LICENSE)
+
+"""
+synthetic module generates snapshots in the Illustris format for 
+benchmarks.
+"""
+
+import os
+import numpy as np
+import h5py
+
+from mesh_illustris.il_util import snapPath, partTypeNum
+
+def make_snapshot(basePath, snapNum=0, n_chunk=4, numPart={"gas": 2**18, 
+    "dm": 2**18}, box_size=1e4, clustering=0.5, n_halo=64, halo_size=100., 
+    seed=0):
+    """
+    Write a random snapshot in the Illustris format. A fraction of 
+    particles are clustered in halos with Gaussian profiles, and the rest 
+    are uniform. Like Illustris, particles of each halo are stored next to 
+    each other, and halos are split among chunks.
+
+    Args:
+        basePath (str): Base path of the simulation data.
+        snapNum (int, default to 0): Number of the snapshot.
+        n_chunk (int, default to 4): Number of chunks.
+        numPart (dict, default to {"gas": 2^18, "dm": 2^18}): Number of 
+            particles of each type in the snapshot.
+        box_size (scalar, default to 1e4): Box size of the simulation.
+        clustering (scalar, default to 0.5): Fraction of particles in halos.
+        n_halo (int, default to 64): Number of halos.
+        halo_size (scalar, default to 100.): Standard deviation of the 
+            positions of particles in a halo.
+        seed (int, default to 0): Random seed.
+
+    Returns:
+        str: basePath.
+    """
+
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0, box_size, (n_halo, 3))
+
+    data = {}
+    for p, n in numPart.items():
+        n_clustered = int(n * clustering)
+        halo = np.sort(rng.integers(n_halo, size=n_clustered))
+        pos = np.concatenate([
+            centers[halo] + rng.normal(0, halo_size, (n_clustered, 3)), 
+            rng.uniform(0, box_size, (n - n_clustered, 3))]) % box_size
+        data[partTypeNum(p)] = {
+            "Coordinates": pos, 
+            "Masses": rng.uniform(1, 2, n).astype(np.float32), 
+            "ParticleIDs": np.arange(n, dtype=np.uint64)}
+
+    for i in range(n_chunk):
+        fn = snapPath(basePath, snapNum, i)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with h5py.File(fn, "w") as f:
+            numPart_ThisFile = np.zeros(6, dtype=np.int64)
+            for ptNum, fields in data.items():
+                n = len(fields["Coordinates"])
+                rows = slice(i * n // n_chunk, (i+1) * n // n_chunk)
+                numPart_ThisFile[ptNum] = rows.stop - rows.start
+                grp = f.create_group("PartType%d"%ptNum)
+                for field, value in fields.items():
+                    grp.create_dataset(field, data=value[rows])
+
+            header = f.create_group("Header")
+            header.attrs["BoxSize"] = box_size
+            header.attrs["NumFilesPerSnapshot"] = n_chunk
+            header.attrs["NumPart_ThisFile"] = numPart_ThisFile
+
+    return basePath
@@ -1,13 +1,16 @@
 # Copyright (c) 2021 Bill Chen
 # License: MIT (see LICENSE)
 
-from . import core, il_util, loader, mesh
+from . import cache, core, il_util, loader, mesh, profiler
+from .cache import *
 from .core import *
 from .il_util import *
 from .loader import *
 from .mesh import *
+from .profiler import *
 
-__all__ = core.__all__ + il_util.__all__ + loader.__all__ + mesh.__all__
+__all__ = (cache.__all__ + core.__all__ + il_util.__all__ + loader.__all__ + 
+    mesh.__all__ + profiler.__all__)
 __version__ = "0.2.dev"
 __name__ = "mesh_illustris"
 __author__ = ["Bill Chen"]
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Bill Chen
+# License: MIT (see LICENSE)
+
+"""
+cache module defines the LRUCache to keep loaded indices and metadata 
+across queries.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from .profiler import _count
+
+__all__ = ["LRUCache", "index_cache", "meta_cache", "chunk_cache"]
+
+class LRUCache(object):
+    """LRUCache class caches objects within a memory budget, evicting the 
+    least recently used ones."""
+
+    def __init__(self, max_bytes, name=None, max_entries=None):
+        """
+        Args:
+            max_bytes (int): Memory budget in bytes. Memory-mapped arrays 
+                count with their mapped size. The most recently loaded 
+                object is always kept, even if it exceeds the budget.
+            name (None or str, default to None): Name of the cache. Hits 
+                and misses of a named cache are also counted by active 
+                profilers as "<name>_hits" and "<name>_misses".
+            max_entries (None or int, default to None): Maximum number of 
+                objects, e.g., to bound the file descriptors held by 
+                memory-mapped objects. None for no limit.
+        """
+
+        super(LRUCache, self).__init__()
+        self._max_bytes = max_bytes
+        self._max_entries = max_entries
+        self._name = name
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.RLock()
+
+    @property
+    def max_bytes(self):
+        """int: Memory budget in bytes."""
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        with self._lock:
+            self._max_bytes = value
+            self._evict()
+
+    @property
+    def max_entries(self):
+        """None or int: Maximum number of objects."""
+        return self._max_entries
+
+    @max_entries.setter
+    def max_entries(self, value):
+        with self._lock:
+            self._max_entries = value
+            self._evict()
+
+    @property
+    def stats(self):
+        """dict: Number of hits, misses, evictions, entries and bytes."""
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses, 
+                "evictions": self._evictions, "entries": len(self._data), 
+                "bytes": self._bytes}
+
+    def get(self, key, load):
+        """
+        Get a cached object, loading it if not cached.
+
+        Args:
+            key (hashable): Key of the object.
+            load (callable): Function called as load() to load the object 
+                if it is not cached.
+
+        Returns:
+            object: Cached or newly loaded object.
+        """
+
+        with self._lock:
+            hit = key in self._data
+            if hit:
+                self._hits += 1
+                self._data.move_to_end(key)
+                value = self._data[key][0]
+            else:
+                self._misses += 1
+
+        if self._name is not None:
+            _count(self._name + ("_hits" if hit else "_misses"))
+        if hit:
+            return value
+
+        # Load outside the lock so that other keys are not blocked
+        value = load()
+        size = _sizeof(value)
+
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = (value, size)
+                self._bytes += size
+                self._evict()
+            return value
+
+    def pop(self, key):
+        """
+        Remove an object from the cache if it is cached.
+
+        Args:
+            key (hashable): Key of the object.
+        """
+
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[1]
+
+    def clear(self):
+        """Remove all objects and reset the statistics."""
+
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+
+    def _evict(self):
+        """
+        Evict least recently used objects until within the budget. Maps of 
+        evicted objects are closed once they are no longer referenced 
+        elsewhere.
+        """
+        while len(self._data) > 1 and (self._bytes > self._max_bytes or 
+            (self._max_entries is not None and 
+            len(self._data) > self._max_entries)):
+            self._bytes -= self._data.popitem(last=False)[1][1]
+            self._evictions += 1
+
+def _sizeof(value):
+    """
+    Approximate memory usage of an object in bytes.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+# Loaded indices of chunks, with a default budget of 4 GB. Each index 
+# holds one file descriptor for its map, so at most 256 are kept
+index_cache = LRUCache(2**32, "index_cache", 256)
+
+# Header and offset, dtype and shape of fields in chunk files
+meta_cache = LRUCache(2**26, "meta_cache")
+
+# Decompressed storage chunks of chunked (e.g., compressed) datasets
+chunk_cache = LRUCache(2**28, "chunk_cache")
@@ -7,29 +7,61 @@ core codes of the mesh_illustris package.
 """
 
 import os
+import contextlib
+import collections
 import numpy as np
 import h5py
-import time
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor, 
+    as_completed)
+
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
 
 from .il_util import *
-from .mesh import Mesh
+from .il_util import _fieldMeta, _fileMeta
+from .cache import index_cache, meta_cache
+from .profiler import _stage, _count, _propagate
+from .mesh import (Mesh, _encode, _decode, _adapt, _key_intervals, 
+    _column_intervals, _subtract_intervals, _sphere_columns, 
+    _sphere_intervals)
+
+__all__ = ["Dataset", "SingleDataset", "Selection"]
+
+# Particle types with more particles are indexed block by block
+_BLOCK_SIZE = 2**24
+
+# Reductions stored in the pyramid of per-cell aggregates
+_UFUNC = {"sum": np.add, "min": np.minimum, "max": np.maximum}
+_IDENTITY = {"sum": 0., "min": np.inf, "max": -np.inf}
 
-__all__ = ["Dataset", "SingleDataset"]
+# Offsets of the children of a cell at the next level
+_CORNERS = np.array([[i, j, k] for i in range(2) for j in range(2) 
+    for k in range(2)])
 
 class Dataset(object):
     """Dataset class stores a snapshot of simulation."""
 
-    def __init__(self, datasets, n_chunk):
+    def __init__(self, datasets, n_chunk, summary_fn=None):
         """
         Args:
             datasets (list of SingleDataset): Chunks that store the 
                 snapshot of simulation. 
             n_chunk (int): Number of chunks
+            summary_fn (None or str, default to None): File name of the 
+                snapshot index, which maps cells to particles in all chunks, 
+                so that a query only opens this file and the data files it 
+                needs. With adaptive indices, it only has the extents of 
+                chunks, so that a query only opens the chunks it needs. 
+                None to query the index file of each chunk.
         """
 
         super(Dataset, self).__init__()
         self._datasets = datasets
         self._n_chunk = n_chunk
+        self._summary_fn = summary_fn
+        self._built = False
 
     @property
     def datasets(self):
@@ -42,8 +74,262 @@ class Dataset(object):
         """int: Number of chunks."""
         return self._n_chunk
 
+    @property
+    def summary(self):
+        """dict: Extents (in units of Mesh cells) and counts of particles in 
+            each chunk, from the snapshot index. Extents of adaptive indices 
+            enclose their leaves."""
+
+        return {gName: {"count": g["count"], "extent": g["extent"]} 
+            for gName, g in self.index.items()}
+
+    @property
+    def index(self):
+        """dict: Newly generated or cached snapshot index. Loaded index is 
+            kept in index_cache, which evicts the least recently used index 
+            beyond its memory budget."""
+
+        # Create the snapshot index if necessary
+        if not self._built:
+            self.build_summary()
+            self._built = True
+
+        index = {}
+        with _stage("index", self._summary_fn):
+            for p in self._datasets[0].partType:
+                gName = "PartType%d"%(partTypeNum(p))
+                index[gName] = index_cache.get((self._summary_fn, gName), 
+                    lambda: self._load_index(gName))
+
+        return index
+
+    def _load_index(self, gName):
+        """
+        Load the snapshot index of one particle type. Arrays are 
+        memory-mapped, so that a query only reads the pages it touches.
+        """
+        mapped = np.memmap(self._summary_fn, mode="r")
+        with h5py.File(self._summary_fn, "r") as f:
+            return {name: _memmap(mapped, f[gName][name]) 
+                for name in f[gName].keys()}
+
+    def build_summary(self):
+        """
+        Build the snapshot index from the index files of all chunks if it 
+        does not exist or misses some particle types. Index files are 
+        built serially if necessary, call build_indices() beforehand to 
+        build them in parallel.
+
+        For each particle type, the snapshot index stores the index of all 
+        chunks one after another, with the offset of each chunk. Occupied 
+        cells of all chunks are stored as runs (key, chunk, start, end) 
+        sorted by key and chunk, where particles of cell key in chunk are 
+        index[offset[chunk]:][start:end]. Counts and extents (in units of 
+        Mesh cells) of particles in each chunk are stored as well, and only 
+        them for adaptive indices.
+        """
+
+        partType = self._datasets[0].partType
+        name = "extent" if self._datasets[0]._threshold is not None else ( 
+            "index")
+        if not _missing_index(self._summary_fn, partType, name):
+            return
+
+        with _lock(self._summary_fn):
+            todo = _missing_index(self._summary_fn, partType, name)
+            if not todo:
+                return
+
+            for d in self._datasets:
+                d.build_index()
+
+            with _replace(self._summary_fn) as f:
+                for p in todo:
+                    gName = "PartType%d"%(partTypeNum(p))
+                    _build_summary(self._datasets, gName, 
+                        f.create_group(gName))
+
+            for p in todo:
+                index_cache.pop((self._summary_fn, 
+                    "PartType%d"%(partTypeNum(p))))
+
+    def _select(self, func, partType, workers=None, refine=True, 
+        **kwargs):
+        """
+        Slice the snapshot index to select particles of a subset (e.g., a 
+        box or sphere) in all chunks. Without the snapshot index, the index 
+        of each chunk is sliced instead, skipping chunks whose extents in 
+        the summary of adaptive indices miss the subset.
+
+        Args:
+            func (str): Types of subset, must be "box" or "sphere".
+            partType (list of str): Particle types to be selected.
+            workers (None or int, default to None): Number of threads to 
+                refine the exact subset in chunks concurrently.
+            refine (bool, default to True): Whether to refine particles on 
+                the boundary for the exact subset, see SingleDataset._select.
+            **kwargs: arguments to be sent to slicing function.
+
+        Returns:
+            tuple: Chunks containing particles of the subset, and list of 
+                Selection of each particle type in each of these chunks.
+        """
+
+        adaptive = self._datasets[0]._threshold is not None
+        if self._summary_fn is None or adaptive:
+            datasets = self._prune(func, partType, **kwargs)
+            return datasets, _map(
+                lambda d: d._select(func, partType, refine, **kwargs), 
+                datasets, workers)
+
+        idx = self.index
+        d = self._datasets[0]
+        with _stage("slicing", self._summary_fn):
+            select, edge = d._intervals(func, **kwargs)
+
+            ranges = []
+            for p in partType:
+                g = idx["PartType%d"%(partTypeNum(p))]
+                ranges.append([_split_runs(_runs(intervals, g["key"], 
+                    g["chunk"], g["start"], g["end"]), self._n_chunk) 
+                    if intervals is not None else None 
+                    for intervals in [select, edge]])
+
+        # At least one chunk is needed to create an empty subset
+        chunks = sorted(set(c for r in ranges for rr in r if rr is not None 
+            for c in rr)) or [0]
+
+        def select_chunk(c):
+            targets = []
+            for j, p in enumerate(partType):
+                g = idx["PartType%d"%(partTypeNum(p))]
+                index = (None if self._datasets[c]._store else 
+                    g["index"][g["offset"][c]:g["offset"][c+1]])
+                empty = np.empty((0, 2), dtype=np.int64)
+                target = Selection(ranges[j][0].get(c, empty), index)
+                boundary = None if edge is None else Selection(
+                    ranges[j][1].get(c, empty), index)
+                if not refine:
+                    targets.append((target, boundary))
+                    continue
+                if boundary is not None:
+                    target = _refine(self._datasets[c].data_fn, p, boundary, 
+                        target, func, d.box_size, **kwargs)
+                _count("particles", len(target), self._datasets[c].fn)
+                targets.append(target)
+            return targets
+
+        return ([self._datasets[c] for c in chunks], 
+            _map(select_chunk, chunks, workers))
+
+    def _prune(self, func, partType, **kwargs):
+        """
+        Chunks whose extents in the summary intersect a subset (e.g., a box 
+        or sphere), or all chunks without the summary. At least one chunk 
+        is returned to create an empty subset.
+        """
+        if self._summary_fn is None:
+            return self._datasets
+
+        d = self._datasets[0]
+        cell_size = (d._boundary[1] - d._boundary[0]) / 2**d._depth
+        needed = np.zeros(self._n_chunk, dtype=bool)
+        idx = self.index
+        with _stage("slicing", self._summary_fn):
+            for p in partType:
+                g = idx["PartType%d"%(partTypeNum(p))]
+                extent = np.asarray(g["extent"])
+                outside = _classify(func, d._boundary[0] + cell_size * 
+                    extent[:,0], cell_size * (extent[:,1] - extent[:,0]), 
+                    d.box_size, **kwargs)[1]
+                needed |= (np.asarray(g["count"]) > 0) & ~outside
+
+        return [self._datasets[c] for c in np.flatnonzero(needed)] or ( 
+            self._datasets[:1])
+
+    def build_indices(self, workers=None, progress=None, block_size=None):
+        """
+        Build the index files of all chunks in a process pool. Chunks with 
+        complete index files are skipped. The summary of chunk extents is 
+        built afterwards if summary_fn is given.
+
+        Args:
+            workers (None or int, default to None): Number of processes. 
+                None to use the number of processors, 1 to build serially 
+                in the current process.
+            progress (None or callable, default to None): Function called 
+                as progress(n_done, n_total) after each chunk is indexed.
+            block_size (None or int, default to None): Particle types with 
+                more particles are indexed block by block with bounded 
+                memory. None to use 2^24.
+        """
+
+        todo = [d for d in self._datasets if 
+            _missing_index(d._index_fn, d._partType) or 
+            _missing_aggregate(d._index_fn, d._partType, d._aggregate) or 
+            _missing_store(d._store_fn, d._partType, d._store)]
+        n_total = len(todo)
+
+        if workers == 1:
+            for n, d in enumerate(todo):
+                d.build_index(block_size)
+                if progress: progress(n+1, n_total)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_build_index, d._fn, 
+                    d._partType, d._boundary, d._depth, d._curve, 
+                    d._index_fn, block_size, d._aggregate, d._store, 
+                    d._store_fn, d._threshold) for d in todo]
+                for n, future in enumerate(as_completed(futures)):
+                    future.result()
+                    if progress: progress(n+1, n_total)
+
+            # Indices loaded before are outdated
+            for d in todo:
+                for p in d._partType:
+                    index_cache.pop((d._index_fn, 
+                        "PartType%d"%(partTypeNum(p))))
+                meta_cache.pop(("file", d._store_fn))
+
+        if self._summary_fn:
+            self.build_summary()
+
+    def _cells(self, intervals, partType):
+        """
+        Occupied cells of one particle type within intervals of cell keys. 
+        Returns a list of (chunk, index, key, start, end) for chunks that 
+        have such cells, where particles of each cell are index[start:end].
+        """
+
+        # Leaves of an adaptive index are not cells at the same level
+        if self._datasets[0]._threshold is not None:
+            raise ValueError("threshold must be None for deposit and " 
+                "reductions!")
+
+        gName = "PartType%d"%(partTypeNum(partType))
+        cells = []
+        if self._summary_fn is None:
+            for d in self._datasets:
+                g = d.index[gName]
+                pos = _positions(intervals, g["key"])
+                if len(pos):
+                    cells.append((d, g["index"], g["key"][pos], 
+                        g["mark"][pos], g["mark"][pos+1]))
+            return cells
+
+        g = self.index[gName]
+        pos = _positions(intervals, g["key"])
+        pos = pos[np.argsort(g["chunk"][pos], kind="stable")]
+        chunk = g["chunk"][pos]
+        for c in np.unique(chunk):
+            p = pos[np.searchsorted(chunk, c):np.searchsorted(chunk, c+1)]
+            cells.append((self._datasets[c], 
+                g["index"][g["offset"][c]:g["offset"][c+1]], g["key"][p], 
+                g["start"][p], g["end"][p]))
+        return cells
+
     def _combine(self, func, partType, fields, mdi=None, 
-        float32=False, **kwargs):
+        float32=False, workers=None, out=None, unwrap=False, **kwargs):
         """
         Combine subsets (e.g., a box or sphere) of data in different chunks 
         into one subset.
@@ -56,6 +342,14 @@ class Dataset(object):
             mdi (None or list of int, default to None): sub-indeces to be 
                 loaded. None to load all.
             float32 (bool, default to False): Whether to use float32 or not.
+            workers (None or int, default to None): Number of threads to 
+                query chunks concurrently. None or 1 to query serially.
+            out (None or dict, default to None): Buffer to store the 
+                subset, with the same structure as the returned dict. Each 
+                array must be long enough to hold the subset. None to 
+                allocate new arrays.
+            unwrap (bool, default to False): Whether to unwrap Coordinates 
+                periodically to be closest to the center of the subset.
             **kwargs: arguments to be sent to slicing function.
 
         Returns:
@@ -70,34 +364,261 @@ class Dataset(object):
         if isinstance(partType, str):
             partType = [partType]
 
-        for j, d in enumerate(self._datasets):
-            if func == "box":
-                r = d.box(kwargs["boundary"], 
-                    partType, fields, mdi, float32)
-            elif func == "sphere":
-                r = d.sphere(kwargs["center"], kwargs["radius"], 
-                    partType, fields, mdi, float32)
-            else:
-                raise ValueError("func must be either \"box\" or \"sphere\"!")
-
-            if j == 0:
-                result = r
-            else:
-                # Loop over particle types
-                for p in partType:
-                    # Loop over each requested field for this particle type
-                    for i, field in enumerate(fields):
-                        # read data local to the current file
-                        if mdi is None or mdi[i] is None:
-                            result[p][field] = _concatenate_enable_empty(
-                                result[p][field], r[p][field][:])
-                        else:
-                            result[p][field] = _concatenate_enable_empty(
-                                result[p][field], r[p][field][:,mdi[i]])
+        if func not in ["box", "sphere"]:
+            raise ValueError("func must be either \"box\" or \"sphere\"!")
+        _check_store(self._datasets[0], fields)
+
+        # Slice the index first, so that the number of particles from each 
+        # chunk is known before reading any data. Chunks irrelevant to the 
+        # subset are skipped
+        datasets, targets = self._select(func, partType, workers, **kwargs)
+
+        # Allocate the subset once, or use the buffer given by out
+        result = {}
+        views = [{} for d in datasets]
+        with _stage("merge"):
+            for j, p in enumerate(partType):
+                counts = [len(t[j]) for t in targets]
+                offsets = np.cumsum([0] + counts)
+                result[p] = {"count": offsets[-1]}
+
+                meta = _meta(datasets, p, fields, mdi, float32)
+                for i, field in enumerate(fields):
+                    if meta is None:
+                        result[p][field] = np.array([])
+                    elif out is None:
+                        result[p][field] = np.empty(
+                            (offsets[-1],) + meta[field]["shape"], 
+                            dtype=meta[field]["dtype"])
+                    else:
+                        buf = out[p][field]
+                        if (len(buf) < offsets[-1] or 
+                            buf.shape[1:] != meta[field]["shape"]):
+                            raise ValueError("out[%s][%s] must have shape "
+                                "of at least %s!"%(p, field, 
+                                (offsets[-1],) + meta[field]["shape"]))
+                        result[p][field] = buf[:offsets[-1]]
+
+                    for c in range(len(datasets)):
+                        views[c].setdefault(p, {})[field] = (
+                            result[p][field][offsets[c]:offsets[c+1]])
+
+        # Read data of each chunk in place
+        _map(lambda c: loadFile(datasets[c].data_fn, partType, fields, mdi, 
+            float32, targets[c], views[c]), range(len(datasets)), workers)
+
+        if unwrap:
+            with _stage("merge"):
+                _unwrap(result, partType, fields, mdi, 
+                    self._datasets[0].box_size, _center(func, **kwargs))
 
         return result
-    
-    def box(self, boundary, partType, fields, mdi=None, float32=False):
+
+    def _combine_many(self, func, partType, fields, queries, mdi=None, 
+        float32=False, workers=None, unwrap=False, **kwargs):
+        """
+        Combine many subsets (e.g., boxes or spheres) of data in different 
+        chunks, reading and refining each chunk only once for all subsets. 
+
+        Args:
+            func (str): Types of subset, must be "box" or "sphere". This 
+                argument determines the slicing method.
+            partType (str or list of str): Particle types to be loaded.
+            fields (str or list of str): Particle fields to be loaded.
+            queries (list of dict): Arguments to be sent to slicing function 
+                for each subset.
+            mdi (None or list of int, default to None): sub-indeces to be 
+                loaded. None to load all.
+            float32 (bool, default to False): Whether to use float32 or not.
+            workers (None or int, default to None): Number of threads to 
+                query chunks concurrently. None or 1 to query serially.
+            unwrap (bool, default to False): Whether to unwrap Coordinates 
+                periodically to be closest to the center of each subset.
+            **kwargs: arguments to be sent to slicing function for all 
+                subsets.
+
+        Yields:
+            tuple: Number of the subset in queries, and the subset of data, 
+                as soon as all chunks of the subset are read.
+        """
+
+        # Make sure fields is not a single element
+        if isinstance(fields, str):
+            fields = [fields]
+
+        # Make sure partType is not a single element
+        if isinstance(partType, str):
+            partType = [partType]
+
+        if func not in ["box", "sphere"]:
+            raise ValueError("func must be either \"box\" or \"sphere\"!")
+        _check_store(self._datasets[0], fields)
+
+        queries = [dict(kwargs, **q) for q in queries]
+
+        # Slice the index for all subsets first, and collect the 
+        # selections of all subsets in each chunk, which are refined later
+        number = {id(d): c for c, d in enumerate(self._datasets)}
+        todo = collections.defaultdict(list)
+        last = {}
+        for i, q in enumerate(queries):
+            datasets, selections = self._select(func, partType, workers, 
+                False, **q)
+            for d, selection in zip(datasets, selections):
+                if any(len(t) or (e is not None and len(e)) 
+                    for t, e in selection):
+                    todo[number[id(d)]].append((i, selection))
+                    last[i] = max(last.get(i, 0), number[id(d)])
+        chunks = sorted(todo)
+        done = collections.defaultdict(list)
+        for i, c in last.items():
+            done[c].append(i)
+
+        meta = [_meta([self._datasets[c] for c in chunks] or 
+            self._datasets[:1], p, fields, mdi, float32) for p in partType]
+
+        def refine(c):
+            # Refine the union of particles on the boundary of all subsets 
+            # once, and split it to subsets
+            d = self._datasets[c]
+            targets = [[] for i, selection in todo[c]]
+            for j, p in enumerate(partType):
+                edges = [selection[j][1] for i, selection in todo[c] 
+                    if selection[j][1] is not None]
+                if edges:
+                    with _stage("refine", d.data_fn):
+                        union = np.unique(np.concatenate([e.index 
+                            for e in edges]))
+                        pos = loadFile(d.data_fn, p, "Coordinates", 
+                            float32=False, index=[union])[p]["Coordinates"]
+
+                for n, (i, selection) in enumerate(todo[c]):
+                    target, edge = selection[j]
+                    if edge is not None:
+                        extra = edge.index
+                        inside = _contains(func, pos[np.searchsorted(union, 
+                            extra)], d.box_size, **queries[i])
+                        target = Selection(target.ranges, target._index, 
+                            extra[inside])
+                    _count("particles", len(target), d.fn)
+                    targets[n].append(target)
+            return targets
+
+        def read(c):
+            # Read the union of selections once, and scatter it to subsets
+            targets = refine(c)
+            union = [np.unique(np.concatenate([np.array([], dtype=np.int64)] 
+                + [target[j].index for target in targets])) 
+                for j in range(len(partType))]
+            data = loadFile(self._datasets[c].data_fn, partType, fields, mdi, 
+                float32, union)
+
+            pieces = []
+            with _stage("merge", self._datasets[c].data_fn):
+                for (i, selection), target in zip(todo[c], targets):
+                    piece = {}
+                    for j, p in enumerate(partType):
+                        rows = np.searchsorted(union[j], target[j].index)
+                        if len(rows):
+                            piece[p] = {field: data[p][field][rows] 
+                                for field in fields}
+                    pieces.append((i, piece))
+            return pieces
+
+        def assemble(i, pieces):
+            with _stage("merge"):
+                result = _assemble(pieces, partType, fields, meta)
+                if unwrap:
+                    _unwrap(result, partType, fields, mdi, 
+                        self._datasets[0].box_size, 
+                        _center(func, **queries[i]))
+            return result
+
+        # Subsets without any particles
+        for i in range(len(queries)):
+            if i not in last:
+                yield i, assemble(i, [])
+
+        pieces = collections.defaultdict(list)
+        for c, chunk_pieces in zip(chunks, _imap(read, chunks, workers)):
+            for i, piece in chunk_pieces:
+                pieces[i].append(piece)
+
+            # Subsets whose chunks are all read
+            for i in done[c]:
+                yield i, assemble(i, pieces.pop(i))
+
+    def _iterate(self, func, partType, fields, mdi=None, float32=False, 
+        batch_size=None, workers=1, unwrap=False, **kwargs):
+        """
+        Iterate over a subset (e.g., a box or sphere) of data in batches, 
+        reading the next batches in the background.
+
+        Args:
+            func (str): Types of subset, must be "box" or "sphere". This 
+                argument determines the slicing method.
+            partType (str or list of str): Particle types to be loaded.
+            fields (str or list of str): Particle fields to be loaded.
+            mdi (None or list of int, default to None): sub-indeces to be 
+                loaded. None to load all.
+            float32 (bool, default to False): Whether to use float32 or not.
+            batch_size (None or int, default to None): Maximum number of 
+                particles of each type in a batch. None to yield one batch 
+                per chunk.
+            workers (None or int, default to 1): Number of batches read 
+                in the background ahead of the consumer. None to read in 
+                the foreground.
+            unwrap (bool, default to False): Whether to unwrap Coordinates 
+                periodically to be closest to the center of the subset.
+            **kwargs: arguments to be sent to slicing function.
+
+        Returns:
+            generator: Batches of the subset, with the same structure as 
+                the subset returned by _combine().
+        """
+
+        # Make sure fields is not a single element
+        if isinstance(fields, str):
+            fields = [fields]
+
+        # Make sure partType is not a single element
+        if isinstance(partType, str):
+            partType = [partType]
+
+        if func not in ["box", "sphere"]:
+            raise ValueError("func must be either \"box\" or \"sphere\"!")
+        _check_store(self._datasets[0], fields)
+
+        chunks = collections.deque(zip(*self._select(func, partType, 
+            **kwargs)))
+
+        def batches():
+            # Split the selection of each chunk into batches, and drop the 
+            # selection once its batches are read
+            while chunks:
+                d, target = chunks.popleft()
+                length = max(len(t) for t in target)
+                size = batch_size if batch_size else max(length, 1)
+                for start in range(0, length, size):
+                    yield d, target, start, start + size
+
+        center = _center(func, **kwargs)
+        def read(batch):
+            d, target, start, end = batch
+            index = [t.slice(start, end) for t in target]
+            result = loadFile(d.data_fn, partType, fields, mdi, float32, 
+                index)
+            for j, p in enumerate(partType):
+                result[p]["count"] = len(index[j])
+            if unwrap:
+                _unwrap(result, partType, fields, mdi, d.box_size, center)
+            return result
+
+        return _imap(read, batches(), workers)
+
+    def box(self, boundary, partType, fields, mdi=None, float32=False, 
+        workers=None, out=None, method="outer", periodic=True, 
+        unwrap=False):
         """
         Load a sub-box of data.
 
@@ -109,15 +630,30 @@ class Dataset(object):
             mdi (None or list of int, default to None): sub-indeces to be 
                 loaded. None to load all.
             float32 (bool, default to False): Whether to use float32 or not.
+            workers (None or int, default to None): Number of threads to 
+                query chunks concurrently. None or 1 to query serially.
+            out (None or dict, default to None): Buffer to store the 
+                sub-box, with the same structure as the returned dict. 
+                None to allocate new arrays.
+            method (str, default to "outer"): How to load the box, must be 
+                "outer" (cells intersecting the box), "exact" or "inner" 
+                (cells inside the box).
+            periodic (bool, default to True): Whether the box wraps around 
+                the periodic boundary of the simulation.
+            unwrap (bool, default to False): Whether to unwrap Coordinates 
+                periodically to be closest to the center of the box.
 
         Returns:
             dict: Sub-box of data.
         """
-        return self._combine("box", partType, fields, mdi, float32, 
-            boundary=boundary)
+        with _stage("query"):
+            return self._combine("box", partType, fields, mdi, float32, 
+                workers, out, unwrap, boundary=boundary, method=method, 
+                periodic=periodic)
 
     def sphere(self, center, radius, partType, fields, mdi=None, 
-        float32=False):
+        float32=False, workers=None, out=None, method="outer", 
+        periodic=True, unwrap=False):
         """
         Load a sub-sphere of data.
 
@@ -130,17 +666,363 @@ class Dataset(object):
             mdi (None or list of int, default to None): sub-indeces to be 
                 loaded. None to load all.
             float32 (bool, default to False): Whether to use float32 or not.
+            workers (None or int, default to None): Number of threads to 
+                query chunks concurrently. None or 1 to query serially.
+            out (None or dict, default to None): Buffer to store the 
+                sub-sphere, with the same structure as the returned dict. 
+                None to allocate new arrays.
+            method (str, default to "outer"): How to load the sphere, must 
+                be "outer" (cells intersecting the sphere), "exact" or 
+                "inner" (cells inside the sphere).
+            periodic (bool, default to True): Whether the sphere wraps 
+                around the periodic boundary of the simulation.
+            unwrap (bool, default to False): Whether to unwrap Coordinates 
+                periodically to be closest to the center of the sphere.
 
         Returns:
             dict: Sub-sphere of data.
         """
-        return self._combine("sphere", partType, fields, mdi, float32, 
-            center=center, radius=radius)
+        with _stage("query"):
+            return self._combine("sphere", partType, fields, mdi, float32, 
+                workers, out, unwrap, center=center, radius=radius, 
+                method=method, periodic=periodic)
+
+    def iter_box(self, boundary, partType, fields, mdi=None, 
+        float32=False, batch_size=None, workers=1, method="outer", 
+        periodic=True, unwrap=False):
+        """
+        Iterate over a sub-box of data in batches with bounded memory.
+
+        Args:
+            boundary (numpy.ndarray of scalar): Boundary of the box, with 
+                shape of (3, 2).
+            partType (str or list of str): Particle types to be loaded.
+            fields (str or list of str): Particle fields to be loaded.
+            mdi (None or list of int, default to None): sub-indeces to be 
+                loaded. None to load all.
+            float32 (bool, default to False): Whether to use float32 or not.
+            batch_size (None or int, default to None): Maximum number of 
+                particles of each type in a batch. None to yield one batch 
+                per chunk.
+            workers (None or int, default to 1): Number of batches read 
+                in the background ahead of the consumer. None to read in 
+                the foreground.
+            method (str, default to "outer"): How to load the box, must be 
+                "outer" (cells intersecting the box), "exact" or "inner" 
+                (cells inside the box).
+            periodic (bool, default to True): Whether the box wraps around 
+                the periodic boundary of the simulation.
+            unwrap (bool, default to False): Whether to unwrap Coordinates 
+                periodically to be closest to the center of the box.
+
+        Returns:
+            generator: Batches of the sub-box, each with the same structure 
+                as the sub-box returned by box().
+        """
+        return self._iterate("box", partType, fields, mdi, float32, 
+            batch_size, workers, unwrap, boundary=boundary, method=method, 
+            periodic=periodic)
+
+    def iter_sphere(self, center, radius, partType, fields, mdi=None, 
+        float32=False, batch_size=None, workers=1, method="outer", 
+        periodic=True, unwrap=False):
+        """
+        Iterate over a sub-sphere of data in batches with bounded memory.
+
+        Args:
+            center (numpy.ndarray of scalar): Center of the sphere, with 
+                shape of (3,).
+            radius (scalar): Radius of the sphere.
+            partType (str or list of str): Particle types to be loaded.
+            fields (str or list of str): Particle fields to be loaded.
+            mdi (None or list of int, default to None): sub-indeces to be 
+                loaded. None to load all.
+            float32 (bool, default to False): Whether to use float32 or not.
+            batch_size (None or int, default to None): Maximum number of 
+                particles of each type in a batch. None to yield one batch 
+                per chunk.
+            workers (None or int, default to 1): Number of batches read 
+                in the background ahead of the consumer. None to read in 
+                the foreground.
+            method (str, default to "outer"): How to load the sphere, must 
+                be "outer" (cells intersecting the sphere), "exact" or 
+                "inner" (cells inside the sphere).
+            periodic (bool, default to True): Whether the sphere wraps 
+                around the periodic boundary of the simulation.
+            unwrap (bool, default to False): Whether to unwrap Coordinates 
+                periodically to be closest to the center of the sphere.
+
+        Returns:
+            generator: Batches of the sub-sphere, each with the same 
+                structure as the sub-sphere returned by sphere().
+        """
+        return self._iterate("sphere", partType, fields, mdi, float32, 
+            batch_size, workers, unwrap, center=center, radius=radius, 
+            method=method, periodic=periodic)
+
+    def deposit(self, boundary, partType, field=None, bins=64, 
+        workers=None, periodic=True):
+        """
+        Deposit particles in a box onto a regular grid, summing a field in 
+        each bin. Particles in Mesh cells that lie entirely in one bin are 
+        summed cell by cell without reading their Coordinates, or from the 
+        aggregates in the index if the field is aggregated, so that only 
+        particles in cells across the edges of bins are read and binned 
+        one by one.
+
+        Args:
+            boundary (numpy.ndarray of scalar): Boundary of the box, with 
+                shape of (3, 2).
+            partType (str or list of str): Particle types to be deposited.
+            field (None or str, default to None): Scalar field to be summed 
+                in each bin. None to count particles.
+            bins (int or list of int, default to 64): Number of bins along 
+                each axis.
+            workers (None or int, default to None): Number of threads to 
+                deposit chunks concurrently. None or 1 to deposit serially.
+            periodic (bool, default to True): Whether the box wraps around 
+                the periodic boundary of the simulation.
+
+        Returns:
+            dict: Grid of each particle type, with shape of bins.
+        """
+
+        # Make sure partType is not a single element
+        if isinstance(partType, str):
+            partType = [partType]
+
+        boundary = np.asarray(boundary, dtype=np.float64)
+        bins = tuple(np.broadcast_to(bins, (3,)).astype(np.int64))
+
+        d = self._datasets[0]
+        lower, upper = d._cell_range(boundary)
+        intervals = _key_intervals(lower, upper, d._depth, d._curve, 
+            periodic)
+
+        result = {}
+        for p in partType:
+            grids = _map(lambda cells: _deposit(*cells, p, field, boundary, 
+                bins, periodic), self._cells(intervals, p), workers)
+            result[p] = np.sum(grids, axis=0) if grids else np.zeros(bins)
+
+        return result
+
+    def project(self, boundary, partType, field=None, axis=2, bins=64, 
+        workers=None, periodic=True):
+        """
+        Project particles in a box along an axis onto a regular 2D grid, 
+        summing a field in each bin, e.g., to make a column density map. 
+        See deposit() for details.
+
+        Args:
+            boundary (numpy.ndarray of scalar): Boundary of the box, with 
+                shape of (3, 2).
+            partType (str or list of str): Particle types to be projected.
+            field (None or str, default to None): Scalar field to be summed 
+                in each bin. None to count particles.
+            axis (int, default to 2): Axis of the projection.
+            bins (int or list of int, default to 64): Number of bins along 
+                each of the other two axes.
+            workers (None or int, default to None): Number of threads to 
+                project chunks concurrently. None or 1 to project serially.
+            periodic (bool, default to True): Whether the box wraps around 
+                the periodic boundary of the simulation.
+
+        Returns:
+            dict: Grid of each particle type, with shape of bins.
+        """
+        bins = list(np.broadcast_to(bins, (2,)))
+        bins.insert(axis, 1)
+        grid = self.deposit(boundary, partType, field, bins, workers, 
+            periodic)
+        return {p: g.sum(axis=axis) for p, g in grid.items()}
+
+    def _reduce(self, func, partType, fields=None, workers=None, **kwargs):
+        """
+        Reduce particles of a subset (e.g., a box or sphere) to their count, 
+        and the sum, minimum and maximum of fields, from the pyramid of 
+        per-cell aggregates. Cells are visited from the coarsest level, and 
+        only particles in the finest cells across the boundary of the subset 
+        are read. Without the pyramid, particles are counted from the cells 
+        at the finest level.
+
+        Args:
+            func (str): Types of subset, must be "box" or "sphere".
+            partType (str or list of str): Particle types to be reduced.
+            fields (None or str or list of str, default to None): Fields to 
+                be reduced, which must be aggregated in the index. None to 
+                count particles only.
+            workers (None or int, default to None): Number of threads to 
+                reduce chunks concurrently. None or 1 to reduce serially.
+            **kwargs: arguments to be sent to slicing function.
+
+        Returns:
+            dict: For each particle type, the "count" of particles and the 
+                "sum", "min" and "max" of each field.
+        """
+
+        # Make sure fields is not a single element
+        if isinstance(fields, str):
+            fields = [fields]
+        fields = fields if fields else []
+
+        # Make sure partType is not a single element
+        if isinstance(partType, str):
+            partType = [partType]
+
+        if func not in ["box", "sphere"]:
+            raise ValueError("func must be either \"box\" or \"sphere\"!")
+
+        select = self._datasets[0]._intervals(func, **dict(kwargs, 
+            method="outer"))[0]
+
+        result = {}
+        for p in partType:
+            partial = _map(lambda cells: _reduce(*cells, p, fields, func, 
+                **kwargs), self._cells(select, p), workers)
+            result[p] = {"count": sum(r["count"] for r in partial)}
+            for field in fields:
+                result[p][field] = {name: ufunc.reduce(
+                    [r[field][name] for r in partial], 
+                    initial=_IDENTITY[name]) for name, ufunc in _UFUNC.items()}
+        return result
+
+    def reduce_box(self, boundary, partType, fields=None, workers=None, 
+        periodic=True):
+        """
+        Reduce particles in a box to their count, and the sum, minimum and 
+        maximum of fields. Most of the box is answered by the pyramid of 
+        per-cell aggregates in the index, and only particles in cells 
+        across the boundary of the box are read.
+
+        Args:
+            boundary (numpy.ndarray of scalar): Boundary of the box, with 
+                shape of (3, 2).
+            partType (str or list of str): Particle types to be reduced.
+            fields (None or str or list of str, default to None): Fields to 
+                be reduced, which must be aggregated in the index, see 
+                load(). None to count particles only.
+            workers (None or int, default to None): Number of threads to 
+                reduce chunks concurrently. None or 1 to reduce serially.
+            periodic (bool, default to True): Whether the box wraps around 
+                the periodic boundary of the simulation.
+
+        Returns:
+            dict: For each particle type, the "count" of particles and the 
+                "sum", "min" and "max" of each field.
+        """
+        with _stage("query"):
+            return self._reduce("box", partType, fields, workers, 
+                boundary=boundary, periodic=periodic)
+
+    def reduce_sphere(self, center, radius, partType, fields=None, 
+        workers=None, periodic=True):
+        """
+        Reduce particles in a sphere to their count, and the sum, minimum 
+        and maximum of fields. Most of the sphere is answered by the pyramid 
+        of per-cell aggregates in the index, and only particles in cells 
+        across the boundary of the sphere are read.
+
+        Args:
+            center (numpy.ndarray of scalar): Center of the sphere, with 
+                shape of (3,).
+            radius (scalar): Radius of the sphere.
+            partType (str or list of str): Particle types to be reduced.
+            fields (None or str or list of str, default to None): Fields to 
+                be reduced, which must be aggregated in the index, see 
+                load(). None to count particles only.
+            workers (None or int, default to None): Number of threads to 
+                reduce chunks concurrently. None or 1 to reduce serially.
+            periodic (bool, default to True): Whether the sphere wraps 
+                around the periodic boundary of the simulation.
+
+        Returns:
+            dict: For each particle type, the "count" of particles and the 
+                "sum", "min" and "max" of each field.
+        """
+        with _stage("query"):
+            return self._reduce("sphere", partType, fields, workers, 
+                center=np.asarray(center), radius=radius, periodic=periodic)
+
+    def box_many(self, boundaries, partType, fields, mdi=None, 
+        float32=False, workers=None, method="outer", periodic=True, 
+        unwrap=False, generator=False):
+        """
+        Load many sub-boxes of data, reading each chunk only once.
+
+        Args:
+            boundaries (list of numpy.ndarray of scalar): Boundaries of the 
+                boxes, each with shape of (3, 2).
+            partType (str or list of str): Particle types to be loaded.
+            fields (str or list of str): Particle fields to be loaded.
+            mdi (None or list of int, default to None): sub-indeces to be 
+                loaded. None to load all.
+            float32 (bool, default to False): Whether to use float32 or not.
+            workers (None or int, default to None): Number of threads to 
+                query chunks concurrently. None or 1 to query serially.
+            method (str, default to "outer"): How to load the boxes, must 
+                be "outer" (cells intersecting the box), "exact" or "inner" 
+                (cells inside the box).
+            periodic (bool, default to True): Whether the boxes wrap around 
+                the periodic boundary of the simulation.
+            unwrap (bool, default to False): Whether to unwrap Coordinates 
+                periodically to be closest to the center of each box.
+            generator (bool, default to False): Whether to return a 
+                generator yielding (i, sub-box) as soon as the i-th sub-box 
+                is read, instead of a list of all sub-boxes.
+
+        Returns:
+            list of dict or generator: Sub-boxes of data.
+        """
+        results = self._combine_many("box", partType, fields, 
+            [{"boundary": b} for b in boundaries], mdi, float32, workers, 
+            unwrap, method=method, periodic=periodic)
+        return results if generator else _collect(results, len(boundaries))
+
+    def sphere_many(self, centers, radii, partType, fields, mdi=None, 
+        float32=False, workers=None, method="outer", periodic=True, 
+        unwrap=False, generator=False):
+        """
+        Load many sub-spheres of data, reading each chunk only once.
+
+        Args:
+            centers (numpy.ndarray of scalar): Centers of the spheres, with 
+                shape of (n, 3).
+            radii (scalar or numpy.ndarray of scalar): Radii of the spheres, 
+                with shape of (n,).
+            partType (str or list of str): Particle types to be loaded.
+            fields (str or list of str): Particle fields to be loaded.
+            mdi (None or list of int, default to None): sub-indeces to be 
+                loaded. None to load all.
+            float32 (bool, default to False): Whether to use float32 or not.
+            workers (None or int, default to None): Number of threads to 
+                query chunks concurrently. None or 1 to query serially.
+            method (str, default to "outer"): How to load the spheres, must 
+                be "outer" (cells intersecting the sphere), "exact" or 
+                "inner" (cells inside the sphere).
+            periodic (bool, default to True): Whether the spheres wrap 
+                around the periodic boundary of the simulation.
+            unwrap (bool, default to False): Whether to unwrap Coordinates 
+                periodically to be closest to the center of each sphere.
+            generator (bool, default to False): Whether to return a 
+                generator yielding (i, sub-sphere) as soon as the i-th 
+                sub-sphere is read, instead of a list of all sub-spheres.
+
+        Returns:
+            list of dict or generator: Sub-spheres of data.
+        """
+        radii = np.broadcast_to(radii, (len(centers),))
+        results = self._combine_many("sphere", partType, fields, 
+            [{"center": np.asarray(c), "radius": r} 
+            for c, r in zip(centers, radii)], mdi, float32, workers, 
+            unwrap, method=method, periodic=periodic)
+        return results if generator else _collect(results, len(centers))
         
 class SingleDataset(object):
     """SingleDataset class stores a chunck of snapshot."""
 
-    def __init__(self, fn, partType, depth=8, index_path=None):
+    def __init__(self, fn, partType, depth=8, index_path=None, curve="row", 
+        aggregate=None, store=None, threshold=None):
         """
         Args:
             fn (str): File name to be loaded.
@@ -149,6 +1031,25 @@ class SingleDataset(object):
                 corresponds to the Mesh dimension of (2^8, 2^8, 2^8).
             index_path (str): Path to store the index files. None to store 
                 with the data.
+            curve (str, default to "row"): Ordering of Mesh cells, must be 
+                "row" (row-major) or "morton" (Z-order).
+            aggregate (None or list of str, default to None): Scalar fields 
+                whose per-cell aggregates (sum, minimum and maximum) are 
+                stored in the index at every level of Mesh. None to store 
+                only the count of particles in cells.
+            store (None, True or list of str, default to None): Fields to be 
+                copied to a store sorted by cell key next to the index file, 
+                from which selected particles are read as a few sequential 
+                slices, in the order of cells. True to copy all fields, None 
+                to read from fn. The store also has the field "row", the 
+                rows of particles in fn, and always has Coordinates, which 
+                are needed to select the exact subset. Only stored fields 
+                can be loaded.
+            threshold (None or int, default to None): Maximum number of 
+                particles in a cell of an adaptive index, where cells are 
+                subdivided like an octree only if they have more particles, 
+                down to depth. curve must be "morton". None to use the 
+                uniform Mesh at depth.
         """
 
         super(SingleDataset, self).__init__()
@@ -160,19 +1061,35 @@ class SingleDataset(object):
             partType = [partType]
         self._partType = partType
 
+        if threshold is not None:
+            if curve != "morton":
+                raise ValueError("curve must be \"morton\" for an adaptive " 
+                    "index!")
+            if aggregate:
+                raise ValueError("aggregate must be None for an adaptive " 
+                    "index!")
+
         self._depth = depth
+        self._curve = curve
+        self._aggregate = aggregate
+        self._threshold = threshold
 
         self._index_path = index_path
-        suffix = ".idx_d%02d.h5"%depth
-        if index_path:
-            self._index_fn = index_path + fn[fn.rfind("/"):] + suffix
-        else:
-            self._index_fn = fn + suffix
-
-        self._index = None
-        with h5py.File(fn, 'r') as f:
-            self._box_size = f['Header'].attrs['BoxSize']
-            self._boundary = np.array([[0., 0., 0.],
+        base = index_path + fn[fn.rfind("/"):] if index_path else fn
+        self._index_fn = base + _index_suffix(depth, curve, 
+            threshold=threshold)
+        # Coordinates are read from the store to refine exact subsets
+        if store and store is not True and "Coordinates" not in store:
+            store = list(store) + ["Coordinates"]
+        self._store = store
+        # Particles are sorted in the same order by an adaptive index, so 
+        # the store is shared with the uniform one
+        self._store_fn = base + _index_suffix(depth, curve, "store")
+
+        self._built = False
+        self._stored = False
+        self._box_size = _fileMeta(fn)["BoxSize"]
+        self._boundary = np.array([[0., 0., 0.],
                 [self._box_size, self._box_size, self._box_size]])
 
         # Set the int type for Mesh
@@ -190,6 +1107,20 @@ class SingleDataset(object):
         """str: File name to be loaded."""
         return self._fn
 
+    @property
+    def data_fn(self):
+        """str: File name to read selected particles from, i.e., the store 
+            sorted by cell key if used, otherwise fn."""
+        if not self._store:
+            return self._fn
+
+        # Create the store if necessary
+        if not self._stored:
+            self.build_index()
+            self._stored = True
+
+        return self._store_fn
+
     @property
     def partType(self):
         """str or list of str: Particle types to be loaded."""
@@ -202,58 +1133,86 @@ class SingleDataset(object):
 
     @property
     def index(self):
-        """dict: Newly generated or cached index of the Dataset. """
-
-        if self._index:
-            return self._index
+        """dict: Newly generated or cached index of the Dataset. Loaded 
+            index is kept in index_cache, which evicts the least recently 
+            used index beyond its memory budget."""
 
-        # Generate index
-        self._index = {}
+        # Create index file if necessary
+        if not self._built:
+            self.build_index()
+            self._built = True
 
-        # Find index file, otherwise create
-        with h5py.File(self._index_fn,'a') as f:
+        index = {}
+        with _stage("index", self._index_fn):
             for p in self._partType:
-                ptNum = partTypeNum(p)
-                gName = "PartType%d"%(ptNum)
-                self._index[gName] = {}
+                gName = "PartType%d"%(partTypeNum(p))
+                index[gName] = index_cache.get((self._index_fn, gName), 
+                    lambda: self._load_index(gName))
 
-                # Load index if exists in index file 
-                if "/"+gName in f.keys():
-                    self._index[gName]["count"] = f[gName].attrs["count"]
+        return index
 
-                    self._index[gName]["index"] = f[gName]["index"][:]
-                    self._index[gName]["mark"] = f[gName]["mark"][:]
-                    
-                # Compute and save index if does not exist in index file
-                else:
-                    data = loadFile(self._fn, self._partType, "Coordinates")
-                    grp = f.create_group(gName)
+    def _load_index(self, gName):
+        """
+        Load the index of one particle type from the index file. Arrays 
+        are memory-mapped, so that a query only reads the pages it touches.
+        """
+        mapped = np.memmap(self._index_fn, mode="r")
+        with h5py.File(self._index_fn, "r") as f:
+            result = {"count": f[gName].attrs["count"]}
+            for name in ["index", "key", "mark", "level"]:
+                if name in f[gName]:
+                    result[name] = _memmap(mapped, f[gName][name])
+            if "aggregate" in f[gName]:
+                grp = f[gName]["aggregate"]
+                result["aggregate"] = {
+                    "fields": [str(x) for x in grp.attrs["fields"]], 
+                    "levels": [{name: _memmap(mapped, ds) 
+                    for name, ds in grp["level_%02d"%l].items()} 
+                    for l in range(self._depth + 1)]}
+            return result
+
+    def build_index(self, block_size=None):
+        """
+        Build the index file (and the store if used) of this chunk if it 
+        does not exist or misses some particle types. The index is not 
+        loaded into memory.
 
-                    length = data[p]["count"]
-                    self._index[gName]["count"] = length
-                    grp.attrs["count"] =  length
+        Args:
+            block_size (None or int, default to None): Particle types with 
+                more particles are indexed block by block with bounded 
+                memory. None to use 2^24.
+        """
+        _build_index(self._fn, self._partType, self._boundary, self._depth, 
+            self._curve, self._index_fn, block_size, self._aggregate, 
+            self._store, self._store_fn, self._threshold)
+        for p in self._partType:
+            index_cache.pop((self._index_fn, "PartType%d"%(partTypeNum(p))))
+        meta_cache.pop(("file", self._store_fn))
+
+    def _cell_range(self, boundary, method="outer"):
+        """
+        Lower (inclusive) and upper (exclusive) Mesh cells of a box.
+        """
+
+        boundary_normalized = (
+            2**self._depth * (boundary - self._boundary[0]) / 
+            (self._boundary[1] - self._boundary[0]))
 
-                    pos = data[p]["Coordinates"] if length else np.array([])
-                    
-                    m = Mesh(pos, length, 0, self._boundary, self._depth)
+        if method in ["outer", "exact"]:
+            lower = np.floor(boundary_normalized[0]).astype(self._int_tree)
+            upper = np.ceil(boundary_normalized[1]).astype(self._int_tree)
 
-                    (self._index[gName]["index"], 
-                        self._index[gName]["mark"]) = m.build()
-                    grp.create_dataset("index", 
-                        data=self._index[gName]["index"], dtype=np.int64)
-                    grp.create_dataset("mark", 
-                        data=self._index[gName]["mark"], dtype=np.int64)
+        if method == "inner":
+            lower = np.ceil(boundary_normalized[0]).astype(self._int_tree)
+            upper = np.floor(boundary_normalized[1]).astype(self._int_tree)
 
-        return self._index
+        return lower, upper
 
     def box(self, boundary, partType, fields, mdi=None, float32=True, 
-        method="outer"):
+        method="outer", periodic=True, unwrap=False):
         """
         Slicing method to load a sub-box of data.
 
-        Note: The current version only support loading the outer or inner 
-            box of the sub-box. Loading the exact sub-box is not supported.
-
         Args:
             boundary (numpy.ndarray of scalar): Boundary of the box, with 
                 shape of (3, 2).
@@ -263,7 +1222,12 @@ class SingleDataset(object):
                 loaded. None to load all.
             float32 (bool, default to False): Whether to use float32 or not.
             method (str, default to "outer"): How to load the box, must be 
-                "outer" or "exact" or "inner".
+                "outer" (cells intersecting the box), "exact" or "inner" 
+                (cells inside the box).
+            periodic (bool, default to True): Whether the box wraps around 
+                the periodic boundary of the simulation.
+            unwrap (bool, default to False): Whether to unwrap Coordinates 
+                periodically to be closest to the center of the box.
 
         Returns:
             dict: Sub-box of data.
@@ -277,45 +1241,165 @@ class SingleDataset(object):
         if isinstance(partType, str):
             partType = [partType]
 
-        self.index # pre-indexing
+        _check_store(self, fields)
+        with _stage("query", self._fn):
+            targets = self._select("box", partType, boundary=boundary, 
+                method=method, periodic=periodic)
 
-        boundary_normalized = (
-            2**self._depth * (boundary - self._boundary[0]) / 
-            (self._boundary[1] - self._boundary[0]))
+            result = loadFile(self.data_fn, partType, fields, mdi, float32, 
+                targets)
+            if unwrap:
+                _unwrap(result, partType, fields, mdi, self._box_size, 
+                    _center("box", boundary=boundary))
 
-        if method in ["outer", "exact"]:
-            lower = np.floor(boundary_normalized[0]).astype(self._int_tree)
-            upper = np.ceil(boundary_normalized[1]).astype(self._int_tree)
+        return result
 
-        if method == "inner":
-            lower = np.ceil(boundary_normalized[0]).astype(self._int_tree)
-            upper = np.floor(boundary_normalized[1]).astype(self._int_tree)
+    def _select(self, func, partType, refine=True, **kwargs):
+        """
+        Slice the index to select particles of a subset (e.g., a box or 
+        sphere).
 
-        targets = []
-        tt0 = 0
-        # Use for loop here assuming the box is small
-        for p in partType:
-            ptNum = partTypeNum(p)
-            gName = "PartType%d"%(ptNum)
+        Args:
+            func (str): Types of subset, must be "box" or "sphere".
+            partType (list of str): Particle types to be selected.
+            refine (bool, default to True): Whether to refine particles on 
+                the boundary for the exact subset. Otherwise, particles on 
+                the boundary are returned along with the selection, to be 
+                refined by the caller.
+            **kwargs: arguments to be sent to slicing function.
+
+        Returns:
+            list of Selection: Selected particles for each particle type, 
+                or list of tuple of the Selection of particles selected 
+                entirely and on the boundary (None unless method is 
+                "exact") without refine.
+        """
+
+        idx = self.index # pre-indexing
+        with _stage("slicing", self._index_fn):
+            if self._threshold is None:
+                select, edge = self._intervals(func, **kwargs)
 
-            t0 = time.time()
-            target = _slicing(lower, upper, self._index[gName]["mark"], 
-                self._index[gName]["index"], self._depth, self._int_tree)
-            tt0 += time.time() - t0
+            selections = []
+            # Use for loop here assuming the box is small
+            for p in partType:
+                ptNum = partTypeNum(p)
+                gName = "PartType%d"%(ptNum)
+                key = idx[gName]["key"]
+                mark = idx[gName]["mark"]
+                index = None if self._store else idx[gName]["index"]
+                if self._threshold is None:
+                    ranges = [_slicing(intervals, key, mark) 
+                        if intervals is not None else None 
+                        for intervals in [select, edge]]
+                else:
+                    ranges = self._traverse(func, idx[gName], **kwargs)
+                selections.append(tuple(Selection(r, index) 
+                    if r is not None else None for r in ranges))
+
+        if not refine:
+            return selections
 
+        targets = []
+        for p, (target, boundary) in zip(partType, selections):
+            if boundary is not None:
+                target = _refine(self.data_fn, p, boundary, target, func, 
+                    self._box_size, **kwargs)
+            _count("particles", len(target), self._fn)
             targets.append(target)
 
-        print("time: %.3fs"%tt0)
-        return loadFile(self._fn, partType, fields, mdi, float32, targets)
+        return targets
+
+    def _intervals(self, func, **kwargs):
+        """
+        Intervals of cell keys to select a subset (e.g., a box or sphere). 
+        Returns intervals of cells to be selected entirely, and intervals 
+        of cells on the boundary to be refined for the exact subset (None 
+        unless method is "exact").
+        """
+
+        method = kwargs.get("method", "outer")
+        periodic = kwargs.get("periodic", True)
+        if func == "box":
+            lower, upper = self._cell_range(kwargs["boundary"], method)
+            outer = _key_intervals(lower, upper, self._depth, self._curve, 
+                periodic)
+            lower, upper = self._cell_range(kwargs["boundary"], "inner")
+            inner = _key_intervals(lower, upper, self._depth, self._curve, 
+                periodic)
+        else:
+            scale = 2**self._depth / (self._boundary[1] - self._boundary[0])
+            center = scale * (np.asarray(kwargs["center"], dtype=np.float64) 
+                - self._boundary[0])
+            radius = float(scale[0] * kwargs["radius"])
+            if self._curve == "row":
+                outer, inner = [_column_intervals(c, self._depth) for c in 
+                    _sphere_columns(center, radius, self._depth, periodic)]
+            else:
+                outer, inner = _sphere_intervals(center, radius, 
+                    self._depth, periodic)
+            if method == "inner":
+                outer = inner
+
+        # Only particles in cells on the boundary are checked for the exact 
+        # subset, while those in cells inside are accepted directly
+        if method == "exact":
+            return inner, _subtract_intervals(outer, inner)
+        return outer, None
+
+    def _traverse(self, func, g, **kwargs):
+        """
+        Traverse the octree of an adaptive index g from the root to select 
+        particles of a subset (e.g., a box or sphere). Leaves inside the 
+        subset are selected entirely, and only nodes across its boundary 
+        are subdivided. Returns ranges into the sorted index of leaves to 
+        be selected entirely, and of leaves across the boundary to be 
+        refined for the exact subset (None unless method is "exact").
+        """
 
+        method = kwargs.get("method", "outer")
+        key, level, mark = g["key"], g["level"], g["mark"]
+        inside, edge = [], []
+
+        # Nodes at level l are prefixes of keys, and their leaves are 
+        # key[lower:upper]
+        node = np.zeros(1, dtype=np.int64)
+        for l in range(self._depth + 1):
+            shift = 3*(self._depth - l)
+            lower = np.searchsorted(key, node << shift)
+            upper = np.searchsorted(key, (node + 1) << shift)
+            occupied = lower < upper
+            node, lower, upper = node[occupied], lower[occupied], upper[ 
+                occupied]
+
+            size = self._box_size / 2**l
+            within, outside = _classify(func, self._boundary[0] + 
+                size * _decode(node, l, "morton"), size, self._box_size, 
+                **kwargs)
+            across = ~(within | outside)
+            leaf = across & (upper - lower == 1) & (level[lower] == l)
+            inside.append(np.stack([mark[lower[within]], 
+                mark[upper[within]]], axis=1))
+            edge.append(np.stack([mark[lower[leaf]], mark[upper[leaf]]], 
+                axis=1))
+
+            node = ((node[across & ~leaf] << 3)[:,None] + 
+                np.arange(8)).reshape(-1)
+            if not len(node):
+                break
+
+        inside, edge = [_sort_ranges(r) for r in [inside, edge]]
+        if method == "exact":
+            return inside, edge
+        if method == "inner":
+            return inside, None
+        return _sort_ranges([inside, edge]), None
 
     def sphere(self, center, radius, partType, fields, mdi=None, 
-        method="outer"):
+        float32=True, method="outer", periodic=True, unwrap=False):
         """
         Slicing method to load a sub-sphere of data.
 
-        Note: This function is not supported in the current version
-
         Args:
             center (numpy.ndarray of scalar): Center of the sphere, with 
                 shape of (3,).
@@ -325,44 +1409,950 @@ class SingleDataset(object):
             mdi (None or list of int, default to None): sub-indeces to be 
                 loaded. None to load all.
             float32 (bool, default to False): Whether to use float32 or not.
-            method (str, default to "outer"): How to load the box, must be 
-                "outer" or "exact" or "inner".
+            method (str, default to "outer"): How to load the sphere, must 
+                be "outer" (cells intersecting the sphere), "exact" or 
+                "inner" (cells inside the sphere).
+            periodic (bool, default to True): Whether the sphere wraps 
+                around the periodic boundary of the simulation.
+            unwrap (bool, default to False): Whether to unwrap Coordinates 
+                periodically to be closest to the center of the sphere.
+
+        Returns:
+            dict: Sub-sphere of data.
+        """
+
+        # Make sure fields is not a single element
+        if isinstance(fields, str):
+            fields = [fields]
+
+        # Make sure partType is not a single element
+        if isinstance(partType, str):
+            partType = [partType]
+
+        _check_store(self, fields)
+        with _stage("query", self._fn):
+            targets = self._select("sphere", partType, center=center, 
+                radius=radius, method=method, periodic=periodic)
+
+            result = loadFile(self.data_fn, partType, fields, mdi, float32, 
+                targets)
+            if unwrap:
+                _unwrap(result, partType, fields, mdi, self._box_size, 
+                    center)
+
+        return result
+
+
+class Selection(object):
+    """
+    Selection class stores particles selected from a chunk, as ranges into 
+    the sorted index of Mesh. Indices of particles are only materialized 
+    when needed.
+    """
+
+    def __init__(self, ranges, index, extra=None):
+        """
+        Args:
+            ranges (numpy.ndarray of int): Ranges (start, end) into the 
+                sorted index, with shape of (n, 2).
+            index (None or numpy.ndarray of int): Sorted index of Mesh, 
+                i.e., the "rank" of Mesh.build(). None if ranges are rows 
+                themselves, e.g., in the store sorted by cell key.
+            extra (None or numpy.ndarray of int, default to None): Indices 
+                of additional selected particles, e.g., from refining the 
+                boundary of a subset.
+        """
+
+        super(Selection, self).__init__()
+        self._ranges = ranges
+        self._index = index
+        self._extra = (np.array([], dtype=np.int64) if extra is None else 
+            extra)
+        self._count = int(np.sum(ranges[:,1] - ranges[:,0])) + len(
+            self._extra)
+        self._materialized = None
+
+    @property
+    def ranges(self):
+        """numpy.ndarray of int: Ranges (start, end) into the sorted index, 
+            with shape of (n, 2)."""
+        return self._ranges
+
+    @property
+    def count(self):
+        """int: Number of selected particles."""
+        return self._count
+
+    @property
+    def index(self):
+        """numpy.ndarray of int: Sorted indices of selected particles in 
+            the chunk, materialized on first access."""
+        if self._materialized is None:
+            rows = (_expand(self._ranges) if self._index is None else 
+                _materialize(self._ranges, self._index))
+            self._materialized = np.sort(np.concatenate([rows, self._extra]))
+        return self._materialized
+
+    def slice(self, start, end):
+        """
+        Sorted indices of the start-th to end-th selected particles, in the 
+        order of ranges followed by the additional particles. Unlike index, 
+        only the particles in the slice are materialized, and nothing is 
+        kept.
+
+        Args:
+            start (int): First selected particle.
+            end (int): End of the selected particles (exclusive).
+
+        Returns:
+            numpy.ndarray of int: Sorted indices of particles in the slice.
         """
-        pass
 
+        length = self._ranges[:,1] - self._ranges[:,0]
+        offset = np.concatenate([[0], np.cumsum(length)]).astype(np.int64)
+        first = np.searchsorted(offset, start, side="right") - 1
+        last = min(np.searchsorted(offset, end, side="left"), 
+            len(self._ranges))
+
+        # Clip the ranges overlapping the slice
+        ranges = self._ranges[first:last].astype(np.int64)
+        ranges[:,0] += np.maximum(start - offset[first:last], 0)
+        ranges[:,1] -= np.maximum(offset[first+1:last+1] - end, 0)
+        rows = (_expand(ranges) if self._index is None else 
+            _materialize(ranges, self._index))
+        extra = self._extra[max(start - offset[-1], 0):max(end - offset[-1], 
+            0)]
+        return np.sort(np.concatenate([rows, extra]))
+
+    def __len__(self):
+        return self._count
+
+    def __array__(self, dtype=None, copy=None):
+        return self.index if dtype is None else self.index.astype(dtype)
+
+def _index_suffix(depth, curve, name="idx", threshold=None):
+    """
+    Suffix of index files, or other files named by name.
+    """
+    return ".%s_d%02d%s%s.h5"%(name, depth, "" if curve == "row" else 
+        "_"+curve, "" if threshold is None else "_t%d"%threshold)
+
+def _missing_store(store_fn, partType, fields):
+    """
+    Particle types whose fields are missing in the store. Particle types 
+    without particles in the chunk are never missing once stored, since 
+    they have no fields to copy.
+    """
+    if not fields:
+        return []
+    if not os.path.exists(store_fn):
+        return list(partType)
+
+    with h5py.File(store_fn, "r") as f:
+        return [p for p in partType if 
+            not _has(f, "PartType%d"%partTypeNum(p), "row") or (
+            fields is not True and len(f["PartType%d"%partTypeNum(p)]["row"]) 
+            and not set(fields) <= set(f["PartType%d"%partTypeNum(p)].keys()))]
+
+def _check_store(d, fields):
+    """
+    Make sure fields can be read from the store of chunk d, if used.
+    """
+    if not d._store or d._store is True:
+        return
+    for field in fields:
+        if field not in d._store and field != "row":
+            raise ValueError("%s must be in store!"%field)
+
+def _missing_index(index_fn, partType, name="extent"):
+    """
+    Particle types whose index is missing in the index file, i.e., whose 
+    group does not have the dataset or attribute name.
+    """
+    if not os.path.exists(index_fn):
+        return list(partType)
+
+    # Index of older versions is also missing
+    with h5py.File(index_fn, "r") as f:
+        return [p for p in partType if 
+            not _has(f, "PartType%d"%partTypeNum(p), name)]
+
+def _missing_aggregate(index_fn, partType, fields):
+    """
+    Particle types whose aggregates of fields are missing in the index 
+    file.
+    """
+    if not fields:
+        return []
+    if not os.path.exists(index_fn):
+        return list(partType)
+
+    with h5py.File(index_fn, "r") as f:
+        return [p for p in partType if 
+            not _has(f, "PartType%d"%partTypeNum(p), "aggregate") or 
+            not set(fields) <= set(f["PartType%d"%partTypeNum(p)][
+            "aggregate"].attrs["fields"])]
+
+def _has(f, gName, name):
+    """
+    Whether group gName of f has the dataset or attribute name.
+    """
+    return gName in f and (name in f[gName] or name in f[gName].attrs)
+
+def _build_index(fn, partType, boundary, depth, curve, index_fn, 
+    block_size=None, aggregate=None, store=None, store_fn=None, 
+    threshold=None):
+    """
+    Build the missing index of a chunk and save it to the index file.
+
+    The index file is never modified in place. A new file is written next 
+    to it and then atomically renamed, under an exclusive lock, so that 
+    processes building or reading the same index file do not interfere.
+
+    Particle types with more than block_size particles are indexed by 
+    _stream_index() with bounded memory. Aggregates of fields in aggregate 
+    are built by _build_aggregate() if missing, and so is the store of 
+    fields in store by _build_store(). With threshold, occupied cells are 
+    merged into the leaves of an octree by _adapt(), stored with their 
+    "level".
+    """
+    if block_size is None:
+        block_size = _BLOCK_SIZE
+
+    if store:
+        _build_index(fn, partType, boundary, depth, curve, index_fn, 
+            block_size, aggregate, threshold=threshold)
+        _build_store(fn, partType, index_fn, store_fn, store, block_size)
+        return
+
+    if not (_missing_index(index_fn, partType) or 
+        _missing_aggregate(index_fn, partType, aggregate)):
+        return
+
+    with _lock(index_fn):
+        # Another process may have built the index while waiting
+        todo = _missing_index(index_fn, partType)
+        todo_aggregate = _missing_aggregate(index_fn, partType, aggregate)
+        if not (todo or todo_aggregate):
+            return
+
+        with _replace(index_fn) as f:
+            for p in todo:
+                gName = "PartType%d"%(partTypeNum(p))
+                grp = f.create_group(gName)
+
+                length = _fileMeta(fn)["NumPart_ThisFile"][partTypeNum(p)]
+                grp.attrs["count"] = length
+
+                # Coordinates are read in blocks if streamed, even if they 
+                # are chunked (e.g., compressed)
+                if length > block_size:
+                    _stream_index(fn, p, length, boundary, depth, curve, grp, 
+                        block_size, index_fn)
+                else:
+                    pos = loadFile(fn, p, "Coordinates", 
+                        float32=False)[p]["Coordinates"]
+                    m = Mesh(pos, length, 0, boundary, depth, curve)
+                    grp.attrs["extent"] = m.extent()
+                    rank, key, mark = m.build()
+                    grp.create_dataset("index", data=rank, dtype=np.int64)
+                    grp.create_dataset("key", data=key, dtype=np.int64)
+                    grp.create_dataset("mark", data=mark, dtype=np.int64)
+
+                if threshold is not None:
+                    key, level, mark = _adapt(grp["key"][:], grp["mark"][:], 
+                        depth, threshold)
+                    for name, value in [("key", key), ("level", level), 
+                        ("mark", mark)]:
+                        if name in grp:
+                            del grp[name]
+                        grp.create_dataset(name, data=value, dtype=np.int64)
+
+            for p in todo_aggregate:
+                gName = "PartType%d"%(partTypeNum(p))
+                if gName not in f:
+                    with h5py.File(index_fn, "r") as f_old:
+                        f_old.copy(f_old[gName], f)
+                _build_aggregate(fn, p, f[gName], depth, curve, aggregate, 
+                    block_size)
+
+def _build_store(fn, partType, index_fn, store_fn, fields, block_size):
+    """
+    Copy fields of a chunk to the store, where particles are sorted by cell 
+    key as in the index, and save the rows of particles in fn as the field 
+    "row". Fields are copied in blocks of block_size particles. Like the 
+    index file, the store is replaced atomically under a lock.
+    """
+    if not _missing_store(store_fn, partType, fields):
+        return
+
+    with _lock(store_fn):
+        todo = _missing_store(store_fn, partType, fields)
+        if not todo:
+            return
+
+        f_data = h5py.File(fn, "r")
+        f_index = h5py.File(index_fn, "r")
+        with f_data, f_index, _replace(store_fn) as f:
+            f_data.copy(f_data["Header"], f)
+            for p in todo:
+                gName = "PartType%d"%(partTypeNum(p))
+                grp = f.create_group(gName)
+                index = f_index[gName]["index"]
+                grp.create_dataset("row", shape=index.shape, dtype=np.int64)
+
+                names = []
+                if gName in f_data:
+                    names = (list(f_data[gName].keys()) if fields is True 
+                        else list(fields))
+                for name in names:
+                    grp.create_dataset(name, shape=f_data[gName][name].shape, 
+                        dtype=f_data[gName][name].dtype)
+
+                for start in range(0, len(index), block_size):
+                    rows = index[start:start+block_size]
+                    end = start + len(rows)
+                    grp["row"][start:end] = rows
+                    if not names:
+                        continue
+                    data = loadFile(fn, p, names, float32=False, 
+                        index=[rows])[p]
+                    for name in names:
+                        grp[name][start:end] = data[name]
+
+def _build_aggregate(fn, partType, grp, depth, curve, fields, block_size):
+    """
+    Build the pyramid of per-cell aggregates of one particle type from its 
+    index in the HDF5 group grp, and save it to grp["aggregate"]. At every 
+    level from depth down to 0, occupied cells store their keys, the count 
+    of particles, and the sum, minimum and maximum of each field. Fields 
+    are read cell by cell in blocks of about block_size particles.
+    """
+    if "aggregate" in grp:
+        fields = list(grp["aggregate"].attrs["fields"]) + [
+            field for field in fields 
+            if field not in grp["aggregate"].attrs["fields"]]
+        del grp["aggregate"]
+
+    key = grp["key"][:]
+    mark = grp["mark"][:]
+    level = {"key": key, "count": np.diff(mark)}
+    blocks = [0]
+    if len(key):
+        meta = _fieldMeta(fn, partType, fields, float32=False)
+        blocks = np.unique(np.append(np.searchsorted(mark, 
+            np.arange(0, mark[-1], block_size), side="right") - 1, len(key)))
+    for field in fields:
+        if len(key) and len(meta[field]["shape"]):
+            raise ValueError("Only scalar fields can be aggregated!")
+        for name in _UFUNC:
+            level["%s_%s"%(name, field)] = np.zeros(len(key))
+
+    for c0, c1 in zip(blocks[:-1], blocks[1:]):
+        data = loadFile(fn, partType, fields, float32=False, 
+            index=[grp["index"][mark[c0]:mark[c1]]])[partType]
+        offsets = mark[c0:c1] - mark[c0]
+        for field in fields:
+            for name, ufunc in _UFUNC.items():
+                level["%s_%s"%(name, field)][c0:c1] = ufunc.reduceat(
+                    data[field], offsets)
+
+    agg = grp.create_group("aggregate")
+    agg.attrs["fields"] = fields
+    for l in range(depth, -1, -1):
+        sub = agg.create_group("level_%02d"%l)
+        for name, value in level.items():
+            sub.create_dataset(name, data=value)
+        if l:
+            level = _coarsen(level, l, curve)
+
+def _coarsen(level, l, curve):
+    """
+    Aggregates of parent cells at level l - 1 from aggregates of cells at 
+    level l.
+    """
+    parent = _encode(_decode(level["key"], l, curve) >> 1, l-1, curve)
+    order = np.argsort(parent, kind="stable")
+    parent = parent[order]
+    starts = np.flatnonzero(np.diff(parent, prepend=-1))
+
+    coarse = {"key": parent[starts]}
+    for name, value in level.items():
+        if name == "key":
+            continue
+        ufunc = np.add if name == "count" else _UFUNC[name.split("_")[0]]
+        coarse[name] = ufunc.reduceat(value[order], starts) if len(
+            starts) else value[:0]
+    return coarse
+
+def _stream_index(fn, partType, length, boundary, depth, curve, grp, 
+    block_size, index_fn):
+    """
+    Build the index of one particle type in fn by counting sort over blocks 
+    of positions, and save it to the HDF5 group grp. 
+
+    The first pass counts particles in each occupied cell, which gives 
+    "key" and "mark". The second pass scatters the index of each particle 
+    to its place in a temporary memory-mapped file, which is then copied to 
+    grp block by block. Apart from "key" and "mark", the memory usage is 
+    bounded by block_size. The result is identical to Mesh.build().
+    """
+    blocks = [(start, min(start+block_size, length)) 
+        for start in range(0, length, block_size)]
+
+    def mesh(start, end):
+        pos = loadFile(fn, partType, "Coordinates", float32=False, 
+            index=[np.arange(start, end)])[partType]["Coordinates"]
+        return Mesh(pos, end-start, start, boundary, depth, curve)
+
+    # Count particles in each occupied cell
+    key = np.array([], dtype=np.int64)
+    count = np.array([], dtype=np.int64)
+    extent = []
+    for start, end in blocks:
+        m = mesh(start, end)
+        extent.append(m.extent())
+        key, inv = np.unique(np.concatenate(
+            [key, m.keys()]), return_inverse=True)
+        count = np.bincount(inv, minlength=len(key), weights=np.concatenate(
+            [count, np.ones(end-start, dtype=np.int64)])).astype(np.int64)
+    extent = np.array(extent)
+    mark = np.concatenate([[0], np.cumsum(count)]).astype(np.int64)
+    grp.attrs["extent"] = np.array(
+        [extent[:,0].min(axis=0), extent[:,1].max(axis=0)])
+
+    # Scatter the index of particles, keeping their order in each cell
+    rank_fn = "%s.rank.tmp%d"%(index_fn, os.getpid())
+    try:
+        rank = np.memmap(rank_fn, mode="w+", dtype=np.int64, shape=(length,))
+        filled = np.zeros(len(key), dtype=np.int64)
+        for start, end in blocks:
+            cell = np.searchsorted(key, mesh(start, end).keys())
+            order = np.argsort(cell, kind="stable")
+            cell = cell[order]
+            within = np.arange(end-start) - np.searchsorted(cell, cell)
+            rank[mark[cell] + filled[cell] + within] = start + order
+            u, c = np.unique(cell, return_counts=True)
+            filled[u] += c
+        rank.flush()
+
+        ds = grp.create_dataset("index", shape=(length,), dtype=np.int64)
+        for start, end in blocks:
+            ds[start:end] = rank[start:end]
+        del rank
+    finally:
+        os.remove(rank_fn)
+
+    grp.create_dataset("key", data=key, dtype=np.int64)
+    grp.create_dataset("mark", data=mark, dtype=np.int64)
+
+def _meta(datasets, partType, fields, mdi=None, float32=True):
+    """
+    Dtype and shape of fields from the first chunk that has particles of 
+    partType. None if no chunk has any.
+    """
+    ptNum = partTypeNum(partType)
+    for d in datasets:
+        if _fileMeta(d.fn)["NumPart_ThisFile"][ptNum]:
+            return _fieldMeta(d.data_fn, partType, fields, mdi, float32)
+    return None
+
+def _assemble(pieces, partType, fields, meta):
+    """
+    Concatenate pieces of a subset read from different chunks.
+    """
+    result = {}
+    for j, p in enumerate(partType):
+        result[p] = {}
+        for field in fields:
+            arrays = [piece[p][field] for piece in pieces if p in piece]
+            if meta[j] is None:
+                result[p][field] = np.array([])
+            elif len(arrays) == 1:
+                result[p][field] = arrays[0]
+            else:
+                result[p][field] = np.concatenate([np.empty((0,) + 
+                    meta[j][field]["shape"], dtype=meta[j][field]["dtype"])] 
+                    + arrays)
+        result[p]["count"] = sum(len(piece[p][fields[0]]) 
+            for piece in pieces if p in piece)
+    return result
+
+def _deposit(d, index, key, start, end, partType, field, boundary, bins, 
+    periodic=True):
+    """
+    Deposit particles in cells (key, start, end) of a chunk onto the grid 
+    of Dataset.deposit().
+    """
+    cell_size = d.box_size / 2**d._depth
+    width = boundary[1] - boundary[0]
+    bin_size = width / bins
+    grid = np.zeros(bins)
+
+    # Lower corners of cells relative to the box
+    lower = (d._boundary[0] + cell_size * _decode(key, d._depth, d._curve) - 
+        boundary[0])
+    if periodic:
+        lower %= d.box_size
+    first = np.floor(lower / bin_size).astype(np.int64)
+    last = np.ceil((lower + cell_size) / bin_size).astype(np.int64) - 1
+    interior = np.all((lower >= 0) & (lower + cell_size <= width) & 
+        (first == last), axis=1)
+    ranges = np.stack([start, end], axis=1)
+
+    # Cells inside one bin are summed cell by cell
+    if np.any(interior):
+        count = end[interior] - start[interior]
+        aggregate = d.index["PartType%d"%(partTypeNum(partType))].get(
+            "aggregate")
+        if field is None:
+            total = count
+        elif aggregate and field in aggregate["fields"]:
+            level = aggregate["levels"][d._depth]
+            total = level["sum_" + field][np.searchsorted(level["key"], 
+                key[interior])]
+        else:
+            rows = _materialize(ranges[interior], index)
+            values = loadFile(d.fn, partType, field, float32=False, 
+                index=[rows])[partType][field]
+            total = np.add.reduceat(values, np.cumsum(count) - count)
+        np.add.at(grid, tuple(first[interior].T), total)
+
+    # Particles in cells across the edges of bins are binned one by one
+    rows = np.sort(_materialize(ranges[~interior], index))
+    if len(rows):
+        fields = ["Coordinates"] + ([field] if field else [])
+        data = loadFile(d.fn, partType, fields, float32=False, 
+            index=[rows])[partType]
+        pos = data["Coordinates"] - boundary[0]
+        if periodic:
+            pos %= d.box_size
+        inside = np.all((pos >= 0) & (pos < width), axis=1)
+        np.add.at(grid, tuple(np.minimum((pos[inside] / bin_size).astype(
+            np.int64), np.array(bins) - 1).T), 
+            data[field][inside] if field else 1)
+
+    return grid
+
+def _reduce(d, index, key, start, end, partType, fields, func, **kwargs):
+    """
+    Reduce particles of a subset in cells (key, start, end) of a chunk, 
+    where particles of each cell are index[start:end]. Cells are visited 
+    from the root of the pyramid of per-cell aggregates if the index has 
+    one, otherwise only cells at the finest level are used.
+    """
+    aggregate = d.index["PartType%d"%(partTypeNum(partType))].get(
+        "aggregate")
+    for field in fields:
+        if not aggregate or field not in aggregate["fields"]:
+            raise ValueError("%s must be aggregated in the index!"%field)
+
+    result = {"count": 0}
+    for field in fields:
+        result[field] = dict(_IDENTITY)
+
+    def classify(edge, l):
+        size = d.box_size / 2**l
+        lower = d._boundary[0] + size * _decode(edge, l, d._curve)
+        return _classify(func, lower, size, d.box_size, **kwargs)
+
+    if aggregate:
+        # Descend from the root to the finest cells across the boundary
+        edge = aggregate["levels"][0]["key"]
+        for l, level in enumerate(aggregate["levels"]):
+            if l:
+                edge = _present(np.unique(_encode(((_decode(edge, l-1, 
+                    d._curve) << 1)[:,None] + _CORNERS).reshape(-1, 3), l, 
+                    d._curve)), level["key"])
+            inside, outside = classify(edge, l)
+            pos = np.searchsorted(level["key"], edge[inside])
+            result["count"] += np.sum(level["count"][pos])
+            for field in fields:
+                for name, ufunc in _UFUNC.items():
+                    result[field][name] = ufunc.reduce(
+                        level["%s_%s"%(name, field)][pos], 
+                        initial=result[field][name])
+            edge = edge[~(inside | outside)]
+    else:
+        inside, outside = classify(key, d._depth)
+        result["count"] += np.sum((end - start)[inside])
+        edge = key[~(inside | outside)]
+
+    # Particles in cells across the boundary are read one by one
+    pos = np.searchsorted(key, _present(edge, key))
+    rows = np.sort(_materialize(np.stack([start[pos], end[pos]], axis=1), 
+        index))
+    if len(rows):
+        data = loadFile(d.fn, partType, ["Coordinates"] + fields, 
+            float32=False, index=[rows])[partType]
+        inside = _contains(func, data["Coordinates"], d.box_size, **kwargs)
+        result["count"] += np.sum(inside)
+        for field in fields:
+            for name, ufunc in _UFUNC.items():
+                result[field][name] = ufunc.reduce(data[field][inside], 
+                    initial=result[field][name])
+
+    return result
+
+def _present(key, occupied):
+    """
+    Keys that are in the sorted keys of occupied cells.
+    """
+    pos = np.minimum(np.searchsorted(occupied, key), len(occupied) - 1)
+    return key[occupied[pos] == key] if len(occupied) else key[:0]
+
+def _classify(func, lower, size, box_size, **kwargs):
+    """
+    Whether cells with lower corners and size are entirely inside or 
+    outside a subset (e.g., a box or sphere), consistent with _contains().
+    """
+    periodic = kwargs.get("periodic", True)
+    if func == "box":
+        boundary = np.asarray(kwargs["boundary"])
+        width = boundary[1] - boundary[0]
+        lower = lower - boundary[0]
+        if periodic:
+            lower %= box_size
+            return (np.all(lower + size <= width, axis=1), 
+                np.any((lower >= width) & (lower + size <= box_size), 
+                axis=1))
+        return (np.all((lower >= 0) & (lower + size <= width), axis=1), 
+            np.any((lower + size <= 0) | (lower >= width), axis=1))
+
+    dist = lower + size/2 - kwargs["center"]
+    if periodic:
+        dist -= box_size * np.round(dist / box_size)
+    near = np.maximum(np.abs(dist) - size/2, 0)
+    far = np.abs(dist) + size/2
+    return (np.sum(far**2, axis=1) <= kwargs["radius"]**2, 
+        np.sum(near**2, axis=1) > kwargs["radius"]**2)
+
+def _collect(results, n):
+    """
+    Collect (i, subset) yielded by Dataset._combine_many() into a list.
+    """
+    collected = [None] * n
+    for i, result in results:
+        collected[i] = result
+    return collected
+
+def _build_summary(datasets, gName, grp):
+    """
+    Build the snapshot index of one particle type from the index files of 
+    all chunks, and save it to the HDF5 group grp. The index of chunks is 
+    copied one chunk at a time. Adaptive indices are only summarized by 
+    counts and the extents of their leaves.
+    """
+    adaptive = datasets[0]._threshold is not None
+    count = np.zeros(len(datasets), dtype=np.int64)
+    extent = np.zeros((len(datasets), 2, 3), dtype=np.int64)
+    key, chunk, start, end = [], [], [], []
+    for c, d in enumerate(datasets):
+        with h5py.File(d._index_fn, "r") as f:
+            count[c] = f[gName].attrs["count"]
+            extent[c] = f[gName].attrs["extent"]
+            if adaptive:
+                # Leaves may extend beyond the cells of particles
+                if count[c]:
+                    lower = _decode(f[gName]["key"][:], d._depth, "morton")
+                    upper = lower + (1 << (d._depth - 
+                        f[gName]["level"][:]))[:,None]
+                    extent[c] = [lower.min(axis=0), upper.max(axis=0)]
+                continue
+            mark = f[gName]["mark"][:]
+            key.append(f[gName]["key"][:])
+        chunk.append(np.full(len(mark)-1, c, dtype=np.int64))
+        start.append(mark[:-1])
+        end.append(mark[1:])
+
+    offset = np.concatenate([[0], np.cumsum(count)]).astype(np.int64)
+    grp.create_dataset("count", data=count)
+    grp.create_dataset("extent", data=extent)
+    if adaptive:
+        return
+    grp.create_dataset("offset", data=offset)
+
+    ds = grp.create_dataset("index", shape=(offset[-1],), dtype=np.int64)
+    for c, d in enumerate(datasets):
+        if count[c]:
+            with h5py.File(d._index_fn, "r") as f:
+                ds[offset[c]:offset[c+1]] = f[gName]["index"][:]
+
+    # Runs are sorted by key, and by chunk within the same key
+    key = np.concatenate(key).astype(np.int64)
+    order = np.argsort(key, kind="stable")
+    grp.create_dataset("key", data=key[order])
+    for name, value in [("chunk", chunk), ("start", start), ("end", end)]:
+        grp.create_dataset(name, data=np.concatenate(value)[order])
+
+def _split_runs(runs, n_chunk):
+    """
+    Split runs (chunk, start, end) by chunk. Returns a dict mapping each 
+    chunk to its ranges (start, end), with shape of (n, 2).
+    """
+    runs = runs[np.argsort(runs[:,0], kind="stable")]
+    chunks = np.unique(runs[:,0])
+    bounds = np.searchsorted(runs[:,0], np.append(chunks, n_chunk))
+    return {c: _merge_ranges(runs[bounds[n]:bounds[n+1],1:]) 
+        for n, c in enumerate(chunks)}
+
+def _sort_ranges(ranges):
+    """
+    Concatenate a list of ranges (start, end) into sorted and merged 
+    ranges, with shape of (n, 2).
+    """
+    ranges = np.concatenate([np.empty((0, 2), dtype=np.int64)] + 
+        [np.asarray(r, dtype=np.int64) for r in ranges])
+    return _merge_ranges(ranges[np.argsort(ranges[:,0], kind="stable")])
+
+def _refine(fn, partType, edge, target, func, box_size, **kwargs):
+    """
+    Refine the selection target of a chunk with particles in edge, i.e., in 
+    cells on the boundary, that are inside the exact subset (e.g., a box or 
+    sphere).
+    """
+    with _stage("refine", fn):
+        extra = edge.index
+        if len(extra):
+            pos = loadFile(fn, partType, "Coordinates", float32=False, 
+                index=[extra])[partType]["Coordinates"]
+            extra = extra[_contains(func, pos, box_size, **kwargs)]
+    return Selection(target.ranges, target._index, extra)
+
+def _memmap(mapped, ds):
+    """
+    View the HDF5 dataset ds in mapped, the memory-mapped bytes of its 
+    file, so that all datasets of a file share one map and one file 
+    descriptor. Datasets that are not stored contiguously (e.g. chunked or 
+    empty) are read into memory.
+    """
+    offset = ds.id.get_offset()
+    if offset is None:
+        return ds[:]
+    size = int(np.prod(ds.shape)) * ds.dtype.itemsize
+    return mapped[offset:offset+size].view(ds.dtype).reshape(ds.shape)
+
+@contextlib.contextmanager
+def _replace(fn):
+    """
+    Open a new HDF5 file to replace fn, keeping the groups of fn that are 
+    not replaced. The new file is written next to fn and atomically renamed 
+    to fn on success. Must be called with the lock on fn held.
+    """
+    tmp_fn = "%s.tmp%d"%(fn, os.getpid())
+    try:
+        with h5py.File(tmp_fn, "w") as f:
+            yield f
+
+            # Keep groups of other particle types
+            if os.path.exists(fn):
+                with h5py.File(fn, "r") as f_old:
+                    for gName in f_old.keys():
+                        if gName not in f:
+                            f_old.copy(f_old[gName], f)
+        os.replace(tmp_fn, fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+@contextlib.contextmanager
+def _lock(fn):
+    """
+    Exclusive lock on fn across processes and threads. The lock is held on a 
+    separate ".lock" file and released when the holder exits.
+    """
+    with open(fn + ".lock", "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _contains(func, pos, box_size, **kwargs):
+    """
+    Whether positions are inside a subset (e.g., a box or sphere). With 
+    periodic, positions are compared with the nearest image of the subset.
+    """
+    periodic = kwargs.get("periodic", True)
+    if func == "box":
+        boundary = np.asarray(kwargs["boundary"])
+        if not periodic:
+            return np.all((pos >= boundary[0]) & (pos < boundary[1]), 
+                axis=1)
+        return np.all((pos - boundary[0]) % box_size < 
+            boundary[1] - boundary[0], axis=1)
+
+    dist = pos - kwargs["center"]
+    if periodic:
+        dist -= box_size * np.round(dist / box_size)
+    return np.sum(dist**2, axis=1) <= kwargs["radius"]**2
+
+def _center(func, **kwargs):
+    """
+    Center of a subset (e.g., a box or sphere).
+    """
+    if func == "box":
+        return np.mean(kwargs["boundary"], axis=0)
+    return np.asarray(kwargs["center"])
+
+def _unwrap(result, partType, fields, mdi, box_size, center):
+    """
+    Unwrap Coordinates in place to the periodic images closest to center.
+    """
+    for i, field in enumerate(fields):
+        if field != "Coordinates":
+            continue
+        c = center if mdi is None or mdi[i] is None else center[mdi[i]]
+        for p in partType:
+            pos = result[p][field]
+            if len(pos):
+                pos -= box_size * np.round((pos - c) / box_size)
 
-def _concatenate_enable_empty(arr1, arr2):
+def _map(func, items, workers=None):
     """
-    Concatenate two arrays allowing one or two to be empty.
+    Apply func to items serially or in a thread pool, keeping the order.
     """
-    s1 = arr1.shape
-    s2 = arr2.shape
-    if len(s1) == 1 and len(s2) == 2:
-        return np.concatenate((arr1.reshape(0, s2[1]), arr2))
-    if len(s1) == 2 and len(s2) == 1:
-        return np.concatenate((arr1, arr2.reshape(0, s1[1])))
-    return np.concatenate((arr1, arr2))
+    if workers is None or workers == 1:
+        return list(map(func, items))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_propagate(func), items))
+
+def _imap(func, items, workers=None):
+    """
+    Apply func to items lazily, serially or in a thread pool, keeping the 
+    order. At most workers items are processed ahead of the consumer, so 
+    that a single worker reads ahead in the background.
+    """
+    if workers is None:
+        for item in items:
+            yield func(item)
+        return
+
+    func = _propagate(func)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = collections.deque()
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) > workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
 
 
 # Speeding up slicing with numba.jit
-from numba import jit, typed, types
+from numba import jit
+
+@jit(nopython=True)
+def _slicing(intervals, key, mark):
+    """
+    Slice the index file according to intervals of cell keys. Only occupied 
+    cells are stored in key, so interval boundaries are located by binary 
+    search. Returns ranges (start, end) into the sorted index, with shape 
+    of (n, 2).
+    """
+    ranges = np.empty((len(intervals), 2), dtype=np.int64)
+    m = 0
+    for n in range(len(intervals)):
+        start = mark[np.searchsorted(key, intervals[n,0])]
+        end = mark[np.searchsorted(key, intervals[n,1])]
+        if start == end:
+            continue
+        if m and ranges[m-1,1] == start:
+            ranges[m-1,1] = end
+        else:
+            ranges[m,0] = start
+            ranges[m,1] = end
+            m += 1
+
+    return ranges[:m]
+
+@jit(nopython=True)
+def _positions(intervals, key):
+    """
+    Positions in key of the keys within intervals of cell keys.
+    """
+    lower = np.searchsorted(key, intervals[:,0])
+    upper = np.searchsorted(key, intervals[:,1])
+
+    pos = np.empty(np.sum(upper - lower), dtype=np.int64)
+    m = 0
+    for n in range(len(intervals)):
+        for r in range(lower[n], upper[n]):
+            pos[m] = r
+            m += 1
+
+    return pos
+
+@jit(nopython=True)
+def _runs(intervals, key, chunk, start, end):
+    """
+    Slice the runs of the snapshot index according to intervals of cell 
+    keys. Returns runs (chunk, start, end) sorted by key, with shape of 
+    (n, 3).
+    """
+    pos = _positions(intervals, key)
+
+    runs = np.empty((len(pos), 3), dtype=np.int64)
+    for m in range(len(pos)):
+        runs[m,0] = chunk[pos[m]]
+        runs[m,1] = start[pos[m]]
+        runs[m,2] = end[pos[m]]
+
+    return runs
 
 @jit(nopython=True)
-def _slicing(lower, upper, mark, index, depth, int_tree):
+def _merge_ranges(ranges):
     """
-    Slice the index file according to lower/upper boundaries.
+    Merge sorted ranges (start, end) where one ends at the start of the 
+    next.
     """
-    target = typed.List.empty_list(types.int64)
-    shifter = np.array([4**depth,2**depth,1], dtype=int_tree)
-    for i in range(lower[0], upper[0]):
-        for j in range(lower[1], upper[1]):
-            idx_3d_lower = np.array([i, j, lower[2]], dtype=int_tree)
-            idx_1d_lower = np.sum(idx_3d_lower * shifter)
-            idx_3d_upper = np.array([i, j, upper[2]], dtype=int_tree)
-            idx_1d_upper = np.sum(idx_3d_upper * shifter)
+    merged = np.empty((len(ranges), 2), dtype=np.int64)
+    m = 0
+    for n in range(len(ranges)):
+        if m and merged[m-1,1] == ranges[n,0]:
+            merged[m-1,1] = ranges[n,1]
+        else:
+            merged[m,0] = ranges[n,0]
+            merged[m,1] = ranges[n,1]
+            m += 1
 
-            start = mark[idx_1d_lower]
-            end = mark[idx_1d_upper]
-            target.extend(index[start:end])
+    return merged[:m]
 
-    return target
\ No newline at end of file
+@jit(nopython=True)
+def _expand(ranges):
+    """
+    Concatenate rows start to end of all ranges.
+    """
+    count = 0
+    for n in range(len(ranges)):
+        count += ranges[n,1] - ranges[n,0]
+
+    target = np.empty(count, dtype=np.int64)
+    m = 0
+    for n in range(len(ranges)):
+        for row in range(ranges[n,0], ranges[n,1]):
+            target[m] = row
+            m += 1
+
+    return target
+
+@jit(nopython=True)
+def _materialize(ranges, index):
+    """
+    Concatenate index[start:end] of all ranges.
+    """
+    count = 0
+    for n in range(len(ranges)):
+        count += ranges[n,1] - ranges[n,0]
+
+    target = np.empty(count, dtype=np.int64)
+    m = 0
+    for n in range(len(ranges)):
+        length = ranges[n,1] - ranges[n,0]
+        target[m:m+length] = index[ranges[n,0]:ranges[n,1]]
+        m += length
+
+    return target
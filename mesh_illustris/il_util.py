@@ -10,15 +10,26 @@
 il_util module defines some commonly used functions for Illustris.
 """
 
+import os
+import zlib
+import itertools
 import numpy as np
 import h5py
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import meta_cache, chunk_cache
+from .profiler import _stage, _count, _propagate
 
 __all__ = ["loadFile", "partTypeNum", "snapPath"]
 
-def loadFile(fn, partType, fields=None, mdi=None, float32=True, index=None):
+def loadFile(fn, partType, fields=None, mdi=None, float32=True, index=None, 
+    out=None):
     """
     Load a subset of particles/cells in one chunk file. 
-    This function applies numpy.memmap to minimize memory usage.
+    This function applies numpy.memmap to minimize memory usage. Metadata 
+    of the chunk file is cached in meta_cache, so the file is only opened 
+    by h5py at the first call. Datasets that are chunked (e.g., compressed) 
+    cannot be memory-mapped, and are read by _readChunked() instead.
 
     Args:
         fn (str): File name to be loaded.
@@ -27,7 +38,12 @@ def loadFile(fn, partType, fields=None, mdi=None, float32=True, index=None):
         mdi (None or list of int, default to None): sub-indeces to be 
             loaded. None to load all.
         float32 (bool, default to False): Whether to use float32 or not.
-        index (list of list of int): List of Fancy indices for slicing.
+        index (list of list of int): List of Fancy indices for slicing. 
+            Runs of consecutive indices are copied in bulk, so sorted 
+            indices are the fastest to load.
+        out (None or dict, default to None): Arrays to store the data in 
+            place, with the same structure as the returned dict. None to 
+            allocate new arrays.
 
     Returns:
         dict: Entire or subset of data, depending on whether index == None.
@@ -42,47 +58,212 @@ def loadFile(fn, partType, fields=None, mdi=None, float32=True, index=None):
         partType = [partType]
     
     result = {}
-    with h5py.File(fn, "r") as f:
-        for j, p in enumerate(partType):
-            ptNum = partTypeNum(p)
-            gName = "PartType%d"%(ptNum)
-            result[p] = {}
-
-            numType = f["Header"].attrs["NumPart_ThisFile"][ptNum]
-            result[p]["count"] = numType
-
-            # Loop over each requested field for this particle type
-            for i, field in enumerate(fields):
-                if not numType:
-                    result[p][field] = np.array([])
+    meta = _fileMeta(fn)
+    for j, p in enumerate(partType):
+        ptNum = partTypeNum(p)
+        gName = "PartType%d"%(ptNum)
+        result[p] = {}
+
+        numType = meta["NumPart_ThisFile"][ptNum]
+        result[p]["count"] = numType
+
+        # Loop over each requested field for this particle type
+        for i, field in enumerate(fields):
+            if not numType:
+                result[p][field] = np.array([])
+                continue
+
+            # read data local to the current file
+            ds = meta[gName][field]
+            col = None if mdi is None else mdi[i]
+            dtype = ds["dtype"]
+            if dtype == np.float64 and float32: dtype = np.float32
+
+            if ds["offset"] is not None:
+                with _stage("open", fn):
+                    to_load = np.memmap(fn, mode="r", shape=ds["shape"], 
+                        offset=ds["offset"], dtype=ds["dtype"])
+                if col is not None:
+                    to_load = to_load[:,col]
+
+                # Keep the lazy memmap if the entire data is requested
+                if not index and out is None and dtype == to_load.dtype:
+                    result[p][field] = to_load
                     continue
 
-                # Allocate within return dict
-                dtype = f[gName][field].dtype
-                shape = f[gName][field].shape
-                if dtype == np.float64 and float32: dtype = np.float32
-                result[p][field] = np.zeros(shape, dtype=dtype)
-
-                # read data local to the current file
-                ds = f[gName][field]
-                offset = ds.id.get_offset()
-                dtype = ds.dtype
-                shape = ds.shape
-                to_load = np.memmap(fn, mode="r", shape=shape, offset=offset, 
-                    dtype=dtype)
-                if index:
-                    if mdi is None or mdi[i] is None:
-                        result[p][field] = to_load[index[j]]
-                    else:
-                        result[p][field] = to_load[index[j],mdi[i]]
-                else:
-                    if mdi is None or mdi[i] is None:
-                        result[p][field] = to_load[:]
+            # Allocate only the size of output within return dict
+            length = len(index[j]) if index else numType
+            if out is None:
+                shape = ds["shape"][1:] if col is None else ()
+                data = np.empty((length,) + shape, dtype=dtype)
+            else:
+                data = out[p][field]
+
+            if ds["offset"] is None:
+                _readChunked(fn, gName, field, ds, 
+                    index[j] if index else None, data, col)
+            else:
+                with _stage("gather", fn):
+                    if index:
+                        _gather(to_load, np.asarray(index[j], 
+                            dtype=np.int64), data)
                     else:
-                        result[p][field] = to_load[:,mdi[i]]
+                        data[:] = to_load
+            _count("bytes", data.nbytes, fn)
+            result[p][field] = data
+
+    return result
+
+def _fieldMeta(fn, partType, fields, mdi=None, float32=True):
+    """
+    Dtype and shape (excluding the first axis) of fields of one particle 
+    type, as returned by loadFile.
+    """
+
+    # Make sure fields is not a single element
+    if isinstance(fields, str):
+        fields = [fields]
+
+    result = {}
+    meta = _fileMeta(fn)
+    gName = "PartType%d"%(partTypeNum(partType))
+    for i, field in enumerate(fields):
+        dtype = meta[gName][field]["dtype"]
+        shape = meta[gName][field]["shape"][1:]
+        if dtype == np.float64 and float32: dtype = np.float32
+        if not (mdi is None or mdi[i] is None): shape = ()
+        result[field] = {"dtype": dtype, "shape": shape}
 
     return result
 
+def _fileMeta(fn):
+    """
+    Header and offset, dtype and shape of all fields in a chunk file. The 
+    result is cached in meta_cache.
+    """
+
+    def load():
+        meta = {}
+        with _stage("open", fn):
+            f = h5py.File(fn, "r")
+        with f:
+            for name in ["BoxSize", "NumPart_ThisFile"]:
+                meta[name] = f["Header"].attrs[name]
+            for gName in f.keys():
+                if not gName.startswith("PartType"):
+                    continue
+                meta[gName] = {}
+                for field, ds in f[gName].items():
+                    if isinstance(ds, h5py.Dataset):
+                        plist = ds.id.get_create_plist()
+                        meta[gName][field] = {"offset": ds.id.get_offset(), 
+                            "dtype": ds.dtype, "shape": ds.shape, 
+                            "chunks": ds.chunks, "filters": [
+                            plist.get_filter(k)[0] 
+                            for k in range(plist.get_nfilters())]}
+        return meta
+
+    with _stage("meta", fn):
+        return meta_cache.get(("file", fn), load)
+
+def _readChunked(fn, gName, field, meta, index, out, col=None):
+    """
+    Read rows index (None for all) of a dataset that cannot be 
+    memory-mapped, e.g., a chunked and compressed one, into out. The 
+    storage chunks containing the rows, across all columns, are 
+    decompressed only once and kept in chunk_cache. Storage chunks 
+    filtered by deflate (gzip) and shuffle only are decompressed in 
+    parallel, others by h5py.
+    """
+    with _stage("open", fn):
+        f = h5py.File(fn, "r")
+    with f, _stage("gather", fn):
+        ds = f[gName][field]
+        if index is None:
+            out[:] = ds[:] if col is None else ds[:,col]
+            return
+
+        rows = np.asarray(index, dtype=np.int64)
+        if not len(rows):
+            return
+
+        # Group rows by storage chunks
+        size = (meta["chunks"] or meta["shape"])[0]
+        ids = rows // size
+        order = np.argsort(ids, kind="stable")
+        needed, starts = np.unique(ids[order], return_index=True)
+        bounds = np.append(starts, len(rows))
+
+        def load(c):
+            return chunk_cache.get((fn, gName, field, c), 
+                lambda: _readStorageChunk(ds, meta, c))
+
+        if _parallel(meta) and len(needed) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(needed), 
+                os.cpu_count())) as executor:
+                blocks = list(executor.map(_propagate(load), needed))
+        else:
+            blocks = [load(c) for c in needed]
+
+        for n, c in enumerate(needed):
+            block = blocks[n] if col is None else blocks[n][:,col]
+            target = order[bounds[n]:bounds[n+1]]
+            out[target] = block[rows[target] - c*size]
+
+def _readStorageChunk(ds, meta, c):
+    """
+    Read and decompress the c-th row of storage chunks of ds along the 
+    first axis, assembling the storage chunks along the other axes.
+    """
+    size = (meta["chunks"] or meta["shape"])[0]
+    start = c*size
+    end = min(start + size, meta["shape"][0])
+    if not _parallel(meta):
+        return ds[start:end]
+
+    shape = tuple(meta["shape"][1:])
+    chunks = tuple(meta["chunks"][1:])
+    if chunks == shape:
+        return _decompress(ds, meta, (start,) + (0,)*len(shape))[:end-start]
+
+    # Storage chunks along the other axes, e.g., of h5py's default chunking
+    block = np.empty((size,) + shape, dtype=meta["dtype"])
+    for corner in itertools.product(*[range(0, n, k) 
+        for n, k in zip(shape, chunks)]):
+        width = tuple(min(k, n - o) for o, k, n in zip(corner, chunks, shape))
+        block[(slice(None),) + tuple(slice(o, o + w) 
+            for o, w in zip(corner, width))] = _decompress(ds, meta, 
+            (start,) + corner)[(slice(None),) + tuple(slice(0, w) 
+            for w in width)]
+    return block[:end-start]
+
+def _decompress(ds, meta, offset):
+    """
+    Read and decompress the storage chunk of ds at offset, with the shape 
+    of storage chunks.
+    """
+
+    # Undo the filters of the chunk in reverse order, unless skipped
+    mask, raw = ds.id.read_direct_chunk(offset)
+    for k in reversed(range(len(meta["filters"]))):
+        if mask & (1 << k):
+            continue
+        if meta["filters"][k] == h5py.h5z.FILTER_DEFLATE:
+            raw = zlib.decompress(raw)
+        else:
+            raw = np.frombuffer(raw, dtype=np.uint8).reshape(
+                meta["dtype"].itemsize, -1).T.tobytes()
+
+    return np.frombuffer(raw, dtype=meta["dtype"]).reshape(meta["chunks"])
+
+def _parallel(meta):
+    """
+    Whether storage chunks of a dataset can be decompressed without h5py, 
+    and thus in parallel.
+    """
+    return meta["chunks"] is not None and set(meta["filters"]) <= {
+        h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE}
+
 def partTypeNum(partType):
     """
     Map common names to numeric particle types.
@@ -130,3 +311,22 @@ def snapPath(basePath, snapNum, chunkNum=0):
     filePath = snapPath + "snap_%03d.%d.hdf5"%(snapNum, chunkNum)
 
     return filePath
+
+
+# Speeding up gathering with numba.jit
+from numba import jit
+
+@jit(nopython=True, nogil=True)
+def _gather(src, index, out):
+    """
+    Copy src[index] to out, copying runs of consecutive indices in bulk.
+    """
+    n = len(index)
+    m = 0
+    while m < n:
+        start = index[m]
+        length = 1
+        while m + length < n and index[m+length] == start + length:
+            length += 1
+        out[m:m+length] = src[start:start+length]
+        m += length
@@ -14,12 +14,14 @@ Illustris or IllustrisTNG.
 import numpy as np
 import h5py
 
-from .core import Dataset, SingleDataset
+from .core import Dataset, SingleDataset, _index_suffix
 from .il_util import partTypeNum, snapPath
 
 __all__ = ["load"]
 
-def load(basePath, snapNum, partType, depth=8, index_path=None):
+def load(basePath, snapNum, partType, depth=8, index_path=None, 
+    curve="row", build_index=False, workers=None, progress=None, 
+    aggregate=None, store=None, threshold=None):
     """
     Function to load snapshots in Illustris or IllustrisTNG.
 
@@ -32,6 +34,33 @@ def load(basePath, snapNum, partType, depth=8, index_path=None):
             corresponds to the mesh dimension of (2^8, 2^8, 2^8).
         index_path (str): Path to store the index files. None to store 
             with the data.
+        curve (str, default to "row"): Ordering of mesh cells, must be 
+            "row" (row-major) or "morton" (Z-order).
+        build_index (bool, default to False): Whether to build the index 
+            files of all chunks in advance, instead of lazily on the first 
+            query of each chunk.
+        workers (None or int, default to None): Number of processes to 
+            build the index files. None to use the number of processors.
+        progress (None or callable, default to None): Function called as 
+            progress(n_done, n_total) after each chunk is indexed.
+        aggregate (None or list of str, default to None): Scalar fields 
+            whose per-cell aggregates (sum, minimum and maximum) are stored 
+            in the index at every level of mesh, e.g., ["Masses"]. None to 
+            store only the count of particles in cells.
+        store (None, True or list of str, default to None): Fields to be 
+            copied to a store sorted by mesh cell next to the index files, 
+            so that a box or sphere is read as a few sequential slices. True 
+            to copy all fields, None to read from the snapshot. Particles 
+            are then loaded in the order of cells, and the field "row" maps 
+            them back to their rows in the snapshot. Coordinates are always 
+            stored, and only stored fields can be loaded.
+        threshold (None or int, default to None): Maximum number of 
+            particles in a cell of an adaptive index, e.g., 1024. Cells with 
+            more particles are subdivided like an octree, down to depth, so 
+            that dense regions are indexed finely and sparse ones coarsely. 
+            curve must be "morton". Chunks are then queried one by one, 
+            skipping those whose extents in the snapshot summary miss the 
+            subset. None to use the uniform mesh.
 
     Returns:
         `Dataset`: Structured data.
@@ -45,6 +74,19 @@ def load(basePath, snapNum, partType, depth=8, index_path=None):
     # Loop over chunks
     for i in range(n_chunk):
         fn = snapPath(basePath, snapNum, i)
-        d.append(SingleDataset(fn, partType, depth, index_path))
+        d.append(SingleDataset(fn, partType, depth, index_path, curve, 
+            aggregate, store, threshold))
 
-    return Dataset(d, n_chunk)
\ No newline at end of file
+    # The summary of chunk extents is stored beside the snapshot. Leaves of 
+    # adaptive indices differ between chunks, so only their extents are 
+    # summarized
+    fn = snapPath(basePath, snapNum)
+    summary_fn = ((index_path if index_path else fn[:fn.rfind("/")]) + 
+        "/snap_%03d"%snapNum + _index_suffix(depth, curve, 
+        threshold=threshold))
+
+    dataset = Dataset(d, n_chunk, summary_fn)
+    if build_index:
+        dataset.build_indices(workers, progress)
+
+    return dataset
\ No newline at end of file
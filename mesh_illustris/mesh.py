@@ -7,13 +7,14 @@ mesh module defines the Mesh to tessellate the entire volume.
 """
 
 import numpy as np
+from numba import jit
 
 __all__ = ["Mesh"]
 
 class Mesh(object):
     """Mesh class tessellates the entire volume."""
 
-    def __init__(self, pos, length, offset, boundary, depth):
+    def __init__(self, pos, length, offset, boundary, depth, curve="row"):
         """
         Args:
             pos (numpy.ndarray of scalar): Positions of points, with shape of 
@@ -25,15 +26,22 @@ class Mesh(object):
                 shape of (3, 2).
             depth (int, default to 8): Depth of Mesh. For example, depth = 8
                 corresponds to the Mesh dimension of (2^8, 2^8, 2^8).
+            curve (str, default to "row"): Ordering of cells, must be "row" 
+                (row-major) or "morton" (Z-order). With "morton", a compact 
+                box maps to fewer and longer runs of points.
         """
 
         super(Mesh, self).__init__()
 
+        if curve not in ["row", "morton"]:
+            raise ValueError("curve must be either \"row\" or \"morton\"!")
+
         self._pos = pos
         self._length = length
         self._offset = offset
         self._boundary = boundary
         self._depth = depth
+        self._curve = curve
 
         # Set the int type for Mesh
         if depth <= 10:
@@ -57,41 +65,508 @@ class Mesh(object):
                 corresponds to the Mesh dimension of (2^8, 2^8, 2^8)"""
         return self._depth
 
-    def build(self):
+    @property
+    def curve(self):
+        """str, default to "row": Ordering of cells, "row" or "morton"."""
+        return self._curve
+
+    def _cells(self):
         """
-        Build index for the points according to the Mesh.
-        The indexing process produces a "rand" and a "mark" variables, which 
-        link the index of each point to its location in the Mesh.
+        3D indices of the cells that points fall in, with shape of 
+        (length, 3).
+        """
+        idx_3d = (2**self._depth * (self._pos - self._boundary[0]) //
+            (self._boundary[1] - self._boundary[0])).astype(self._int_tree)
+
+        # Points on the upper boundary belong to the last cell
+        return np.clip(idx_3d, 0, 2**self._depth-1)
+
+    def extent(self):
+        """
+        Extent of the points in units of cells.
 
         Returns:
-            tuple of numpy.ndarray of int: (rank, mark).
+            numpy.ndarray of int: Lower (inclusive) and upper (exclusive) 
+                cells enclosing all points, with shape of (2, 3). Both are 
+                zeros if there is no point.
         """
 
         if not self._length:
-            mark = np.zeros(8**self._depth+1, dtype=np.int64)
-            rank = np.array([], dtype=np.int64)
-            return rank, mark
+            return np.zeros((2, 3), dtype=np.int64)
 
-        idx_3d = (2**self._depth * (self._pos - self._boundary[0]) //
-            (self._boundary[1] - self._boundary[0])).astype(self._int_tree)
+        idx_3d = self._cells()
+        return np.array([idx_3d.min(axis=0), idx_3d.max(axis=0)+1], 
+            dtype=np.int64)
+
+    def keys(self):
+        """
+        1D keys of the cells that points fall in.
+
+        Returns:
+            numpy.ndarray of int: Cell keys, with shape of (length,).
+        """
+
+        if not self._length:
+            return np.array([], dtype=np.int64)
 
         # Conbine 3D index into 1D 
-        idx_1d = np.sum(
-            np.left_shift(idx_3d, [2*self._depth,self._depth,0]), axis=1)
+        return _encode(self._cells(), self._depth, self._curve)
+
+    def build(self, method="counting"):
+        """
+        Build index for the points according to the Mesh.
+        The indexing process produces a "rank", a "key" and a "mark" 
+        variables, which link the index of each point to its location in 
+        the Mesh. Only occupied cells are stored, so the size of the index 
+        grows with the number of points rather than with 8^depth.
+
+        Args:
+            method (str, default to "counting"): Sorting method, must be 
+                "counting" (linear-time radix sort on cell keys) or "sort" 
+                (comparison sort). Both give identical results.
+
+        Returns:
+            tuple of numpy.ndarray of int: (rank, key, mark). "key" is the 
+                sorted 1D index of occupied cells, and points in cell 
+                key[n] are rank[mark[n]:mark[n+1]].
+        """
+
+        if method not in ["counting", "sort"]:
+            raise ValueError("method must be either \"counting\" or "
+                "\"sort\"!")
 
-        # Sort rank with index
-        idx = np.argsort(idx_1d)
-        idx_all = np.arange(8**self._depth, dtype=self._int_tree)
+        if not self._length:
+            rank = np.array([], dtype=np.int64)
+            key = np.array([], dtype=np.int64)
+            mark = np.zeros(1, dtype=np.int64)
+            return rank, key, mark
 
-        mark = np.zeros(8**self._depth+1, dtype=np.int64)
-        mark[1:] = np.searchsorted(idx_1d, idx_all, side="right", sorter=idx)
+        idx_1d = self.keys()
+
+        # Sort rank with index, keeping the order of points in each cell
+        if method == "counting":
+            idx = _counting_argsort(idx_1d, 3*self._depth)
+        else:
+            idx = np.argsort(idx_1d, kind="stable")
+
+        # Only keep occupied cells
+        idx_1d = idx_1d[idx]
+        mark = np.flatnonzero(np.diff(idx_1d)) + 1
+        key = idx_1d[np.concatenate([[0], mark])]
+        mark = np.concatenate([[0], mark, [self._length]]).astype(np.int64)
 
         rank = np.arange(self._offset, self._offset+self._length, 
             dtype=np.int64)
         rank = rank[idx]
 
-        return rank, mark
+        return rank, key, mark
+
+
+def _encode(idx_3d, depth, curve="row"):
+    """
+    Combine 3D cell indices with shape of (n, 3) into 1D cell keys.
+    """
+    idx_3d = idx_3d.astype(np.int64)
+    if curve == "row":
+        return np.sum(np.left_shift(idx_3d, [2*depth,depth,0]), axis=1)
+
+    # Interleave bits of (i, j, k) for the Z-order
+    idx_1d = np.zeros(len(idx_3d), dtype=np.int64)
+    for b in range(depth):
+        bits = (idx_3d >> b) & 1
+        idx_1d |= ((bits[:,0] << (3*b+2)) | (bits[:,1] << (3*b+1)) | 
+            (bits[:,2] << 3*b))
+    return idx_1d
+
+def _decode(idx_1d, depth, curve="row"):
+    """
+    Split 1D cell keys into 3D cell indices with shape of (n, 3), the 
+    inverse of _encode().
+    """
+    idx_1d = np.asarray(idx_1d, dtype=np.int64)
+    if curve == "row":
+        return np.right_shift(idx_1d[:,None], [2*depth,depth,0]) & (
+            (1 << depth) - 1)
+
+    # De-interleave bits of the Z-order
+    idx_3d = np.zeros((len(idx_1d), 3), dtype=np.int64)
+    for b in range(depth):
+        for d in range(3):
+            idx_3d[:,d] |= ((idx_1d >> (3*b+2-d)) & 1) << b
+    return idx_3d
+
+def _adapt(key, mark, depth, threshold):
+    """
+    Merge occupied cells (key, mark) of a Mesh with the Z-order into the 
+    leaves of an octree, where a cell is subdivided only if it has more 
+    than threshold particles, down to depth. Returns (key, level, mark) of 
+    occupied leaves sorted by key, where key is the first cell at depth in 
+    each leaf, and particles of leaf n are mark[n] to mark[n+1] in the 
+    sorted index, as for cells.
+    """
+    key = np.asarray(key, dtype=np.int64)
+    mark = np.asarray(mark, dtype=np.int64)
+    done = np.zeros(len(key), dtype=bool)
+    first, level = [], []
+
+    # With the Z-order, cells in a node at level l share the first 3*l bits 
+    # of their keys, and are thus contiguous in key
+    for l in range(depth + 1):
+        todo = np.flatnonzero(~done)
+        if not len(todo):
+            break
+        prefix = key[todo] >> 3*(depth - l)
+        bounds = np.append(np.flatnonzero(np.append(True, 
+            prefix[1:] != prefix[:-1])), len(todo))
+        lower = todo[bounds[:-1]]
+        upper = todo[bounds[1:] - 1] + 1
+
+        leaf = (mark[upper] - mark[lower] <= threshold) | (l == depth)
+        first.append(lower[leaf])
+        level.append(np.full(np.sum(leaf), l, dtype=np.int64))
+        cover = np.zeros(len(key) + 1, dtype=np.int64)
+        np.add.at(cover, lower[leaf], 1)
+        np.add.at(cover, upper[leaf], -1)
+        done |= np.cumsum(cover[:-1]) > 0
+
+    first = np.concatenate([np.array([], dtype=np.int64)] + first)
+    level = np.concatenate([np.array([], dtype=np.int64)] + level)
+    order = np.argsort(first)
+    first, level = first[order], level[order]
+    shift = 3*(depth - level)
+
+    return ((key[first] >> shift) << shift, level, 
+        np.append(mark[first], mark[-1]))
+
+@jit(nopython=True)
+def _counting_argsort(keys, bits, max_digit_bits=16):
+    """
+    Stable argsort of non-negative integer keys with at most bits bits, by 
+    least-significant-digit radix sort. Each pass is a counting sort on at 
+    most max_digit_bits bits, so the cost is linear in the number of keys.
+    """
+    n = len(keys)
+    if bits == 0:
+        return np.arange(n)
+
+    n_pass = max((bits + max_digit_bits - 1) // max_digit_bits, 1)
+    digit_bits = (bits + n_pass - 1) // n_pass
+    mask = (1 << digit_bits) - 1
+
+    # Keys are sorted along with indices to read them sequentially
+    idx = np.arange(n)
+    key = keys.astype(np.int64)
+    idx_buf = np.empty(n, dtype=np.int64)
+    key_buf = np.empty(n, dtype=np.int64)
+    for shift in range(0, n_pass*digit_bits, digit_bits):
+        count = np.zeros(mask+1, dtype=np.int64)
+        for m in range(n):
+            count[(key[m] >> shift) & mask] += 1
+        start = 0
+        for d in range(mask+1):
+            start, count[d] = start + count[d], start
+        for m in range(n):
+            d = (key[m] >> shift) & mask
+            idx_buf[count[d]] = idx[m]
+            key_buf[count[d]] = key[m]
+            count[d] += 1
+        idx, idx_buf = idx_buf, idx
+        key, key_buf = key_buf, key
+    return idx
+
+def _key_intervals(lower, upper, depth, curve="row", periodic=False):
+    """
+    Decompose the cells within lower/upper boundaries into sorted and 
+    disjoint intervals of 1D cell keys, with shape of (n, 2). With periodic, 
+    a box crossing the boundary of the Mesh is wrapped around.
+    """
+    intervals = []
+    for lower, upper in _wrap_boxes(lower, upper, depth, periodic):
+        if curve == "row":
+            intervals.append(_row_intervals(lower, upper, depth))
+        else:
+            intervals.append(_morton_intervals(lower, upper, depth))
+
+    if not intervals:
+        return np.zeros((0, 2), dtype=np.int64)
+    if len(intervals) == 1:
+        return intervals[0]
+    return _merge_intervals(np.concatenate(intervals))
+
+def _wrap_boxes(lower, upper, depth, periodic=False):
+    """
+    Split a box of cells into non-empty boxes within the Mesh. Without 
+    periodic, the box is clipped by the Mesh instead.
+    """
+    n = 2**depth
+    lower = np.asarray(lower, dtype=np.int64)
+    upper = np.asarray(upper, dtype=np.int64)
+    if not periodic:
+        lower, upper = np.clip(lower, 0, n), np.clip(upper, 0, n)
+        return [(lower, upper)] if np.all(upper > lower) else []
+
+    # Split each axis into at most two ranges
+    ranges = []
+    for l, u in zip(lower, upper):
+        if u <= l:
+            return []
+        if u - l >= n:
+            ranges.append([(0, n)])
+            continue
+        l, u = l % n, l % n + (u - l)
+        ranges.append([(l, u)] if u <= n else [(l, n), (0, u - n)])
+
+    return [(np.array([rx[0], ry[0], rz[0]]), np.array([rx[1], ry[1], rz[1]]))
+        for rx in ranges[0] for ry in ranges[1] for rz in ranges[2]]
+
+@jit(nopython=True)
+def _row_intervals(lower, upper, depth):
+    """
+    Key intervals of a box with row-major keys, one per (i, j) column 
+    unless adjacent columns are contiguous.
+    """
+    n = (upper[0]-lower[0]) * (upper[1]-lower[1])
+    intervals = np.empty((n, 2), dtype=np.int64)
+    m = 0
+    for i in range(lower[0], upper[0]):
+        for j in range(lower[1], upper[1]):
+            base = (i << 2*depth) | (j << depth)
+            if m and intervals[m-1,1] == base + lower[2]:
+                intervals[m-1,1] = base + upper[2]
+            else:
+                intervals[m,0] = base + lower[2]
+                intervals[m,1] = base + upper[2]
+                m += 1
+    return intervals[:m]
+
+@jit(nopython=True)
+def _morton_intervals(lower, upper, depth):
+    """
+    Key intervals of a box with Morton keys. Octree nodes fully inside the 
+    box are emitted as a whole, so the number of intervals scales with the 
+    surface rather than the volume of the box.
+    """
+    intervals = []
+    # Stack of (level, i, j, k, code) of octree nodes
+    stack = [(0, 0, 0, 0, 0)]
+    while len(stack):
+        level, i, j, k, code = stack.pop()
+        size = 1 << (depth-level)
+        i0, j0, k0 = i*size, j*size, k*size
+        if (i0 >= upper[0] or i0+size <= lower[0] or 
+            j0 >= upper[1] or j0+size <= lower[1] or
+            k0 >= upper[2] or k0+size <= lower[2]):
+            continue
+
+        if (i0 >= lower[0] and i0+size <= upper[0] and 
+            j0 >= lower[1] and j0+size <= upper[1] and
+            k0 >= lower[2] and k0+size <= upper[2]):
+            shift = 3*(depth-level)
+            start, end = code << shift, (code+1) << shift
+            if len(intervals) and intervals[-1][1] == start:
+                intervals[-1] = (intervals[-1][0], end)
+            else:
+                intervals.append((start, end))
+            continue
+
+        # Push children in reverse order so that keys are emitted in order
+        for c in range(7, -1, -1):
+            stack.append((level+1, 2*i + (c>>2), 2*j + ((c>>1)&1), 
+                2*k + (c&1), 8*code + c))
+
+    result = np.empty((len(intervals), 2), dtype=np.int64)
+    for m in range(len(intervals)):
+        result[m,0] = intervals[m][0]
+        result[m,1] = intervals[m][1]
+    return result
+
+@jit(nopython=True)
+def _merge_intervals(intervals):
+    """
+    Sort intervals of keys and merge those overlapping or adjacent.
+    """
+    if not len(intervals):
+        return intervals
+    intervals = intervals[np.argsort(intervals[:,0])]
+    result = np.empty_like(intervals)
+    result[0] = intervals[0]
+    m = 1
+    for n in range(1, len(intervals)):
+        if intervals[n,0] <= result[m-1,1]:
+            result[m-1,1] = max(result[m-1,1], intervals[n,1])
+        else:
+            result[m] = intervals[n]
+            m += 1
+    return result[:m]
+
+@jit(nopython=True)
+def _subtract_intervals(a, b):
+    """
+    Keys in sorted and disjoint intervals a but not in those of b.
+    """
+    result = np.empty((len(a)+len(b), 2), dtype=np.int64)
+    m = 0
+    n = 0
+    for start, end in a:
+        # Skip intervals of b before the current interval
+        while n < len(b) and b[n,1] <= start:
+            n += 1
+        k = n
+        while k < len(b) and b[k,0] < end:
+            if b[k,0] > start:
+                result[m,0] = start
+                result[m,1] = b[k,0]
+                m += 1
+            start = max(start, b[k,1])
+            k += 1
+        if start < end:
+            result[m,0] = start
+            result[m,1] = end
+            m += 1
+    return result[:m]
+
+def _column_intervals(columns, depth):
+    """
+    Key intervals with row-major keys of cells in (i, j) columns, given as 
+    an array of (i, j, lower_k, upper_k) with shape of (n, 4).
+    """
+    base = (columns[:,0] << 2*depth) | (columns[:,1] << depth)
+    intervals = np.stack([base + columns[:,2], base + columns[:,3]], axis=1)
+    return _merge_intervals(intervals.astype(np.int64))
+
+@jit(nopython=True)
+def _sphere_intervals(center, radius, depth, periodic=False):
+    """
+    Key intervals with Morton keys of cells intersecting (outer) and fully 
+    inside (inner) a sphere. Octree nodes fully inside the sphere are 
+    emitted as a whole, so the number of intervals scales with the surface 
+    rather than the volume of the sphere. Center and radius are in units 
+    of cells. With periodic, distances are measured to the nearest image.
+    """
+    n = 1 << depth
+    outer = []
+    inner = []
+    # Stack of (level, i, j, k, code) of octree nodes
+    stack = [(0, 0, 0, 0, 0)]
+    while len(stack):
+        level, i, j, k, code = stack.pop()
+        size = 1 << (depth-level)
+
+        # Nearest and farthest points of the node to the center
+        near = 0.
+        far = 0.
+        for a, idx in enumerate((i, j, k)):
+            dist = (idx + 0.5) * size - center[a]
+            if periodic:
+                dist -= n * np.round(dist / n)
+            near += max(abs(dist) - size/2, 0.)**2
+            far += (abs(dist) + size/2)**2
+        if near > radius**2:
+            continue
+
+        shift = 3*(depth-level)
+        start, end = code << shift, (code+1) << shift
+        if far <= radius**2:
+            if len(inner) and inner[-1][1] == start:
+                inner[-1] = (inner[-1][0], end)
+            else:
+                inner.append((start, end))
+        if far <= radius**2 or level == depth:
+            if len(outer) and outer[-1][1] == start:
+                outer[-1] = (outer[-1][0], end)
+            else:
+                outer.append((start, end))
+            continue
+
+        # Push children in reverse order so that keys are emitted in order
+        for c in range(7, -1, -1):
+            stack.append((level+1, 2*i + (c>>2), 2*j + ((c>>1)&1), 
+                2*k + (c&1), 8*code + c))
+
+    result = np.empty((len(outer) + len(inner), 2), dtype=np.int64)
+    for m in range(len(outer)):
+        result[m,0] = outer[m][0]
+        result[m,1] = outer[m][1]
+    for m in range(len(inner)):
+        result[len(outer)+m,0] = inner[m][0]
+        result[len(outer)+m,1] = inner[m][1]
+    return result[:len(outer)], result[len(outer):]
+
+@jit(nopython=True)
+def _sphere_columns(center, radius, depth, periodic=False):
+    """
+    Cells intersecting (outer) and fully inside (inner) a sphere, as (i, j) 
+    columns of (i, j, lower_k, upper_k). Center and radius are in units of 
+    cells. With periodic, distances are measured to the nearest image.
+    """
+    n = 1 << depth
+    ranges = np.empty((2, 2), dtype=np.int64)
+    for a in range(2):
+        ranges[a,0] = int(np.floor(center[a]-radius))
+        ranges[a,1] = int(np.floor(center[a]+radius)) + 1
+        if not periodic:
+            ranges[a,0] = max(ranges[a,0], 0)
+            ranges[a,1] = min(ranges[a,1], n)
+        elif ranges[a,1] - ranges[a,0] >= n:
+            # Every column is visited once if the sphere wraps around
+            ranges[a,0] = 0
+            ranges[a,1] = n
+    size = 2 * (max(ranges[0,1]-ranges[0,0], 0) * 
+        max(ranges[1,1]-ranges[1,0], 0))
+    outer = np.empty((size, 4), dtype=np.int64)
+    inner = np.empty((size, 4), dtype=np.int64)
+    m_outer = 0
+    m_inner = 0
+    for i in range(ranges[0,0], ranges[0,1]):
+        for j in range(ranges[1,0], ranges[1,1]):
+            i_, j_ = i % n, j % n
+
+            # Offsets from the center to the center of the column
+            dx = i_ + 0.5 - center[0]
+            dy = j_ + 0.5 - center[1]
+            if periodic:
+                dx -= n * np.round(dx / n)
+                dy -= n * np.round(dy / n)
+
+            # Nearest point of the column to the center
+            near = max(abs(dx) - 0.5, 0.)**2 + max(abs(dy) - 0.5, 0.)**2
+            if near > radius**2:
+                continue
+            dz = np.sqrt(radius**2 - near)
+            k_lo = int(np.floor(center[2]-dz))
+            k_hi = int(np.floor(center[2]+dz)) + 1
+            m_outer = _append_column(outer, m_outer, i_, j_, k_lo, k_hi, n, 
+                periodic)
+
+            # Farthest point of the column to the center
+            far = (abs(dx) + 0.5)**2 + (abs(dy) + 0.5)**2
+            if far > radius**2:
+                continue
+            dz = np.sqrt(radius**2 - far)
+            k_lo = int(np.ceil(center[2]-dz))
+            k_hi = int(np.floor(center[2]+dz))
+            m_inner = _append_column(inner, m_inner, i_, j_, k_lo, k_hi, n, 
+                periodic)
+    return outer[:m_outer], inner[:m_inner]
 
+@jit(nopython=True)
+def _append_column(columns, m, i, j, k_lo, k_hi, n, periodic):
+    """
+    Append column (i, j, k_lo, k_hi) to columns[m:], wrapping or clipping 
+    the k range by the Mesh, and return the new number of columns.
+    """
+    if periodic and k_hi - k_lo >= n:
+        k_lo, k_hi = 0, n
+    elif periodic:
+        k_lo, k_hi = k_lo % n, k_lo % n + (k_hi - k_lo)
+        if k_hi > n:
+            columns[m] = (i, j, 0, k_hi - n)
+            m += 1
+            k_hi = n
+    else:
+        k_lo, k_hi = max(k_lo, 0), min(k_hi, n)
 
-    
-    
\ No newline at end of file
+    if k_lo < k_hi:
+        columns[m] = (i, j, k_lo, k_hi)
+        m += 1
+    return m
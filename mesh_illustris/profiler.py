@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Bill Chen
+# License: MIT (see LICENSE)
+
+"""
+profiler module records where queries spend their time. Stages of queries 
+(e.g., loading the index, slicing and gathering) and counters (e.g., bytes 
+read, particles selected and cache hits) are recorded per file by every 
+active Profiler, and logged to the "mesh_illustris" logger at DEBUG level.
+"""
+
+import time
+import logging
+import threading
+import contextlib
+import contextvars
+
+__all__ = ["Profiler", "profile"]
+
+logger = logging.getLogger("mesh_illustris")
+
+class Profiler(object):
+    """Profiler class accumulates the time of stages and the counters of 
+    queries, in total and per file.
+
+    Stages are "query" (an entire query, including all stages below), 
+    "index" (loading the index), "slicing" (selecting cells from the 
+    index), "refine" (checking particles on the boundary of an exact 
+    subset), "meta" (looking up metadata of files), "open" (opening 
+    files), "gather" (reading particles) and "merge" (allocating and 
+    assembling the subset). Counters are "bytes" (bytes of particles 
+    read), "particles" (particles selected), and "<name>_hits" and 
+    "<name>_misses" of each cache, e.g., "index_cache_hits".
+
+    Stages may be nested, e.g., "refine" includes the "gather" of particles 
+    on the boundary, and "meta" includes "open" on cache misses.
+    """
+
+    def __init__(self):
+        super(Profiler, self).__init__()
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    @property
+    def stages(self):
+        """dict: Number of calls and time in seconds of each stage."""
+        return self._total(self._stages, lambda: {"calls": 0, "time": 0.})
+
+    @property
+    def counters(self):
+        """dict: Total value of each counter."""
+        return self._total(self._counters, lambda: 0)
+
+    @property
+    def files(self):
+        """dict: Stages and counters (as in stages and counters) of each 
+            file. Stages that are not specific to a file are under None."""
+
+        with self._lock:
+            result = {}
+            for (name, fn), (calls, t) in self._stages.items():
+                result.setdefault(fn, {"stages": {}, "counters": {}})[ 
+                    "stages"][name] = {"calls": calls, "time": t}
+            for (name, fn), value in self._counters.items():
+                result.setdefault(fn, {"stages": {}, "counters": {}})[ 
+                    "counters"][name] = value
+            return result
+
+    def add_time(self, stage, seconds, fn=None):
+        """
+        Add one call of a stage.
+
+        Args:
+            stage (str): Name of the stage.
+            seconds (scalar): Time spent in the stage.
+            fn (None or str, default to None): File of the stage.
+        """
+
+        with self._lock:
+            calls, t = self._stages.get((stage, fn), (0, 0.))
+            self._stages[(stage, fn)] = (calls + 1, t + seconds)
+
+    def add(self, name, value=1, fn=None):
+        """
+        Increase a counter.
+
+        Args:
+            name (str): Name of the counter.
+            value (scalar, default to 1): Increment of the counter.
+            fn (None or str, default to None): File of the counter.
+        """
+
+        with self._lock:
+            self._counters[(name, fn)] = ( 
+                self._counters.get((name, fn), 0) + value)
+
+    def clear(self):
+        """Remove all records."""
+
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+    def report(self):
+        """
+        Summarize the records, with the slowest stages first.
+
+        Returns:
+            str: Human-readable summary.
+        """
+
+        lines = ["%-8s %8s %12s"%("stage", "calls", "time (s)")]
+        for name, s in sorted(self.stages.items(), 
+            key=lambda item: -item[1]["time"]):
+            lines.append("%-8s %8d %12.6f"%(name, s["calls"], s["time"]))
+        for name, value in sorted(self.counters.items()):
+            lines.append("%-20s %12d"%(name, value))
+        return "\n".join(lines)
+
+    def _total(self, records, zero):
+        """
+        Sum records over files.
+        """
+        with self._lock:
+            result = {}
+            for (name, fn), value in records.items():
+                total = result.setdefault(name, zero())
+                if isinstance(total, dict):
+                    total["calls"] += value[0]
+                    total["time"] += value[1]
+                else:
+                    result[name] = total + value
+            return result
+
+@contextlib.contextmanager
+def profile(profiler=None):
+    """
+    Context manager to record queries inside it, including their worker 
+    threads, but not queries running concurrently in other threads. For 
+    example::
+
+        with profile() as p:
+            data.box(boundary, "gas", "Masses")
+        print(p.report())
+
+    Args:
+        profiler (None or Profiler, default to None): Profiler to record 
+            to, e.g., to accumulate several blocks. None to create one.
+
+    Yields:
+        `Profiler`: The profiler recording.
+    """
+
+    profiler = Profiler() if profiler is None else profiler
+    token = _profilers.set(_profilers.get() + (profiler,))
+    try:
+        yield profiler
+    finally:
+        _profilers.reset(token)
+
+# Active profilers of the current context
+_profilers = contextvars.ContextVar("profilers", default=())
+
+def _propagate(func):
+    """
+    Wrap func to run in a copy of the current context, so that worker 
+    threads record to the active profilers of the caller.
+    """
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(func, *args)
+
+def _enabled():
+    """
+    Whether anything is recorded, so that stages are not timed otherwise.
+    """
+    return bool(_profilers.get()) or logger.isEnabledFor(logging.DEBUG)
+
+@contextlib.contextmanager
+def _stage(name, fn=None):
+    """
+    Time the block as a stage in all active profilers and the log.
+    """
+    if not _enabled():
+        yield
+        return
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t0
+        for profiler in _profilers.get():
+            profiler.add_time(name, seconds, fn)
+        logger.debug("%s %s: %.6fs", name, fn, seconds)
+
+def _count(name, value=1, fn=None):
+    """
+    Increase a counter in all active profilers and the log.
+    """
+    if not _enabled():
+        return
+
+    for profiler in _profilers.get():
+        profiler.add(name, value, fn)
+    logger.debug("%s %s: %d", name, fn, value)
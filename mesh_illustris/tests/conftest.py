@@ -0,0 +1,79 @@
+# Copyright (c) 2021 Bill Chen
+# License: MIT (see LICENSE)
+
+"""
+conftest module provides shared fixtures for the tests.
+"""
+
+import os
+import numpy as np
+import h5py
+import pytest
+
+from mesh_illustris.il_util import snapPath
+
+def make_snapshot(basePath, snapNum=0, n_chunk=2, numPart=(200, 300), 
+    box_size=100., slabs=False, seed=0, compression=None, storage=None):
+    """
+    Write a small random snapshot in the Illustris format.
+
+    Args:
+        basePath (str): Base path of the simulation data.
+        snapNum (int, default to 0): Number of the snapshot.
+        n_chunk (int, default to 2): Number of chunks.
+        numPart (tuple of int, default to (200, 300)): Number of gas and 
+            dark matter particles in each chunk.
+        box_size (scalar, default to 100.): Box size of the simulation.
+        slabs (bool, default to False): Whether to place the particles of 
+            each chunk in a separate slab along the x axis.
+        seed (int, default to 0): Random seed.
+        compression (None or str, default to None): Compression of fields, 
+            e.g., "gzip" (with shuffle) or "lzf", in storage chunks of 64 
+            particles. None to store fields contiguously.
+        storage (None, True or tuple of int, default to None): Shape of 
+            storage chunks of Coordinates if compressed, e.g., (100, 1). 
+            True for the default of h5py, None for 64 particles.
+
+    Returns:
+        list of dict: Data written to each chunk.
+    """
+
+    rng = np.random.default_rng(seed)
+    chunks = []
+    for i in range(n_chunk):
+        fn = snapPath(str(basePath), snapNum, i)
+        data = {}
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with h5py.File(fn, "w") as f:
+            header = f.create_group("Header")
+            header.attrs["BoxSize"] = box_size
+            header.attrs["NumFilesPerSnapshot"] = n_chunk
+            header.attrs["NumPart_ThisFile"] = np.array(
+                [numPart[0], numPart[1], 0, 0, 0, 0], dtype=np.int32)
+            for ptNum, n in zip([0, 1], numPart):
+                pos = rng.uniform(0, box_size, (n, 3))
+                if slabs:
+                    pos[:,0] = (pos[:,0] + i*box_size) / n_chunk
+                data[ptNum] = {
+                    "Coordinates": pos,
+                    "Masses": rng.uniform(1, 2, n).astype(np.float32),
+                    "ParticleIDs": np.arange(n, dtype=np.uint64) + i*n}
+                grp = f.create_group("PartType%d"%ptNum)
+                for field, value in data[ptNum].items():
+                    if compression is None:
+                        grp.create_dataset(field, data=value)
+                        continue
+                    shape = (64,) + value.shape[1:]
+                    if storage is not None and field == "Coordinates":
+                        shape = storage
+                    grp.create_dataset(field, data=value, chunks=shape, 
+                        compression=compression, 
+                        shuffle=compression == "gzip")
+        chunks.append(data)
+    return chunks
+
+@pytest.fixture
+def snapshot(tmp_path):
+    """Base path and data of a small random snapshot."""
+    basePath = str(tmp_path / "output")
+    return basePath, make_snapshot(basePath)
@@ -0,0 +1,95 @@
+# Copyright (c) 2021 Bill Chen
+# License: MIT (see LICENSE)
+
+"""
+test_cache module tests APIs in cache module.
+"""
+
+import os
+import numpy as np
+import pytest
+
+from mesh_illustris.cache import *
+from mesh_illustris.core import Dataset, SingleDataset
+from mesh_illustris.il_util import snapPath
+
+def test_lru_cache():
+    c = LRUCache(2000)
+    loads = []
+    load = lambda k: lambda: loads.append(k) or np.zeros(100) # 800 bytes
+
+    c.get("a", load("a"))
+    c.get("b", load("b"))
+    c.get("a", load("a"))
+    assert loads == ["a", "b"]
+    assert c.stats["hits"] == 1 and c.stats["misses"] == 2
+
+    # "b" is the least recently used one
+    c.get("c", load("c"))
+    assert c.stats["evictions"] == 1 and c.stats["entries"] == 2
+    c.get("a", load("a"))
+    c.get("b", load("b"))
+    assert loads == ["a", "b", "c", "b"]
+
+    c.max_bytes = 1000
+    assert c.stats["entries"] == 1 and c.stats["bytes"] == 800
+    c.clear()
+    assert c.stats == {"hits": 0, "misses": 0, "evictions": 0, 
+        "entries": 0, "bytes": 0}
+
+def test_index_cache(snapshot):
+    basePath, chunks = snapshot
+    boundary = np.array([[10., 20., 30.], [40., 45., 90.]])
+    sd = SingleDataset(snapPath(basePath, 0, 0), ["gas"], 4)
+    r0 = sd.box(boundary, "gas", "ParticleIDs")
+
+    # Repeated queries reuse the loaded index
+    misses = index_cache.stats["misses"]
+    r1 = sd.box(boundary, "gas", "ParticleIDs")
+    assert index_cache.stats["misses"] == misses
+    assert np.array_equal(r0["gas"]["ParticleIDs"], r1["gas"]["ParticleIDs"])
+
+    # Evicted index is loaded again from the index file
+    index_cache.clear()
+    r2 = sd.box(boundary, "gas", "ParticleIDs")
+    assert index_cache.stats["misses"] == 1
+    assert np.array_equal(r0["gas"]["ParticleIDs"], r2["gas"]["ParticleIDs"])
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), 
+    reason="requires /proc/self/fd")
+def test_index_cache_memmap(tmp_path):
+    from mesh_illustris.tests.conftest import make_snapshot
+    basePath = str(tmp_path / "output")
+    chunks = make_snapshot(basePath, n_chunk=8)
+    d = Dataset([SingleDataset(snapPath(basePath, 0, i), ["gas", "dm"], 4) 
+        for i in range(len(chunks))], len(chunks))
+    boundary = np.array([[0., 0., 0.], [100., 100., 100.]])
+    d.box(boundary, ["gas", "dm"], "ParticleIDs")
+
+    max_entries = index_cache.max_entries
+    try:
+        index_cache.clear()
+        fds = len(os.listdir("/proc/self/fd"))
+        index_cache.max_entries = 4
+        r = d.box(boundary, ["gas", "dm"], "ParticleIDs")
+        assert r["gas"]["count"] == sum(len(c[0]["ParticleIDs"]) 
+            for c in chunks)
+
+        # Mapped indices count with their size, and evicted maps are 
+        # closed, so only the kept ones hold file descriptors
+        stats = index_cache.stats
+        assert stats["entries"] == 4 and stats["evictions"] == 12
+        assert stats["bytes"] >= 4 * 8 * 200
+        assert len(os.listdir("/proc/self/fd")) <= fds + 4
+
+        # Each index holds one map for all of its arrays
+        g = d.datasets[-1].index["PartType0"]
+        assert isinstance(g["key"], np.memmap)
+        assert g["key"]._mmap is g["index"]._mmap
+
+        index_cache.max_bytes = 1
+        assert index_cache.stats["entries"] == 1
+    finally:
+        index_cache.max_entries = max_entries
+        index_cache.max_bytes = 2**32
+        index_cache.clear()
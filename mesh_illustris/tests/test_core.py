@@ -1,2 +1,439 @@
 # Copyright (c) 2021 Bill Chen
-# License: MIT (see LICENSE)
\ No newline at end of file
+# License: MIT (see LICENSE)
+
+"""
+test_core module tests APIs in core module.
+"""
+
+import numpy as np
+import h5py
+import pytest
+
+from mesh_illustris.core import *
+from mesh_illustris.il_util import snapPath
+
+def _inside(pos, boundary):
+    return np.all((pos >= boundary[0]) & (pos < boundary[1]), axis=1)
+
+@pytest.mark.parametrize("curve", ["row", "morton"])
+@pytest.mark.parametrize("depth", [2, 4])
+def test_box_outer(snapshot, depth, curve):
+    basePath, chunks = snapshot
+    boundary = np.array([[10., 20., 30.], [40., 45., 90.]])
+    sd = SingleDataset(snapPath(basePath, 0, 0), ["gas", "dm"], depth, 
+        curve=curve)
+    r = sd.box(boundary, ["gas", "dm"], ["ParticleIDs", "Coordinates"])
+
+    for p, ptNum in [("gas", 0), ("dm", 1)]:
+        pos = chunks[0][ptNum]["Coordinates"]
+        ids = chunks[0][ptNum]["ParticleIDs"]
+
+        # The outer box includes the entire box
+        assert set(ids[_inside(pos, boundary)]) <= set(r[p]["ParticleIDs"])
+
+        # Cells are aligned to the mesh
+        cell = 100. / 2**depth
+        outer = np.array([np.floor(boundary[0]/cell)*cell, 
+            np.ceil(boundary[1]/cell)*cell])
+        assert set(r[p]["ParticleIDs"]) == set(ids[_inside(pos, outer)])
+
+def test_index_file(snapshot):
+    basePath, chunks = snapshot
+    fn = snapPath(basePath, 0, 1)
+    sd = SingleDataset(fn, "gas", 3)
+    sd.index
+    with h5py.File(fn + ".idx_d03.h5", "r") as f:
+        assert set(f["PartType0"].keys()) == {"index", "key", "mark"}
+        assert len(f["PartType0"]["key"]) <= 200
+
+    # Reload from the index file, memory-mapped
+    sd = SingleDataset(fn, "gas", 3)
+    assert len(sd.index["PartType0"]["index"]) == 200
+    for name in ["index", "key", "mark"]:
+        assert isinstance(sd.index["PartType0"][name], np.memmap)
+
+def test_build_index_threads(snapshot):
+    from concurrent.futures import ThreadPoolExecutor
+    basePath, chunks = snapshot
+    fn = snapPath(basePath, 0, 0)
+
+    # Build different particle types of the same index file concurrently
+    sds = [SingleDataset(fn, p, 3) for p in ["gas", "dm"]*4]
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda sd: sd.build_index(), sds))
+
+    with h5py.File(fn + ".idx_d03.h5", "r") as f:
+        assert set(f.keys()) == {"PartType0", "PartType1"}
+        assert f["PartType1"].attrs["count"] == 300
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_dataset_box(snapshot, workers):
+    basePath, chunks = snapshot
+    d = Dataset([SingleDataset(snapPath(basePath, 0, i), "dm", 2) 
+        for i in range(len(chunks))], len(chunks))
+    boundary = np.array([[0., 0., 0.], [50., 50., 50.]])
+    r = d.box(boundary, "dm", ["ParticleIDs", "Masses"], workers=workers)
+
+    ids = np.concatenate([c[1]["ParticleIDs"][
+        _inside(c[1]["Coordinates"], boundary)] for c in chunks])
+    assert np.array_equal(np.sort(r["dm"]["ParticleIDs"]), np.sort(ids))
+    assert len(r["dm"]["Masses"]) == len(ids)
+
+def test_dataset_box_out(snapshot):
+    basePath, chunks = snapshot
+    d = Dataset([SingleDataset(snapPath(basePath, 0, i), ["gas", "dm"], 2) 
+        for i in range(len(chunks))], len(chunks))
+    boundary = np.array([[0., 0., 0.], [50., 50., 50.]])
+    r = d.box(boundary, ["gas", "dm"], ["Coordinates", "Masses"], 
+        mdi=[0, None], float32=True)
+    assert r["gas"]["Coordinates"].dtype == np.float32
+    assert r["gas"]["Coordinates"].shape == (r["gas"]["count"],)
+
+    # Fill a caller-supplied buffer
+    out = {p: {"Coordinates": np.zeros(1000, dtype=np.float32), 
+        "Masses": np.zeros(1000, dtype=np.float32)} for p in ["gas", "dm"]}
+    r_out = d.box(boundary, ["gas", "dm"], ["Coordinates", "Masses"], 
+        mdi=[0, None], float32=True, out=out)
+    for p in ["gas", "dm"]:
+        assert np.shares_memory(r_out[p]["Masses"], out[p]["Masses"])
+        assert np.array_equal(r_out[p]["Masses"], r[p]["Masses"])
+
+    # Empty box
+    boundary = np.array([[25., 25., 25.], [25., 25., 25.]])
+    r = d.box(boundary, "dm", ["Coordinates", "Masses"])
+    assert r["dm"]["Coordinates"].shape == (0, 3)
+
+    with pytest.raises(ValueError, match="out"):
+        d.box(np.array([[0., 0., 0.], [100., 100., 100.]]), "dm", 
+            "Masses", out={"dm": {"Masses": np.zeros(10)}})
+
+@pytest.mark.parametrize("summary", [False, True])
+@pytest.mark.parametrize("workers", [None, 2])
+def test_dataset_many(snapshot, summary, workers):
+    basePath, chunks = snapshot
+    summary_fn = basePath + "/snap_000.idx_d03.h5" if summary else None
+    d = Dataset([SingleDataset(snapPath(basePath, 0, i), ["gas", "dm"], 3) 
+        for i in range(len(chunks))], len(chunks), summary_fn)
+    fields = ["ParticleIDs", "Coordinates"]
+    centers = np.array([[50., 50., 50.], [2., 98., 50.], [25., 25., 25.]])
+    radii = [20., 10., 0.]
+
+    r = d.sphere_many(centers, radii, ["gas", "dm"], fields, 
+        workers=workers, method="exact", unwrap=True)
+    for c, radius, r_many in zip(centers, radii, r):
+        r_one = d.sphere(c, radius, ["gas", "dm"], fields, method="exact", 
+            unwrap=True)
+        for p in ["gas", "dm"]:
+            assert r_many[p]["count"] == r_one[p]["count"]
+            for field in fields:
+                assert np.array_equal(r_many[p][field], r_one[p][field])
+    assert r[2]["dm"]["Coordinates"].shape == (0, 3)
+
+    # Sub-boxes are yielded as soon as they are read
+    boundaries = [np.array([[0., 0., 0.], [50., 50., 50.]]), 
+        np.array([[90., 0., 0.], [110., 100., 100.]])]
+    r = dict(d.box_many(boundaries, "dm", "ParticleIDs", workers=workers, 
+        generator=True))
+    assert sorted(r) == [0, 1]
+    for i, boundary in enumerate(boundaries):
+        assert np.array_equal(r[i]["dm"]["ParticleIDs"], 
+            d.box(boundary, "dm", "ParticleIDs")["dm"]["ParticleIDs"])
+
+@pytest.mark.parametrize("batch_size", [None, 50])
+@pytest.mark.parametrize("workers", [None, 1, 2])
+def test_dataset_iter(snapshot, batch_size, workers):
+    basePath, chunks = snapshot
+    d = Dataset([SingleDataset(snapPath(basePath, 0, i), ["gas", "dm"], 3) 
+        for i in range(len(chunks))], len(chunks))
+    fields = ["ParticleIDs", "Coordinates"]
+    center = np.array([95., 50., 50.])
+
+    r = d.sphere(center, 30., ["gas", "dm"], fields, method="exact", 
+        unwrap=True)
+    batches = list(d.iter_sphere(center, 30., ["gas", "dm"], fields, 
+        batch_size=batch_size, workers=workers, method="exact", unwrap=True))
+    assert len(batches) >= len(chunks)
+    for p in ["gas", "dm"]:
+        assert all(b[p]["count"] <= (batch_size or 300) for b in batches)
+
+        # Batches of a chunk follow the cells, rather than the index
+        order = np.argsort(r[p]["ParticleIDs"])
+        merged = {field: np.concatenate([b[p][field] for b in batches 
+            if b[p]["count"]]) for field in fields}
+        merged_order = np.argsort(merged["ParticleIDs"])
+        for field in fields:
+            assert np.array_equal(r[p][field][order], 
+                merged[field][merged_order])
+
+    # Empty sub-box
+    boundary = np.array([[25., 25., 25.], [25., 25., 25.]])
+    assert not list(d.iter_box(boundary, "dm", "ParticleIDs"))
+
+@pytest.mark.parametrize("summary", [False, True])
+@pytest.mark.parametrize("curve", ["row", "morton"])
+@pytest.mark.parametrize("boundary", [
+    [[10., 20., 30.], [60., 45., 90.]], [[90., -10., 0.], [130., 30., 100.]]])
+def test_dataset_deposit(snapshot, summary, curve, boundary):
+    basePath, chunks = snapshot
+    summary_fn = basePath + "/snap_000.idx_d04.h5" if summary else None
+    d = Dataset([SingleDataset(snapPath(basePath, 0, i), ["gas", "dm"], 4, 
+        curve=curve) for i in range(len(chunks))], len(chunks), summary_fn)
+    boundary = np.array(boundary)
+    bins = (5, 4, 3)
+
+    r = d.box(boundary, ["gas", "dm"], ["Coordinates", "Masses"], 
+        method="exact")
+    grid = d.deposit(boundary, ["gas", "dm"], "Masses", bins, workers=2)
+    count = d.deposit(boundary, "dm", bins=bins)
+    proj = d.project(boundary, "dm", "Masses", axis=1, bins=(5, 3))
+    for p in ["gas", "dm"]:
+        pos = (r[p]["Coordinates"] - boundary[0]) % 100.
+        expected = np.histogramdd(pos, bins, 
+            [(0, w) for w in boundary[1] - boundary[0]], 
+            weights=r[p]["Masses"])[0]
+        assert np.allclose(grid[p], expected)
+    assert np.sum(count["dm"]) == r["dm"]["count"]
+    assert np.allclose(proj["dm"], grid["dm"].sum(axis=1))
+
+@pytest.mark.parametrize("aggregate", [None, ["Masses"]])
+@pytest.mark.parametrize("curve", ["row", "morton"])
+@pytest.mark.parametrize("periodic", [True, False])
+def test_dataset_reduce(snapshot, aggregate, curve, periodic):
+    basePath, chunks = snapshot
+    d = Dataset([SingleDataset(snapPath(basePath, 0, i), ["gas", "dm"], 4, 
+        curve=curve, aggregate=aggregate) for i in range(len(chunks))], 
+        len(chunks), basePath + "/snap_000.idx_d04.h5")
+    fields = ["Masses"] if aggregate else None
+
+    for func, kwargs in [
+        ("box", {"boundary": np.array([[5., 20., 30.], [90., 95., 90.]])}), 
+        ("box", {"boundary": np.array([[80., -10., 0.], [130., 30., 70.]])}), 
+        ("sphere", {"center": np.array([60., 50., 40.]), "radius": 35.})]:
+        r = getattr(d, func)(partType=["gas", "dm"], fields="Masses", 
+            method="exact", periodic=periodic, **kwargs)
+        r_reduce = getattr(d, "reduce_" + func)(partType=["gas", "dm"], 
+            fields=fields, periodic=periodic, **kwargs)
+        for p in ["gas", "dm"]:
+            assert r_reduce[p]["count"] == r[p]["count"]
+            if aggregate:
+                masses = r[p]["Masses"]
+                assert np.isclose(r_reduce[p]["Masses"]["sum"], masses.sum())
+                assert r_reduce[p]["Masses"]["min"] == masses.min()
+                assert r_reduce[p]["Masses"]["max"] == masses.max()
+
+    # Aggregates of the finest level are used by deposit()
+    boundary = np.array([[0., 0., 0.], [100., 100., 100.]])
+    grid = d.deposit(boundary, "gas", "Masses", 2)["gas"]
+    assert np.isclose(grid.sum(), sum(c[0]["Masses"].sum() for c in chunks))
+
+    if not aggregate:
+        with pytest.raises(ValueError, match="aggregated"):
+            d.reduce_box(boundary, "gas", "Masses")
+
+@pytest.mark.parametrize("periodic", [True, False])
+@pytest.mark.parametrize("curve", ["row", "morton"])
+@pytest.mark.parametrize("center, radius", [
+    ([50., 50., 50.], 20.), ([10., 80., 45.], 33.), ([50., 50., 50.], 200.), 
+    ([36.5, 10.2, -1.0], 43.6)])
+def test_sphere(snapshot, curve, center, radius, periodic):
+    basePath, chunks = snapshot
+    d = Dataset([SingleDataset(snapPath(basePath, 0, i), ["gas", "dm"], 3, 
+        curve=curve) for i in range(len(chunks))], len(chunks))
+
+    def ids(r, p, ptNum):
+        pos = np.concatenate([c[ptNum]["Coordinates"] for c in chunks])
+        all_ids = np.concatenate([c[ptNum]["ParticleIDs"] for c in chunks])
+        assert set(r[p]["ParticleIDs"]) <= set(all_ids)
+        dist = pos - center
+        if periodic:
+            dist -= 100. * np.round(dist / 100.)
+        return set(all_ids[np.sum(dist**2, axis=1) <= radius**2])
+
+    kwargs = dict(partType=["gas", "dm"], fields="ParticleIDs", 
+        periodic=periodic)
+    exact = d.sphere(np.array(center), radius, method="exact", **kwargs)
+    outer = d.sphere(np.array(center), radius, method="outer", **kwargs)
+    inner = d.sphere(np.array(center), radius, method="inner", **kwargs)
+    for p, ptNum in [("gas", 0), ("dm", 1)]:
+        expected = ids(exact, p, ptNum)
+        assert sorted(exact[p]["ParticleIDs"]) == sorted(expected)
+        assert set(inner[p]["ParticleIDs"]) <= expected
+        assert expected <= set(outer[p]["ParticleIDs"])
+
+@pytest.mark.parametrize("curve", ["row", "morton"])
+def test_box_exact(snapshot, curve):
+    basePath, chunks = snapshot
+    boundary = np.array([[10., 20., 30.], [40., 45., 90.]])
+    sd = SingleDataset(snapPath(basePath, 0, 0), ["gas", "dm"], 3, 
+        curve=curve)
+    exact = sd.box(boundary, ["gas", "dm"], "ParticleIDs", method="exact")
+    inner = sd.box(boundary, ["gas", "dm"], "ParticleIDs", method="inner")
+
+    for p, ptNum in [("gas", 0), ("dm", 1)]:
+        pos = chunks[0][ptNum]["Coordinates"]
+        ids = chunks[0][ptNum]["ParticleIDs"][_inside(pos, boundary)]
+        assert sorted(exact[p]["ParticleIDs"]) == sorted(ids)
+        assert set(inner[p]["ParticleIDs"]) <= set(ids)
+
+@pytest.mark.parametrize("curve", ["row", "morton"])
+def test_box_periodic(snapshot, curve):
+    basePath, chunks = snapshot
+    d = Dataset([SingleDataset(snapPath(basePath, 0, i), "dm", 3, 
+        curve=curve) for i in range(len(chunks))], len(chunks))
+
+    # A box crossing the boundary in x and z
+    boundary = np.array([[90., 20., -15.], [115., 45., 10.]])
+    r = d.box(boundary, "dm", ["ParticleIDs", "Coordinates"], 
+        method="exact", unwrap=True)
+
+    pos = np.concatenate([c[1]["Coordinates"] for c in chunks])
+    ids = np.concatenate([c[1]["ParticleIDs"] for c in chunks])
+    inside = np.zeros(len(pos), dtype=bool)
+    for shift in [[0., 0., 0.], [100., 0., 0.], [0., 0., -100.], 
+        [100., 0., -100.]]:
+        inside |= _inside(pos + shift, boundary)
+    assert sorted(r["dm"]["ParticleIDs"]) == sorted(ids[inside])
+    assert len(r["dm"]["ParticleIDs"]) > 0
+
+    # Unwrapped coordinates are inside the box
+    assert np.all(_inside(r["dm"]["Coordinates"], boundary))
+
+    # Without periodic, the box is clipped
+    r = d.box(boundary, "dm", "ParticleIDs", method="exact", periodic=False)
+    expected = ids[_inside(pos, boundary)]
+    assert sorted(r["dm"]["ParticleIDs"]) == sorted(expected)
+
+def test_selection():
+    index = np.array([5, 2, 7, 0, 9, 1, 3], dtype=np.int64)
+    s = Selection(np.array([[0, 2], [4, 6]]), index, np.array([8]))
+    assert len(s) == s.count == 5
+    assert np.array_equal(s.index, [1, 2, 5, 8, 9])
+    assert np.array_equal(np.asarray(s, dtype=np.int64), s.index)
+
+    # Slices follow the order of ranges, without materializing the index
+    s = Selection(np.array([[0, 2], [4, 6]]), index, np.array([8]))
+    for size in [1, 2, 3, 5, 7]:
+        pieces = [s.slice(start, start + size) for start in range(0, 5, size)]
+        assert all(len(piece) <= size for piece in pieces)
+        assert all(np.array_equal(piece, np.sort(piece)) for piece in pieces)
+        assert np.array_equal(np.sort(np.concatenate(pieces)), 
+            [1, 2, 5, 8, 9])
+    assert np.array_equal(s.slice(0, 2), [2, 5])
+    assert np.array_equal(s.slice(3, 5), [1, 8])
+    assert s._materialized is None
+
+    s = Selection(np.zeros((0, 2), dtype=np.int64), index)
+    assert len(s) == 0 and len(s.index) == 0 and len(s.slice(0, 3)) == 0
+
+@pytest.mark.parametrize("curve", ["row", "morton"])
+def test_build_index_streaming(snapshot, curve):
+    basePath, chunks = snapshot
+    fn = snapPath(basePath, 0, 0)
+    sd = SingleDataset(fn, ["gas", "dm"], 3, curve=curve)
+    sd.build_index()
+    sd_stream = SingleDataset(fn, ["gas", "dm"], 3, str(basePath), curve)
+    sd_stream.build_index(block_size=37)
+
+    for gName in ["PartType0", "PartType1"]:
+        for name in ["index", "key", "mark"]:
+            assert np.array_equal(sd.index[gName][name], 
+                sd_stream.index[gName][name])
+
+@pytest.mark.parametrize("curve", ["row", "morton"])
+def test_build_index_streaming_chunked(tmp_path, monkeypatch, curve):
+    # Compressed fields are read in blocks, not entirely
+    from mesh_illustris import il_util
+    from mesh_illustris.tests.conftest import make_snapshot
+    files = []
+    for name, compression in [("plain", None), ("gzip", "gzip")]:
+        basePath = str(tmp_path / name)
+        make_snapshot(basePath, compression=compression)
+        files.append(SingleDataset(snapPath(basePath, 0, 0), ["gas", "dm"], 
+            3, basePath, curve, aggregate=["Masses"], store=["ParticleIDs"]))
+    files[0].build_index()
+
+    read = il_util._readChunked
+    sizes = []
+    def spy(fn, gName, field, meta, index, out, col=None):
+        sizes.append(len(out))
+        return read(fn, gName, field, meta, index, out, col)
+    monkeypatch.setattr(il_util, "_readChunked", spy)
+    files[1].build_index(block_size=37)
+    monkeypatch.undo()
+    assert sizes and max(sizes) <= 37
+
+    # The index, aggregates and store are identical
+    for attr in ["_index_fn", "_store_fn"]:
+        datasets = []
+        for sd in files:
+            with h5py.File(getattr(sd, attr), "r") as f:
+                values = {}
+                f.visititems(lambda name, obj: values.__setitem__(name, 
+                    obj[()]) if isinstance(obj, h5py.Dataset) else None)
+            datasets.append(values)
+        assert datasets[0].keys() == datasets[1].keys()
+        for name, value in datasets[0].items():
+            assert np.array_equal(value, datasets[1][name])
+
+@pytest.mark.parametrize("threshold", [1, 16, 1000])
+def test_adaptive(snapshot, threshold):
+    basePath, chunks = snapshot
+    d = Dataset([SingleDataset(snapPath(basePath, 0, i), ["gas", "dm"], 6, 
+        curve="morton", threshold=threshold) for i in range(len(chunks))], 
+        len(chunks))
+    sd = SingleDataset(snapPath(basePath, 0, 0), ["gas", "dm"], 6, 
+        curve="morton")
+    for gName in ["PartType0", "PartType1"]:
+        g = d.datasets[0].index[gName]
+        assert len(g["key"]) <= len(sd.index[gName]["key"])
+        assert np.array_equal(g["index"], sd.index[gName]["index"])
+
+    pos = np.concatenate([c[0]["Coordinates"] for c in chunks])
+    ids = np.concatenate([c[0]["ParticleIDs"] for c in chunks])
+    boundary = np.array([[90., 20., -15.], [115., 45., 10.]])
+    inside = np.zeros(len(pos), dtype=bool)
+    for shift in [[0., 0., 0.], [100., 0., 0.], [0., 0., -100.], 
+        [100., 0., -100.]]:
+        inside |= _inside(pos + shift, boundary)
+    dist = pos - 50.
+    subsets = [(d.box, dict(boundary=boundary), set(ids[inside])), 
+        (d.sphere, dict(center=np.array([50., 50., 50.]), radius=30.), 
+        set(ids[np.sum(dist**2, axis=1) <= 30.**2]))]
+
+    for query, kwargs, expected in subsets:
+        exact = query(partType="gas", fields="ParticleIDs", method="exact", 
+            **kwargs)["gas"]["ParticleIDs"]
+        outer = query(partType="gas", fields="ParticleIDs", method="outer", 
+            **kwargs)["gas"]["ParticleIDs"]
+        inner = query(partType="gas", fields="ParticleIDs", method="inner", 
+            **kwargs)["gas"]["ParticleIDs"]
+        assert sorted(exact) == sorted(expected)
+        assert len(set(outer)) == len(outer) and expected <= set(outer)
+        assert set(inner) <= expected
+
+    # Leaves are not cells at the same level
+    with pytest.raises(ValueError):
+        d.deposit(boundary, "gas")
+
+def test_adaptive_error(snapshot):
+    basePath, chunks = snapshot
+    fn = snapPath(basePath, 0, 0)
+    with pytest.raises(ValueError):
+        SingleDataset(fn, "gas", 6, threshold=16)
+    with pytest.raises(ValueError):
+        SingleDataset(fn, "gas", 6, curve="morton", aggregate=["Masses"], 
+            threshold=16)
+
+def test_adaptive_streaming(snapshot):
+    basePath, chunks = snapshot
+    fn = snapPath(basePath, 0, 0)
+    sd = SingleDataset(fn, ["gas", "dm"], 6, curve="morton", threshold=8)
+    sd.build_index()
+    sd_stream = SingleDataset(fn, ["gas", "dm"], 6, str(basePath), 
+        "morton", threshold=8)
+    sd_stream.build_index(block_size=37)
+
+    for gName in ["PartType0", "PartType1"]:
+        for name in ["index", "key", "level", "mark"]:
+            assert np.array_equal(sd.index[gName][name], 
+                sd_stream.index[gName][name])
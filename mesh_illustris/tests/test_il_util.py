@@ -5,6 +5,7 @@
 test_il_util module tests APIs in il_util module.
 """
 
+import numpy as np
 import h5py
 import pytest
 
@@ -22,6 +23,76 @@ def test_loadFile(snapNum, chunkNum, partType, fields, mdi, index):
     d = loadFile(fn, partType, fields, mdi, float32=True, index=index)
     assert d["stars"]["Coordinates"].shape[1] == 3
 
+@pytest.mark.parametrize("float32", [True, False])
+@pytest.mark.parametrize("index", [
+    None, [[3, 4, 5, 0, 1, 199, 7]], [[]], [np.arange(50, 150)]])
+def test_loadFile_index(snapshot, float32, index):
+    basePath, chunks = snapshot
+    fn = snapPath(basePath, 0, 1)
+    d = loadFile(fn, "gas", ["Coordinates", "Masses"], [1, None], 
+        float32, index)
+    rows = slice(None) if index is None else index[0]
+
+    pos = chunks[1][0]["Coordinates"][rows,1]
+    assert d["gas"]["Coordinates"].dtype == (
+        np.float32 if float32 else np.float64)
+    assert np.array_equal(d["gas"]["Coordinates"], pos.astype(
+        d["gas"]["Coordinates"].dtype))
+    assert np.array_equal(d["gas"]["Masses"], chunks[1][0]["Masses"][rows])
+
+def test_loadFile_out(snapshot):
+    basePath, chunks = snapshot
+    fn = snapPath(basePath, 0, 0)
+    out = {"dm": {"ParticleIDs": np.zeros(3, dtype=np.uint64)}}
+    d = loadFile(fn, "dm", "ParticleIDs", index=[[8, 9, 2]], out=out)
+    assert d["dm"]["ParticleIDs"] is out["dm"]["ParticleIDs"]
+    assert np.array_equal(out["dm"]["ParticleIDs"], [8, 9, 2])
+
+@pytest.mark.parametrize("compression", ["gzip", "lzf"])
+def test_loadFile_chunked(tmp_path, compression):
+    from mesh_illustris.cache import chunk_cache
+    from mesh_illustris.tests.conftest import make_snapshot
+    basePath = str(tmp_path / "output")
+    chunks = make_snapshot(basePath, compression=compression)
+    fn = snapPath(basePath, 0, 1)
+    data = chunks[1][1]
+
+    d = loadFile(fn, "dm", ["Coordinates", "Masses"], float32=False)
+    for field in ["Coordinates", "Masses"]:
+        assert np.array_equal(d["dm"][field], data[field])
+
+    # Each storage chunk is decompressed once
+    chunk_cache.clear()
+    index = [[299, 3, 150, 4, 64, 63, 200]]
+    for i in range(2):
+        d = loadFile(fn, "dm", ["Coordinates", "Masses"], [2, None], 
+            index=index)
+        assert np.array_equal(d["dm"]["Coordinates"], 
+            data["Coordinates"][index[0],2].astype(np.float32))
+        assert np.array_equal(d["dm"]["Masses"], data["Masses"][index[0]])
+    assert chunk_cache.stats["misses"] == 2 * 5
+
+@pytest.mark.parametrize("compression", ["gzip", "lzf"])
+@pytest.mark.parametrize("storage", [True, (100, 1), (64, 2)])
+def test_loadFile_chunked_columns(tmp_path, compression, storage):
+    # Storage chunks that do not span all columns of Coordinates
+    from mesh_illustris.tests.conftest import make_snapshot
+    basePath = str(tmp_path / "output")
+    data = make_snapshot(basePath, numPart=(200, 20000), 
+        compression=compression, storage=storage)[1][1]
+    fn = snapPath(basePath, 0, 1)
+    with h5py.File(fn, "r") as f:
+        assert f["PartType1/Coordinates"].chunks[1] < 3
+
+    index = [[19999, 3, 1250, 4, 64, 63, 12000, 5, 1249]]
+    for mdi in [None, [1]]:
+        d = loadFile(fn, "dm", "Coordinates", mdi, float32=False, 
+            index=index)
+        expected = data["Coordinates"][index[0]]
+        if mdi:
+            expected = expected[:,1]
+        assert np.array_equal(d["dm"]["Coordinates"], expected)
+
 @pytest.mark.parametrize(
     "partType, is_error, expected", [
     (0, False, 0),
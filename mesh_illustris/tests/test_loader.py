@@ -1,2 +1,254 @@
 # Copyright (c) 2021 Bill Chen
-# License: MIT (see LICENSE)
\ No newline at end of file
+# License: MIT (see LICENSE)
+
+"""
+test_loader module tests APIs in loader module.
+"""
+
+import os
+import numpy as np
+import h5py
+import pytest
+
+from mesh_illustris.loader import *
+from mesh_illustris.il_util import snapPath
+from mesh_illustris.core import _missing_store
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_load_build_index(snapshot, workers):
+    basePath, chunks = snapshot
+    calls = []
+    d = load(basePath, 0, ["gas", "dm"], 3, build_index=True, 
+        workers=workers, progress=lambda n, total: calls.append((n, total)))
+
+    assert d.n_chunk == len(chunks)
+    assert calls[-1] == (len(chunks), len(chunks))
+    for i in range(len(chunks)):
+        with h5py.File(snapPath(basePath, 0, i) + ".idx_d03.h5", "r") as f:
+            assert set(f.keys()) == {"PartType0", "PartType1"}
+
+    # Nothing left to build
+    calls.clear()
+    d.build_indices(workers=workers, progress=None)
+    assert not calls
+
+def test_load_index_path(snapshot, tmp_path):
+    basePath, chunks = snapshot
+    index_path = str(tmp_path / "index")
+    os.makedirs(index_path)
+    d = load(basePath, 0, "gas", 3, index_path, build_index=True, workers=1)
+    assert sorted(os.listdir(index_path)) == sorted(
+        ["snap_000.%d.hdf5.idx_d03.h5%s"%(i, s) 
+        for i in range(len(chunks)) for s in ["", ".lock"]] + 
+        ["snap_000.idx_d03.h5", "snap_000.idx_d03.h5.lock"])
+
+def test_load_summary(tmp_path):
+    from mesh_illustris.tests.conftest import make_snapshot
+    basePath = str(tmp_path / "output")
+    chunks = make_snapshot(basePath, n_chunk=4, slabs=True)
+    d = load(basePath, 0, ["gas", "dm"], 3)
+
+    summary = d.summary["PartType1"]
+    assert np.all(summary["count"] == 300)
+    assert np.all(summary["extent"][:,0,0] == [0, 2, 4, 6])
+    assert np.all(summary["extent"][:,1,0] == [2, 4, 6, 8])
+
+    # Only chunks overlapping the box are visited
+    boundary = np.array([[30., 0., 0.], [45., 100., 100.]])
+    datasets, targets = d._select("box", ["dm"], boundary=boundary)
+    assert datasets == d.datasets[1:2]
+    r = d.box(boundary, "dm", "ParticleIDs")
+    pos = chunks[1][1]["Coordinates"]
+    assert len(r["dm"]["ParticleIDs"]) == np.sum(
+        (pos[:,0] >= 25.) & (pos[:,0] < 50.))
+
+@pytest.mark.parametrize("method", ["outer", "exact"])
+def test_load_snapshot_index(snapshot, method):
+    from mesh_illustris.cache import index_cache
+    from mesh_illustris.core import Dataset
+    basePath, chunks = snapshot
+    d = load(basePath, 0, ["gas", "dm"], 3, curve="morton")
+    d_chunk = Dataset(d.datasets, d.n_chunk)
+
+    # Only the snapshot index is loaded by queries
+    index_cache.clear()
+    for center in [[50., 50., 50.], [95., 2., 60.]]:
+        r = d.sphere(center, 20., ["gas", "dm"], "ParticleIDs", 
+            method=method)
+        assert set(k[0] for k in index_cache._data) == {d._summary_fn}
+        r_chunk = d_chunk.sphere(center, 20., ["gas", "dm"], "ParticleIDs", 
+            method=method)
+        for p in ["gas", "dm"]:
+            assert np.array_equal(r[p]["ParticleIDs"], 
+                r_chunk[p]["ParticleIDs"])
+        index_cache.clear()
+
+@pytest.mark.parametrize("store", [True, ["Coordinates", "ParticleIDs"]])
+@pytest.mark.parametrize("build_index", [False, True])
+def test_load_store(snapshot, store, build_index):
+    basePath, chunks = snapshot
+    d = load(basePath, 0, ["gas", "dm"], 3, store=store, 
+        build_index=build_index, workers=2)
+    d_snap = load(basePath, 0, ["gas", "dm"], 3)
+    fields = ["ParticleIDs", "Coordinates", "row"]
+
+    for kwargs in [{"center": [95., 2., 60.], "radius": 20.}, 
+        {"center": [40., 50., 60.], "radius": 30.}]:
+        r = d.sphere(partType=["gas", "dm"], fields=fields, method="exact", 
+            **kwargs)
+        r_snap = d_snap.sphere(partType=["gas", "dm"], fields=fields[:2], 
+            method="exact", **kwargs)
+        for p, ptNum in [("gas", 0), ("dm", 1)]:
+            # Particles are loaded in the order of cells
+            order = np.argsort(r[p]["ParticleIDs"])
+            order_snap = np.argsort(r_snap[p]["ParticleIDs"])
+            for field in fields[:2]:
+                assert np.array_equal(r[p][field][order], 
+                    r_snap[p][field][order_snap])
+
+
+    # Rows map particles back to the snapshot
+    r = d.datasets[0].sphere(np.array([40., 50., 60.]), 30., ["gas", "dm"], 
+        ["ParticleIDs", "row"])
+    for p, ptNum in [("gas", 0), ("dm", 1)]:
+        assert np.array_equal(r[p]["ParticleIDs"], 
+            chunks[0][ptNum]["ParticleIDs"][r[p]["row"]])
+
+    # Sub-boxes are read as sequential slices of the store
+    datasets, targets = d._select("box", ["dm"], 
+        boundary=np.array([[0., 0., 0.], [50., 100., 100.]]))
+    for target in targets:
+        assert len(target[0].ranges) <= 2
+        assert np.array_equal(target[0].index, np.concatenate(
+            [np.arange(*r) for r in target[0].ranges]))
+
+def test_load_store_fields(snapshot):
+    basePath, chunks = snapshot
+    d = load(basePath, 0, ["gas", "dm"], 3, store=["ParticleIDs"])
+    d_snap = load(basePath, 0, ["gas", "dm"], 3)
+
+    # Coordinates are always stored to refine the exact subset
+    kwargs = {"center": [95., 2., 60.], "radius": 20., "method": "exact"}
+    r = d.sphere(partType="gas", fields="ParticleIDs", **kwargs)
+    r_snap = d_snap.sphere(partType="gas", fields="ParticleIDs", **kwargs)
+    assert sorted(r["gas"]["ParticleIDs"]) == sorted(
+        r_snap["gas"]["ParticleIDs"])
+
+    boundary = np.array([[10., 20., 30.], [40., 45., 90.]])
+    with pytest.raises(ValueError, match="Masses"):
+        d.box(boundary, "gas", "Masses")
+    with pytest.raises(ValueError, match="Masses"):
+        d.datasets[0].box(boundary, "gas", "Masses")
+
+def test_load_store_empty(snapshot):
+    basePath, chunks = snapshot
+    # Chunks without particles of a type have no group of that type
+    fn = snapPath(basePath, 0, 1)
+    with h5py.File(fn, "r+") as f:
+        del f["PartType1"]
+        f["Header"].attrs["NumPart_ThisFile"] = np.array([200, 0, 0, 0, 0, 
+            0], dtype=np.int32)
+
+    d = load(basePath, 0, ["gas", "dm"], 3, store=["Masses"], 
+        build_index=True, workers=1)
+    store_fn = d.datasets[1]._store_fn
+    mtime = os.stat(store_fn).st_mtime_ns
+
+    # The store is complete, and is not rewritten
+    assert _missing_store(store_fn, ["gas", "dm"], d.datasets[1]._store) == []
+    d = load(basePath, 0, ["gas", "dm"], 3, store=["Masses"], 
+        build_index=True, workers=1)
+    assert os.stat(store_fn).st_mtime_ns == mtime
+
+    r = d.box(np.array([[0., 0., 0.], [100., 100., 100.]]), "dm", "Masses")
+    assert r["dm"]["count"] == len(chunks[0][1]["Masses"])
+
+def test_load_compressed(tmp_path):
+    from mesh_illustris.tests.conftest import make_snapshot
+    basePath = str(tmp_path / "output")
+    make_snapshot(basePath, compression="gzip")
+    basePath_raw = str(tmp_path / "raw")
+    make_snapshot(basePath_raw)
+
+    center = np.array([60., 50., 40.])
+    r = load(basePath, 0, "gas", 3).sphere(center, 30., "gas", 
+        ["Coordinates", "Masses"], method="exact")
+    r_raw = load(basePath_raw, 0, "gas", 3).sphere(center, 30., "gas", 
+        ["Coordinates", "Masses"], method="exact")
+    for field in ["Coordinates", "Masses"]:
+        assert np.array_equal(r["gas"][field], r_raw["gas"][field])
+
+def test_load_adaptive(snapshot):
+    basePath, chunks = snapshot
+    boundary = np.array([[10., 20., 30.], [40., 45., 90.]])
+    d = load(basePath, 0, "gas", 8, curve="morton", threshold=16, 
+        build_index=True, workers=1)
+    d_uniform = load(basePath, 0, "gas", 8, curve="morton")
+    assert os.path.exists(snapPath(basePath, 0, 0) + 
+        ".idx_d08_morton_t16.h5")
+
+    exact = d.box(boundary, "gas", "ParticleIDs", method="exact")
+    expected = d_uniform.box(boundary, "gas", "ParticleIDs", method="exact")
+    assert sorted(exact["gas"]["ParticleIDs"]) == sorted( 
+        expected["gas"]["ParticleIDs"])
+
+def test_load_adaptive_summary(tmp_path):
+    from mesh_illustris.core import Dataset
+    from mesh_illustris.tests.conftest import make_snapshot
+    basePath = str(tmp_path / "output")
+    chunks = make_snapshot(basePath, n_chunk=4, slabs=True)
+    d = load(basePath, 0, ["gas", "dm"], 6, curve="morton", threshold=16)
+    d_uniform = load(basePath, 0, ["gas", "dm"], 6, curve="morton")
+
+    # Extents enclose the leaves of each chunk
+    summary = d.summary["PartType1"]
+    extent = d_uniform.summary["PartType1"]["extent"]
+    assert np.all(summary["count"] == 300)
+    assert np.all(summary["extent"][:,0] <= extent[:,0])
+    assert np.all(summary["extent"][:,1] >= extent[:,1])
+
+    # Only chunks overlapping the box are visited, with the same particles
+    d_chunk = Dataset(d.datasets, d.n_chunk)
+    for boundary in [[[30., 0., 0.], [45., 100., 100.]], 
+        [[30., 50., 50.], [60., 60., 60.]]]:
+        boundary = np.array(boundary)
+        datasets, targets = d._select("box", ["dm"], boundary=boundary)
+        assert len(datasets) < len(d.datasets)
+        for method in ["outer", "exact"]:
+            r = d.box(boundary, "dm", "ParticleIDs", method=method)
+            r_chunk = d_chunk.box(boundary, "dm", "ParticleIDs", 
+                method=method)
+            assert sorted(r["dm"]["ParticleIDs"]) == sorted( 
+                r_chunk["dm"]["ParticleIDs"])
+
+    # Spheres are pruned as well
+    datasets, targets = d._select("sphere", ["gas", "dm"], 
+        center=np.array([10., 50., 50.]), radius=5.)
+    assert datasets == d.datasets[:1]
+
+def test_load_many_chunks(tmp_path):
+    from mesh_illustris.core import Dataset
+    from mesh_illustris.profiler import profile
+    from mesh_illustris.tests.conftest import make_snapshot
+    basePath = str(tmp_path / "output")
+    make_snapshot(basePath, n_chunk=4, slabs=True)
+    d = Dataset(load(basePath, 0, "dm", 3).datasets, 4)
+    centers = np.array([[10., 50., 50.], [90., 50., 50.], [12., 40., 60.]])
+
+    with profile() as p:
+        results = d.sphere_many(centers, [8.]*3, "dm", "ParticleIDs", 
+            method="exact", generator=True)
+
+        # Subsets in the first chunk are yielded before reading the others
+        i, r = next(results)
+        assert i == 0
+        assert [fn for fn, f in p.files.items() 
+            if "gather" in f["stages"]] == [snapPath(basePath, 0, 0)]
+        r = dict([(i, r)] + list(results))
+
+    # Particles on the boundary are refined once per chunk
+    assert p.stages["refine"]["calls"] == 2
+    for i, center in enumerate(centers):
+        expected = d.sphere(center, 8., "dm", "ParticleIDs", method="exact")
+        assert np.array_equal(r[i]["dm"]["ParticleIDs"], 
+            expected["dm"]["ParticleIDs"])
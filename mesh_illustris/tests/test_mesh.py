@@ -1,2 +1,155 @@
 # Copyright (c) 2021 Bill Chen
-# License: MIT (see LICENSE)
\ No newline at end of file
+# License: MIT (see LICENSE)
+
+"""
+test_mesh module tests APIs in mesh module.
+"""
+
+import numpy as np
+import pytest
+
+from mesh_illustris.mesh import *
+
+from mesh_illustris.mesh import (_encode, _key_intervals, _adapt, 
+    _sphere_columns, _sphere_intervals)
+
+@pytest.mark.parametrize("depth, length", [(2, 0), (3, 1000), (8, 500)])
+def test_build(depth, length):
+    rng = np.random.default_rng(depth)
+    boundary = np.array([[0., 0., 0.], [10., 10., 10.]])
+    pos = rng.uniform(0, 10, (length, 3))
+    rank, key, mark = Mesh(pos, length, 0, boundary, depth).build()
+
+    assert len(rank) == length
+    assert len(mark) == len(key) + 1
+    assert mark[-1] == length
+    assert np.all(np.diff(key) > 0)
+
+    # Every point lies in the cell it is indexed to
+    idx_3d = (2**depth * pos // 10).astype(np.int64)
+    idx_1d = (idx_3d[:,0] << 2*depth) + (idx_3d[:,1] << depth) + idx_3d[:,2]
+    for n, k in enumerate(key):
+        assert np.all(idx_1d[rank[mark[n]:mark[n+1]]] == k)
+
+@pytest.mark.parametrize("curve", ["row", "morton"])
+@pytest.mark.parametrize("lower, upper", [
+    ([0, 0, 0], [8, 8, 8]),
+    ([1, 2, 0], [5, 7, 8]),
+    ([3, 3, 3], [4, 4, 4]),
+    ([-2, 5, 6], [3, 10, 7]),
+    ([2, 2, 2], [2, 5, 5])])
+def test_key_intervals(curve, lower, upper):
+    depth = 3
+    intervals = _key_intervals(np.array(lower), np.array(upper), depth, curve)
+    assert np.all(intervals[:,0] < intervals[:,1])
+    assert np.all(intervals[1:,0] > intervals[:-1,1])
+
+    cells = np.indices((8, 8, 8)).reshape(3, -1).T
+    key = _encode(cells, depth, curve)
+    selected = np.zeros(len(key), dtype=bool)
+    for start, end in intervals:
+        selected |= (key >= start) & (key < end)
+    expected = np.all((cells >= lower) & (cells < upper), axis=1)
+    assert np.all(selected == expected)
+
+def test_curve_error():
+    with pytest.raises(ValueError, match="curve"):
+        Mesh(np.zeros((0, 3)), 0, 0, np.zeros((2, 3)), 3, "hilbert")
+
+@pytest.mark.parametrize("curve", ["row", "morton"])
+@pytest.mark.parametrize("depth, length", [(0, 50), (1, 50), (5, 3000), 
+    (12, 3000)])
+def test_build_method(curve, depth, length):
+    rng = np.random.default_rng(depth)
+    boundary = np.array([[0., 0., 0.], [1., 1., 1.]])
+    pos = rng.uniform(0, 1, (length, 3))**3
+    m = Mesh(pos, length, 10, boundary, depth, curve)
+    for a, b in zip(m.build("counting"), m.build("sort")):
+        assert np.array_equal(a, b)
+
+    with pytest.raises(ValueError, match="method"):
+        m.build("quick")
+
+@pytest.mark.parametrize("threshold", [1, 20, 5000])
+def test_adapt(threshold):
+    depth = 5
+    rng = np.random.default_rng(threshold)
+    boundary = np.array([[0., 0., 0.], [10., 10., 10.]])
+    # Clustered points, so that leaves are at different levels
+    pos = np.concatenate([rng.uniform(0, 10, (300, 3)), 
+        rng.normal(3, 0.3, (700, 3)) % 10])
+    m = Mesh(pos, len(pos), 0, boundary, depth, "morton")
+    rank, cell_key, cell_mark = m.build()
+    key, level, mark = _adapt(cell_key, cell_mark, depth, threshold)
+
+    assert len(mark) == len(key) + 1 == len(level) + 1
+    assert mark[0] == 0 and mark[-1] == len(pos)
+    assert np.all(np.diff(key) > 0) and np.all(np.diff(mark) > 0)
+
+    # Every point lies in its leaf, and only cells with more than 
+    # threshold points are subdivided
+    point_key = m.keys()
+    count = np.diff(mark)
+    shift = 3*(depth - level)
+    for n in range(len(key)):
+        assert np.all(point_key[rank[mark[n]:mark[n+1]]] >> shift[n] == 
+            key[n] >> shift[n])
+        assert count[n] <= threshold or level[n] == depth
+        if level[n]:
+            parent = point_key >> shift[n] + 3 == key[n] >> shift[n] + 3
+            assert np.sum(parent) > threshold
+
+@pytest.mark.parametrize("depth, center, radius", [
+    (1, [0.1, 0.9, 1.], 0.19), (3, [2.92, 0.82, -0.08], 3.49), 
+    (3, [4., 4., 4.], 1.5)])
+def test_sphere_columns(depth, center, radius):
+    # Periodic spheres whose lower edges cross 0, in units of cells
+    n = 1 << depth
+    outer, inner = _sphere_columns(np.array(center), radius, depth, True)
+    cells = set((i, j, k) for i, j, lo, hi in outer for k in range(lo, hi))
+    within = set((i, j, k) for i, j, lo, hi in inner for k in range(lo, hi))
+
+    idx = np.stack(np.meshgrid(*[np.arange(n)]*3, indexing="ij"), 
+        axis=-1).reshape(-1, 3)
+    dist = idx + 0.5 - np.array(center)
+    dist -= n * np.round(dist / n)
+    near = np.sum(np.maximum(np.abs(dist) - 0.5, 0)**2, axis=1)
+    far = np.sum((np.abs(dist) + 0.5)**2, axis=1)
+    assert set(map(tuple, idx[near <= radius**2])) <= cells
+    assert within <= set(map(tuple, idx[far <= radius**2]))
+
+@pytest.mark.parametrize("periodic", [True, False])
+@pytest.mark.parametrize("depth, center, radius", [
+    (1, [0.1, 0.9, 1.], 0.19), (3, [2.92, 0.82, -0.08], 3.49), 
+    (4, [8.3, 7.6, 8.1], 5.7), (4, [15.2, 0.4, 3.3], 9.1)])
+def test_sphere_intervals(periodic, depth, center, radius):
+    # Cells with Morton keys, in units of cells
+    n = 1 << depth
+    outer, inner = _sphere_intervals(np.array(center), radius, depth, 
+        periodic)
+
+    idx = np.stack(np.meshgrid(*[np.arange(n)]*3, indexing="ij"), 
+        axis=-1).reshape(-1, 3)
+    key = _encode(idx, depth, "morton")
+    dist = idx + 0.5 - np.array(center)
+    if periodic:
+        dist -= n * np.round(dist / n)
+    near = np.sum(np.maximum(np.abs(dist) - 0.5, 0)**2, axis=1)
+    far = np.sum((np.abs(dist) + 0.5)**2, axis=1)
+    for intervals, expected in [(outer, near <= radius**2), 
+        (inner, far <= radius**2)]:
+        assert np.all(intervals[1:,0] > intervals[:-1,1])
+        selected = np.zeros(len(key), dtype=bool)
+        for start, end in intervals:
+            selected |= (key >= start) & (key < end)
+        assert np.all(selected == expected)
+
+def test_sphere_intervals_large():
+    # Nodes inside the sphere are merged, so the number of intervals 
+    # scales with the surface rather than the volume of the sphere
+    depth = 8
+    radius = 0.4 * 2**depth
+    center = np.array([0.5, 0.5, 0.5]) * 2**depth + 0.3
+    outer, inner = _sphere_intervals(center, radius, depth, True)
+    assert len(inner) <= len(outer) < 4*np.pi*radius**2
+    assert np.sum(outer[:,1] - outer[:,0]) > 4/3*np.pi*radius**3
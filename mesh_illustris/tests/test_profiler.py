@@ -0,0 +1,100 @@
+# Copyright (c) 2021 Bill Chen
+# License: MIT (see LICENSE)
+
+"""
+test_profiler module tests APIs in profiler module.
+"""
+
+import logging
+import threading
+import numpy as np
+import pytest
+
+from mesh_illustris.profiler import *
+from mesh_illustris.cache import index_cache, meta_cache
+from mesh_illustris.core import SingleDataset
+from mesh_illustris.loader import load
+from mesh_illustris.il_util import snapPath
+
+def test_profiler():
+    p = Profiler()
+    p.add_time("gather", 1., "a")
+    p.add_time("gather", 2., "b")
+    p.add("bytes", 8, "a")
+    p.add("bytes", 8, "a")
+    assert p.stages == {"gather": {"calls": 2, "time": 3.}}
+    assert p.counters == {"bytes": 16}
+    assert p.files["a"] == {"stages": {"gather": {"calls": 1, "time": 1.}}, 
+        "counters": {"bytes": 16}}
+    assert "gather" in p.report()
+    p.clear()
+    assert p.stages == {} and p.counters == {}
+
+def test_profile(snapshot, caplog):
+    basePath, chunks = snapshot
+    boundary = np.array([[10., 20., 30.], [40., 45., 90.]])
+    d = load(basePath, 0, "gas", 4)
+    index_cache.clear()
+    meta_cache.clear()
+
+    with profile() as p:
+        result = d.box(boundary, "gas", ["Coordinates", "ParticleIDs"])
+    n = result["gas"]["count"]
+
+    stages = p.stages
+    for name in ["query", "index", "slicing", "meta", "open", "gather", 
+        "merge"]:
+        assert stages[name]["calls"] > 0
+    assert stages["query"]["calls"] == 1
+    assert p.counters["particles"] == n
+    assert p.counters["bytes"] == sum(result["gas"][field].nbytes 
+        for field in ["Coordinates", "ParticleIDs"])
+    assert p.counters["index_cache_misses"] > 0
+
+    # Gathering is recorded per chunk file
+    fn = snapPath(basePath, 0, 0)
+    assert p.files[fn]["stages"]["gather"]["calls"] == 2
+
+    # Nothing is recorded outside the context, and the index is cached
+    d.box(boundary, "gas", "ParticleIDs")
+    assert p.stages["query"]["calls"] == 1
+    with profile(p):
+        d.box(boundary, "gas", "ParticleIDs")
+    assert p.stages["query"]["calls"] == 2
+    assert "index_cache_hits" in p.counters
+
+    # Stages of a single chunk, also logged at DEBUG level
+    sd = SingleDataset(fn, ["gas"], 4)
+    with caplog.at_level(logging.DEBUG, logger="mesh_illustris"):
+        with profile() as p:
+            sd.box(boundary, "gas", "ParticleIDs", method="exact")
+    assert p.stages["refine"]["calls"] == 1
+    assert any(r.getMessage().startswith("query %s"%fn) 
+        for r in caplog.records)
+
+def test_profile_threads(snapshot):
+    basePath, chunks = snapshot
+    boundary = np.array([[10., 20., 30.], [40., 45., 90.]])
+    d = load(basePath, 0, "gas", 4)
+
+    # Worker threads of a query are recorded
+    with profile() as p:
+        result = d.box(boundary, "gas", "ParticleIDs", workers=2)
+    assert p.stages["query"]["calls"] == 1
+    assert p.stages["gather"]["calls"] == 2
+    assert p.counters["bytes"] == result["gas"]["ParticleIDs"].nbytes
+
+    # Queries running concurrently in other threads are not
+    started, done = threading.Event(), threading.Event()
+    def query():
+        started.wait()
+        d.box(boundary, "gas", "ParticleIDs", workers=2)
+        done.set()
+
+    thread = threading.Thread(target=query)
+    thread.start()
+    with profile() as p:
+        started.set()
+        done.wait()
+    thread.join()
+    assert p.stages == {} and p.counters == {}